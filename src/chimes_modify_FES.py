@@ -7,7 +7,7 @@ def clean_up():
     files   = ' '.join(glob.glob("*input.xyz"))
     files  += ' '.join(glob.glob("params* "))
     files  += ' '.join(glob.glob("*run_md.in"))
-    files  += "run_chimesmd.cmd traj_bad_r.lt.rin.xyz traj_bad_r.lt.rin+dp.xyz restart.bak traj_bad_r.ge.rin+dp_dftbfrq.xyz traj.gen stdoutmsg run_md.out restart.xyzv md_statistics.out"
+    files  += "run_chimesmd.cmd traj_bad_r.lt.rin.xyz traj_bad_r.lt.rin+dp.xyz restart.bak traj_bad_r.ge.rin+dp_dftbfrq.xyz traj.gen stdoutmsg run_md.out restart.xyzv md_statistics.out frames.xyz forceout-batch.txt"
 
     helpers.run_bash_cmnd("rm -f " + files)
 
@@ -57,13 +57,14 @@ def gen_input_file(param_file, xyz_file):
     ofstream.write("\n#")
     ofstream.close()
 
-def get_FES(xyz_file,param_file, md_driver):
+def get_FES(xyz_file,param_file, md_driver, setup=True):
     
     # Tasks:
     
     # Setup files for a ChIMES md run
     
-    gen_input_file(param_file,xyz_file)
+    if setup:
+        gen_input_file(param_file,xyz_file)
     
     # Run the single point calculation
     
@@ -87,3 +88,42 @@ def get_FES(xyz_file,param_file, md_driver):
     # Return results
     
     return tmp_ener, tmp_stress, "forceout.txt"
+
+def get_FES_batch(xyz_file, param_file, md_driver):
+
+    """ 
+    
+    Evaluates every frame of a multi-frame .xyz file.
+    
+    Usage: get_FES_batch("frames.xyz", param_file, md_driver)
+    
+    Notes: ChIMES_MD only reads a single configuration, so frames are run one after
+           another, but the input file is only generated once. Returns a list of 
+           energies, a list of stress tensors (GPa) and the name of a file holding the
+           forces of all frames, one component per line, in frame order.
+    
+    """
+    
+    gen_input_file(param_file,"tmp.xyz")
+    
+    tmp_ener   = []
+    tmp_stress = []
+    
+    ofstream = open("forceout-batch.txt",'w')
+    
+    for frame in helpers.read_xyzframes(xyz_file):
+    
+        helpers.writelines("tmp.xyz", frame)
+        
+        ener, stress, force_file = get_FES("tmp.xyz", param_file, md_driver, setup=False)
+        
+        tmp_ener  .append(ener)
+        tmp_stress.append(stress)
+        
+        with open(force_file,'r') as ifstream:
+            for line in ifstream:
+                ofstream.write(line)
+                
+    ofstream.close()
+    
+    return tmp_ener, tmp_stress, "forceout-batch.txt"
@@ -418,10 +418,7 @@ def get_pared_trajs(do_cluster):
         helpers.run_bash_cmnd("mv traj+box.xyz traj_bad_r.ge.rin+dp_dftbfrq.xyz")
         
     else:
-        with open("traj_bad_r.ge.rin+dp_dftbfrq.xyz") as ifstream:
-            for line in ifstream:
-                if len(line.split()) == 1:
-                    frames += 1
+        frames = helpers.count_xyzframes_general("traj_bad_r.ge.rin+dp_dftbfrq.xyz")
     
     ################################
     # 1. Generate 20 evenly spaced frames
@@ -166,10 +166,7 @@ def continue_job(*argv, **kwargs):
             
                 print("            Resubmitting.")
 
-                if args["job_system"] == "slurm" or args["job_system"] == "TACC" or args["job_system"] == "UM-ARC":
-                    job_list.append(helpers.run_bash_cmnd("sbatch run_cp2k.cmd").split()[-1])
-                else:    
-                    job_list.append(helpers.run_bash_cmnd("qsub run_cp2k.cmd").replace('\n', ''))
+                job_list.append(helpers.submit_job("run_cp2k.cmd", args["job_system"]))
 
             else:
                 print("            Not resubmitting.")
@@ -844,6 +841,8 @@ def setup_cp2k(my_ALC, *argv, **kwargs):
         job_task.append("    done                               ")
         if args["job_system"] == "TACC":
             job_task.append("    ibrun " + "-n " + repr(int(args["job_nodes"])*int(args["job_ppn"])) + " " + args["job_executable"] + " -i cp2k.inp > ${TAG}.cp2k.out  ")
+        elif args["job_system"] == "local":
+            job_task.append("    mpirun -n " + repr(int(args["job_nodes"])*int(args["job_ppn"])) + " " + args["job_executable"] + " -i cp2k.inp > ${TAG}.cp2k.out  ")
         else:
             job_task.append("    srun -N " + repr(args["job_nodes" ]) + " -n " + repr(int(args["job_nodes"])*int(args["job_ppn"])) + " " + args["job_executable"] + " -i cp2k.inp > ${TAG}.cp2k.out  ")
         
@@ -164,10 +164,7 @@ def continue_job(*argv, **kwargs):
             
                 print("            Resubmitting.")
 
-                if args["job_system"] == "slurm" or args["job_system"] == "TACC" or args["job_system"] == "UM-ARC":
-                    job_list.append(helpers.run_bash_cmnd("sbatch run_dftb.cmd").split()[-1])
-                else:    
-                    job_list.append(helpers.run_bash_cmnd("qsub run_dftb.cmd").replace('\n', ''))
+                job_list.append(helpers.submit_job("run_dftb.cmd", args["job_system"]))
 
             else:
                 print("            Not resubmitting.")
@@ -759,6 +756,8 @@ def setup_dftb(my_ALC, *argv, **kwargs):
         job_task.append("    cp " + args["basefile_dir" ] + "/${TEMP}.dftb_in.hsd dftb_in.hsd        ")    
         if args["job_system"] == "TACC":
             job_task.append("    ibrun " + "-n " + str(int(args["job_nodes"])*int(args["job_ppn"])) + " " + args["job_executable"] + " > ${TAG}.dftb.out  ")        
+        elif args["job_system"] == "local":
+            job_task.append("    mpirun -n " + str(int(args["job_nodes"])*int(args["job_ppn"])) + " " + args["job_executable"] + " > ${TAG}.dftb.out  ")        
         else:
             job_task.append("    srun -N " + str(args["job_nodes" ]) + " -n " + str(int(args["job_nodes"])*int(args["job_ppn"])) + " " + args["job_executable"] + " > ${TAG}.dftb.out  ")        
         job_task.append("    mv results.tag ${TAG}.results.tag")
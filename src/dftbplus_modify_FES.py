@@ -5,7 +5,7 @@ import helpers
 def clean_up():
 
     files  = ' '.join(glob.glob("*.sfk"))
-    files += "tmp.gen detailed.out results.tag dftb.out tmp.xyz dftb_in.hsd stdoutmsg"
+    files += "tmp.gen detailed.out results.tag dftb.out tmp.xyz dftb_in.hsd stdoutmsg frames.xyz forceout-batch.txt"
 
 
     helpers.run_bash_cmnd("rm -f " + files)
@@ -43,7 +43,23 @@ def gen_input_file(xyz_file):
 
     return helpers.xyz_to_dftbgen(xyz_file) # Returns name of the xyz_file
 
-def get_FES(xyz_file, param_file, md_driver, temperature):
+def copy_input_files(param_file, temperature, skf=True):
+
+    """ 
+    
+    Copies the DFTB+ input file for the requested electron temperature and, 
+    optionally, the slater koster files into the current directory.
+    
+    Usage: copy_input_files(param_file, temperature)
+    
+    """
+    
+    helpers.run_bash_cmnd("cp " + param_file + "/" + str(temperature).strip() + ".dftb_in.hsd ./dftb_in.hsd")
+    
+    if skf:
+        helpers.run_bash_cmnd("cp " + ' '.join(glob.glob(param_file + "/*skf")) + " .")
+
+def get_FES(xyz_file, param_file, md_driver, temperature, setup=True):
     
     # Tasks:
     
@@ -56,12 +72,8 @@ def get_FES(xyz_file, param_file, md_driver, temperature):
     
     #### NEED TO SET THE ELECTRON TEMPERATURE
     
-    cmnd_1 = "cp " + param_file + "/" + str(temperature).strip() + ".dftb_in.hsd ./dftb_in.hsd"
-    cmnd_2 = glob.glob(param_file + "/*skf")
-    cmnd_2 = "cp " + ' '.join(cmnd_2) + " ."
-
-    helpers.run_bash_cmnd(cmnd_1)
-    helpers.run_bash_cmnd(cmnd_2)
+    if setup:
+        copy_input_files(param_file, temperature)
     
     gen_file = gen_input_file(xyz_file)
     
@@ -150,3 +162,48 @@ def get_FES(xyz_file, param_file, md_driver, temperature):
     # Return results
     
     return tmp_ener, tmp_stress, "forceout.txt"
+
+def get_FES_batch(xyz_file, param_file, md_driver, temperatures):
+
+    """ 
+    
+    Evaluates every frame of a multi-frame .xyz file.
+    
+    Usage: get_FES_batch("frames.xyz", param_file, md_driver, temperatures)
+    
+    Notes: temperatures holds one electron temperature per frame. DFTB+ is run once 
+           per frame, but the slater koster files are only copied once, and the input
+           file only when the electron temperature changes. Returns a list of 
+           energies, a list of stress tensors (GPa) and the name of a file holding the
+           forces of all frames, one component per line, in frame order.
+    
+    """
+    
+    tmp_ener   = []
+    tmp_stress = []
+    last_temp  = None
+    
+    ofstream = open("forceout-batch.txt",'w')
+    
+    for i, frame in enumerate(helpers.read_xyzframes(xyz_file)):
+    
+        temperature = str(temperatures[i]).strip()
+        
+        if temperature != last_temp:
+            copy_input_files(param_file, temperature, skf=(last_temp is None))
+            last_temp = temperature
+    
+        helpers.writelines("tmp.xyz", frame)
+        
+        ener, stress, force_file = get_FES("tmp.xyz", param_file, md_driver, temperature, setup=False)
+        
+        tmp_ener  .append(ener)
+        tmp_stress.append(stress)
+        
+        with open(force_file,'r') as ifstream:
+            for line in ifstream:
+                ofstream.write(line)
+                
+    ofstream.close()
+    
+    return tmp_ener, tmp_stress, "forceout-batch.txt"
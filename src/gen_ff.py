@@ -5,12 +5,15 @@ import os
 import glob # Warning: glob is unsorted... set my_list = sorted(glob.glob(<str>)) if sorting needed
 import copy
 import math as m
+import multiprocessing
 
 # Local modules
 
 import helpers
 import hierarch
 import modify_FES
+import local_lsq
+import planner
 
 
 def combine(to_file, from_files):
@@ -40,8 +43,8 @@ def subtract(**kwargs):
     # 0. Set up an argument parser
     ################################
     
-    default_keys   = [""]*5
-    default_values = [""]*5
+    default_keys   = [""]*8
+    default_values = [""]*8
 
 
     default_keys[0 ] = "md_driver"       ; default_values[0 ] = None      # MD code executable to use when evaluating interactions
@@ -49,6 +52,9 @@ def subtract(**kwargs):
     default_keys[2 ] = "trajectories"    ; default_values[2 ] = []         # List of trajectory files to modify
     default_keys[3 ] = "temperatures"    ; default_values[3 ] = []         # List of temperatures files for each trajectory file
     default_keys[4 ] = "parameters"      ; default_values[4 ] = []       # List of parameter files to use
+    default_keys[5 ] = "batch"           ; default_values[5 ] = False     # Evaluate all frames of a trajectory file with one MD code call?
+    default_keys[6 ] = "nproc"           ; default_values[6 ] = 1         # Number of local processes to evaluate frames over
+    default_keys[7 ] = "cache"           ; default_values[7 ] = None      # Directory for the persistent contribution cache (None: no caching)
 
     args = dict(list(zip(default_keys, default_values)))
     args.update(kwargs)    
@@ -74,104 +80,1179 @@ def subtract(**kwargs):
     
     modify_FES.write_full_FES(args["trajectories"])
     
-    for i in range(len(params)):
-        modify_FES.subtract_off(params[i], args["md_driver"], args["method"], args["trajectories"], args["temperatures"])
+    # All parameter files are subtracted in a single pass over each trajectory file
+    
+    modify_FES.subtract_off(params, args["md_driver"], args["method"], args["trajectories"], args["temperatures"], batch=args["batch"], nproc=int(args["nproc"]), cache=args["cache"])
+        
+    modify_FES.clean_up(args["method"])
+        
+            
+
+
+STORE_HEADER = 4096 # Bytes reserved for the text header of binary (A/b/weights/natoms) store files
+
+def write_store(storefile, txtfile, dtype="float64", source=None, block_rows=4096, meta=None):
+
+    """ 
+    
+    Converts a whitespace delimited text matrix/vector (e.g. A.txt, b.txt, weights.dat,
+    natoms.txt) into a binary store file, and returns the store header.
+    
+    Usage: write_store("A.bin", "A.txt", "float32")
+    
+    Notes: Store files hold a STORE_HEADER byte text header of "key value" lines 
+           (format, rows, cols, dtype, and provenance), followed by the row-major 
+           data, which can be memory mapped via read_store.
+           Rows are parsed and written in blocks of block_rows.
+           Any meta {key: str} entries are added to the header.
+    
+    """
+    
+    import numpy as np
+    import time
+    
+    shape = read_shape(txtfile)
+    rows  = shape["rows"]
+    cols  = shape["cols"]
+    
+    header = {}
+    header["format"]  = "chimes_store-1"
+    header["rows"]    = str(rows)
+    header["cols"]    = str(cols)
+    header["dtype"]   = dtype
+    header["source"]  = os.path.abspath(txtfile) if source is None else source
+    header["created"] = time.strftime("%Y-%m-%d_%H:%M:%S")
+    
+    if meta is not None:
+        header.update(meta)
+    
+    store = open_store(storefile, header)
+    
+    row = 0
+    
+    with open(txtfile,'r') as ifstream:
+    
+        while row < rows:
+        
+            block = [ifstream.readline() for i in range(min(block_rows, rows-row))]
+            
+            store[row:row+len(block)] = np.array(' '.join(block).split(), dtype=np.float64).reshape(len(block),cols)
+            
+            row += len(block)
+            
+    store.flush()
+    del store
+            
+    return header
+    
+def open_store(storefile, header):
+
+    """ 
+    
+    Creates a binary store file with the given header (see write_store) and returns 
+    a writable memory map of its (rows x cols) contents.
+    
+    Usage: open_store("A.bin", header)
+    
+    """
+    
+    import numpy as np
+    
+    text = ''.join([key + " " + str(header[key]).replace(" ","_") + "\n" for key in header])
+    
+    if len(text) > STORE_HEADER:
+        print("ERROR: Store header too long for",storefile)
+        exit()
+    
+    rows = int(header["rows"])
+    cols = int(header["cols"])
+    
+    with open(storefile,'wb') as ofstream:
+        ofstream.write(text.ljust(STORE_HEADER).encode())
+        ofstream.truncate(STORE_HEADER + rows*cols*np.dtype(header["dtype"]).itemsize)
+    
+    if rows*cols == 0:
+        return np.zeros((rows,cols), dtype=header["dtype"])
+        
+    return np.memmap(storefile, dtype=header["dtype"], mode='r+', offset=STORE_HEADER, shape=(rows,cols))
+    
+def read_store_header(storefile):
+
+    """ 
+    
+    Returns the header of a binary store file as a dictionary, or None if storefile isn't a store.
+    
+    Usage: read_store_header("A.bin")
+    
+    Notes: storefile can also be a block manifest (see write_manifest), in which case 
+           the returned header describes the row-wise concatenation of its blocks.
+    
+    """
+
+    with open(storefile,'rb') as ifstream:
+        text = ifstream.read(STORE_HEADER).decode(errors="replace")
+        
+    if text.startswith("format chimes_manifest-"):
+    
+        blocks  = read_manifest(storefile)
+        headers = [read_store_header(f) for f in blocks]
+        
+        if len(set([h["cols"] for h in headers])) > 1:
+            print("ERROR: Manifest blocks have different numbers of columns:",storefile)
+            exit()
+        
+        header = {}
+        header["format"]  = "chimes_manifest-1"
+        header["rows"]    = str(sum([int(h["rows"]) for h in headers]))
+        header["cols"]    = headers[0]["cols"]   if len(headers) > 0 else "0"
+        header["dtype"]   = headers[0]["dtype"]  if len(headers) > 0 else "float64"
+        header["source"]  = ','.join(blocks)
+        
+        return header
+        
+    if not text.startswith("format chimes_store-"):
+        return None
+        
+    header = {}
+    
+    for line in text.split('\n'):
+        line = line.split()
+        if len(line) == 2:
+            header[line[0]] = line[1]
+            
+    return header
+    
+def read_store(storefile):
+
+    """ 
+    
+    Returns a read-only memory map of a binary store file's (rows x cols) contents, 
+    and its header.
+    
+    Usage: A, header = read_store("A.bin")
+    
+    Notes: Block manifests can't be mapped as a single array; use iter_blocks instead.
+    
+    """
+    
+    import numpy as np
+
+    header = read_store_header(storefile)
+    
+    if (header is None) or (not header["format"].startswith("chimes_store-")):
+        print("ERROR: Not a store file:",storefile)
+        exit()
+        
+    rows = int(header["rows"])
+    cols = int(header["cols"])
+    
+    if rows*cols == 0:
+        return np.zeros((rows,cols), dtype=header["dtype"]), header
+    
+    return np.memmap(storefile, dtype=header["dtype"], mode='r', offset=STORE_HEADER, shape=(rows,cols)), header
+    
+def write_manifest(manifest, blocks):
+
+    """ 
+    
+    Writes a block manifest: a virtual, row-wise concatenation of existing block files
+    (binary stores, or text files for b-labeled), e.g. each ALC's own A.bin.
+    
+    Usage: write_manifest("A_comb.blocks", ["../../ALC-0/GEN_FF/A.bin", "../../ALC-1/GEN_FF/A.bin"])
+    
+    Notes: Relative block paths are taken relative to the manifest's directory. 
+           Each ALC's manifest extends the previous ALC's, so combining is O(1) 
+           in the size of the data and each ALC only stores its own rows.
+    
+    """
+    
+    with open(manifest + ".tmp",'w') as ofstream:
+        ofstream.write("format chimes_manifest-1\n")
+        for block in blocks:
+            ofstream.write("block " + block + "\n")
+            
+    os.rename(manifest + ".tmp", manifest)
+    
+def is_manifest(storefile):
+
+    """ 
+    
+    Returns True if storefile is a block manifest (see write_manifest).
+    
+    Usage: is_manifest("A_comb.blocks")
+    
+    """
+    
+    with open(storefile,'rb') as ifstream:
+        return ifstream.read(23) == b"format chimes_manifest-"
+    
+def read_manifest(manifest, resolve=True):
+
+    """ 
+    
+    Returns the list of block files in a block manifest (see write_manifest), in row order. 
+    
+    Usage: read_manifest("A_comb.blocks")
+    
+    Notes: If resolve is True, relative block paths are returned relative to the 
+           current directory rather than the manifest's.
+    
+    """
+    
+    blocks = []
+    
+    with open(manifest,'r') as ifstream:
+        for line in ifstream:
+            line = line.split()
+            if (len(line) == 2) and (line[0] == "block"):
+                blocks.append(line[1])
+                
+    if resolve:
+        blocks = [os.path.normpath(os.path.join(os.path.dirname(manifest), f)) for f in blocks]
+                
+    return blocks
+    
+def iter_blocks(storefile):
+
+    """ 
+    
+    Yields (contents, header) for each block of a binary store or block manifest, 
+    where contents is a read-only memory map (see read_store).
+    
+    Usage: for contents, header in iter_blocks("A_comb.blocks"): ...
+    
+    """
+    
+    if is_manifest(storefile):
+        for f in read_manifest(storefile):
+            yield read_store(f)
+    else:
+        yield read_store(storefile)
+    
+def export_store(storefile, txtfile, start=0, stop=None, block_rows=4096):
+
+    """ 
+    
+    Materializes rows [start,stop) of a binary store file or block manifest as a text 
+    file, e.g. for use by an external solver.
+    
+    Usage: export_store("A_comb.blocks", "A_comb.txt")
+    
+    Notes: Values are written with enough digits to round-trip the store's dtype.
+    
+    """
+    
+    import numpy as np
+    
+    if stop is None:
+        stop = int(read_store_header(storefile)["rows"])
+    
+    offset = 0 # Row index of the current block's first row in the full view
+    
+    with open(txtfile,'w') as ofstream:
+    
+        for contents, header in iter_blocks(storefile):
+        
+            fmt = "%.17g"
+            
+            if header["dtype"] == "float32":
+                fmt = "%.9g"
+                
+            srt = max(start - offset, 0)
+            end = min(stop  - offset, len(contents))
+        
+            for i in range(srt, end, block_rows):
+                np.savetxt(ofstream, contents[i:min(i+block_rows,end)], fmt=fmt)
+                
+            offset += len(contents)
+            
+            if offset >= stop:
+                break
+            
+
+def write_gram(gramfile, amat, bvec, weights, block_rows=4096):
+
+    """ 
+    
+    Computes a block's contribution to the weighted normal equations and saves it 
+    (numpy .npz) to gramfile.
+    
+    Usage: write_gram("gram.npz", "A.bin", "b.bin", "weights.bin")
+    
+    Notes: amat, bvec, and weights are binary stores (see write_store). As in the 
+           solver, each row of A and b is scaled by its weight w, i.e. W = diag(w^2).
+           Saved quantities: AtWA (ncol x ncol), AtWb (ncol), btWb, and rows. Since 
+           these are sums over rows, the cumulative values for several blocks are the sums
+           of the per-block values (see read_gram).
+    
+    """
+    
+    import numpy as np
+    
+    A, header = read_store(amat)
+    b         = read_store(bvec   )[0]
+    w         = read_store(weights)[0]
+    
+    if (len(b) != len(A)) or (len(w) != len(A)):
+        print("ERROR: Inconsistent numbers of rows in:",amat,bvec,weights)
+        exit()
+    
+    gram = new_gram(int(header["cols"]))
+    
+    for i in range(0, len(A), block_rows):
+        add_gram(gram, A[i:i+block_rows], b[i:i+block_rows,0], w[i:i+block_rows,0])
+        
+    with open(gramfile + ".tmp",'wb') as ofstream:
+        np.savez(ofstream, **gram)
+        
+    os.rename(gramfile + ".tmp", gramfile)
+    
+def new_gram(cols):
+
+    """ 
+    
+    Returns an empty set of normal equation terms (see write_gram) for cols columns.
+    
+    Usage: gram = new_gram(100)
+    
+    """
+    
+    import numpy as np
+    
+    return {"AtWA": np.zeros((cols,cols)), "AtWb": np.zeros(cols), "btWb": 0.0, "rows": 0}
+    
+def add_gram(gram, A, b, w):
+
+    """ 
+    
+    Adds a set of rows of A, b, and their weights to a set of normal equation terms 
+    (see write_gram).
+    
+    Usage: add_gram(gram, A[i:j], b[i:j], w[i:j])
+    
+    """
+    
+    import numpy as np
+    
+    w  = np.asarray(w, dtype=np.float64)
+    wA = np.asarray(A, dtype=np.float64) * w[:,None]
+    wb = np.asarray(b, dtype=np.float64) * w
+    
+    gram["AtWA"] += wA.T @ wA
+    gram["AtWb"] += wA.T @ wb
+    gram["btWb"] += wb @ wb
+    gram["rows"] += len(wA)
+    
+def text_gram(amat, bvec, weights, nworkers=1, block_rows=4096):
+
+    """ 
+    
+    Computes the weighted normal equation terms (see write_gram) for a text A-matrix, 
+    b-vector, and weights file, e.g. A_comb.txt, b_comb.txt, and weights_comb.dat.
+    
+    Usage: gram = text_gram("A_comb.txt", "b_comb.txt", "weights_comb.dat", 8)
+    
+    Notes: The A-matrix is read over nworkers processes, in line-aligned byte ranges 
+           (see index_lines).
+    
+    """
+    
+    import numpy as np
+    
+    b     = np.loadtxt(bvec,    dtype=np.float64, ndmin=1)
+    w     = np.loadtxt(weights, dtype=np.float64, ndmin=1)
+    index = index_lines(amat, nworkers)
+    lines = int(index["lines"])
+    cols  = len(helpers.head(amat,1)[0].split()) if lines > 0 else 0
+    
+    if (len(b) != lines) or (len(w) != lines):
+        print("ERROR: Inconsistent numbers of rows in:",amat,bvec,weights)
+        exit()
+    
+    nranges = max(1, min(lines, 4*nworkers))
+    tasks   = []
+    
+    for i in range(nranges):
+        srt = lines*i//nranges
+        end = lines*(i+1)//nranges
+        tasks.append([amat, cols, line_offset(amat, index, srt), end-srt, b[srt:end], w[srt:end], block_rows])
+    
+    if nworkers > 1:
+        pool    = multiprocessing.Pool(nworkers)
+        results = pool.map(text_gram_range, tasks, 1)
+        pool.close()
+        pool.join()
+    else:
+        results = [text_gram_range(task) for task in tasks]
+        
+    gram = new_gram(cols)
+    
+    for result in results:
+        for key in gram:
+            gram[key] += result[key]
+            
+    return gram
+    
+def text_gram_range(task):
+
+    """ 
+    
+    Returns the weighted normal equation terms for nlines lines of a text A-matrix, 
+    starting at a given byte offset.
+    
+    Usage: text_gram_range([amat, cols, offset, nlines, b, w, block_rows])
+    
+    Notes: Worker for text_gram.
+    
+    """
+    
+    import numpy as np
+    
+    amat, cols, offset, nlines, b, w, block_rows = task
+    
+    gram = new_gram(cols)
+    
+    with open(amat,'r') as ifstream:
+    
+        ifstream.seek(offset)
+        
+        for i in range(0, nlines, block_rows):
+        
+            block = [ifstream.readline() for j in range(min(block_rows, nlines-i))]
+            A     = np.array(' '.join(block).split(), dtype=np.float64).reshape(len(block),cols)
+            
+            add_gram(gram, A, b[i:i+len(block)], w[i:i+len(block)])
+            
+    return gram
+    
+def iter_rows(amat, block_rows=4096):
+
+    """ 
+    
+    Yields consecutive blocks of (up to block_rows) rows of a text A-matrix, or a binary 
+    store or block manifest (see write_store), as float64 numpy arrays.
+    
+    Usage: for A in iter_rows("A_comb.txt"): ...
+    
+    """
+    
+    import numpy as np
+    
+    if read_store_header(amat) is not None:
+    
+        for contents, header in iter_blocks(amat):
+            for i in range(0, len(contents), block_rows):
+                yield np.asarray(contents[i:i+block_rows], dtype=np.float64)
+                
+    else:
+    
+        with open(amat,'r') as ifstream:
+        
+            while True:
+            
+                block = [line for line in [ifstream.readline() for j in range(block_rows)] if line.strip()]
+                
+                if len(block) == 0:
+                    break
+                    
+                yield np.array(' '.join(block).split(), dtype=np.float64).reshape(len(block),-1)
+                
+def amat_product(amat, x, block_rows=4096):
+
+    """ 
+    
+    Returns A*x for a text A-matrix, or a binary store or block manifest (see write_store),
+    reading the A-matrix in blocks of block_rows.
+    
+    Usage: Ax = amat_product("A_comb.txt", x)
+    
+    Notes: x may also be a matrix, e.g. one column per solution.
+    
+    """
+    
+    import numpy as np
+    
+    Ax = [A @ x for A in iter_rows(amat, block_rows)]
+                
+    return np.concatenate(Ax + [np.zeros((0,) + np.shape(x)[1:])])
+    
+def write_amat_product(amat, x, outfiles, block_rows=4096):
+
+    """ 
+    
+    Streams A*x to each of outfiles for a text A-matrix, or a binary store or block 
+    manifest (see write_store), reading the A-matrix in blocks of block_rows.
+    
+    Usage: write_amat_product("A.txt", x, ["Ax.txt"])
+    
+    Notes: Unlike amat_product, only one block of A and of A*x is held in memory at a 
+           time. Output has the same format as np.savetxt(outfile, A @ x).
+    
+    """
+    
+    import numpy as np
+    
+    ofstreams = [open(outfile,'w') for outfile in outfiles]
+    
+    for A in iter_rows(amat, block_rows):
+    
+        Ax = A @ x
+        
+        for ofstream in ofstreams:
+            np.savetxt(ofstream, Ax)
+            
+    for ofstream in ofstreams:
+        ofstream.close()
+    
+def read_gram(gramfile):
+
+    """ 
+    
+    Returns the weighted normal equation terms saved by write_gram as a dictionary. 
+    
+    Usage: gram = read_gram("gram_comb.blocks")
+    
+    Notes: gramfile can also be a block manifest of per-ALC gram files, in which case
+           the terms are summed over blocks. Memory use is O(ncol^2), independent of 
+           the number of rows.
+    
+    """
+    
+    import numpy as np
+    
+    if is_manifest(gramfile):
+        gramfiles = read_manifest(gramfile)
+    else:
+        gramfiles = [gramfile]
+        
+    gram = None
+    
+    for f in gramfiles:
+    
+        with np.load(f) as contents:
+        
+            if gram is None:
+                gram = {key: np.array(contents[key], dtype=np.float64) for key in contents.files}
+            else:
+                for key in contents.files:
+                    gram[key] += contents[key]
+                    
+    gram["rows"] = int(gram["rows"])
+    
+    return gram
+    
+def amat_shape(combined=True, n_hyper_sets=1):
+
+    """ 
+    
+    Returns [rows, cols] of the current ALC's combined A-matrix, or of the A-matrix 
+    built for this ALC alone (combined=False), or None if it doesn't exist.
+    
+    Usage: rows, cols = amat_shape()
+    
+    Notes: Expects to be called from the ALC's base folder. Built A-matrices for multiple
+           hyper sets are counted as their column-wise join.
+    
+    """
+    
+    if combined:
+        amats = ["GEN_FF/A_comb.blocks", "GEN_FF/A_comb.bin", "GEN_FF/A_comb.txt"]
+    elif n_hyper_sets > 1:
+        amats = [["GEN_FF-" + str(i) + "/A.txt" for i in range(n_hyper_sets)]]
+    else:
+        amats = ["GEN_FF/A.bin", "GEN_FF/A.txt"]
+        
+    for amat in amats:
+    
+        parts = amat if type(amat) is list else [amat]
+        
+        if all([os.path.isfile(part) for part in parts]):
+            shapes = [read_shape(part) for part in parts]
+            return [shapes[0]["rows"], sum([shape["cols"] for shape in shapes])]
+            
+    return None
+    
+def scan_shape(txtfile):
+
+    """ 
+    
+    Returns [rows, cols, bytes, sha1 hex digest] for a text file, from one chunked pass.
+    
+    Usage: rows, cols, nbytes, digest = scan_shape("A.txt")
+    
+    Notes: A final line without a trailing newline still counts as a row. cols is the 
+           number of whitespace delimited entries on the first line.
+    
+    """
+    
+    import hashlib
+    
+    rows   = 0
+    nbytes = 0
+    first  = b''
+    last   = b'\n'
+    sha1   = hashlib.sha1()
+    
+    with open(txtfile,'rb') as ifstream:
+    
+        while True:
+        
+            chunk = ifstream.read(COPY_BYTES)
+            
+            if not chunk:
+                break
+                
+            if (rows == 0) and (b'\n' not in first):
+                first += chunk.split(b'\n',1)[0]
+                
+            sha1.update(chunk)
+            
+            rows   += chunk.count(b'\n')
+            nbytes += len(chunk)
+            last    = chunk[-1:]
+            
+    if last != b'\n':
+        rows += 1
+        
+    cols = len(first.split()) if rows > 0 else 0
+            
+    return [rows, cols, nbytes, sha1.hexdigest()]
+    
+def ends_with_newline(txtfile):
+
+    """ 
+    
+    Returns True if a text file is empty or ends in a newline.
+    
+    Usage: ends_with_newline("A.txt")
+    
+    """
+    
+    with open(txtfile,'rb') as ifstream:
+    
+        ifstream.seek(0, os.SEEK_END)
+        
+        if ifstream.tell() == 0:
+            return True
+            
+        ifstream.seek(-1, os.SEEK_END)
+        
+        return ifstream.read(1) == b'\n'
+    
+def write_shape(txtfile, parts=None, labeled=False):
+
+    """ 
+    
+    Writes a shape manifest, <txtfile>.shape, for a text matrix/vector file, and returns 
+    its contents as a dictionary (see read_shape).
+    
+    Usage: write_shape("b-labeled_comb.txt", ["../../ALC-0/GEN_FF/b-labeled_comb.txt", "b-labeled.txt"], labeled=True)
+    
+    Notes: The manifest holds "key value" lines: format, size and mtime (to detect 
+           changes), rows, cols, and one "block <rows> <bytes> <sha1>" line per block. 
+           If parts is given, txtfile is taken to be their concatenation (e.g. via 
+           helpers.cat_specific), and its blocks are those of the parts, so that only 
+           parts without a valid manifest are read. Parts must have the same number of
+           columns. If the sizes don't add up, or a part other than the last doesn't 
+           end in a newline, txtfile is rescanned. Otherwise txtfile is scanned as a 
+           single block.
+           If labeled, txtfile is a b-labeled file, and the number of rows in each 
+           weighting class (see classify_b_labeled) is kept as "class <key> <n>" lines.
+    
+    """
+    
+    stat  = os.stat(txtfile)
+    shape = None
+    
+    if parts is not None:
+    
+        shapes = [read_shape(part, labeled) for part in parts]
+        
+        if len(set([part["cols"] for part in shapes if part["rows"] > 0])) > 1:
+            print("ERROR: Parts of", txtfile, "have different numbers of columns:", parts)
+            exit()
+        
+        if sum([sum([block[1] for block in part["blocks"]]) for part in shapes]) != stat.st_size:
+            print("WARNING: Size of", txtfile, "doesn't match its parts; rescanning")
+            
+        elif not all([ends_with_newline(part) for part in parts[:-1]]):
+            print("WARNING: A part of", txtfile, "doesn't end in a newline, so rows were joined; rescanning")
+            
+        else:
+        
+            shape = {"rows": 0, "cols": 0, "blocks": [], "classes": {}}
+            
+            for part in shapes:
+            
+                shape["rows"   ] += part["rows"]
+                shape["cols"   ]  = max(shape["cols"], part["cols"])
+                shape["blocks" ] += part["blocks"]
+                
+                for key in part["classes"]:
+                    shape["classes"][key] = shape["classes"].get(key,0) + part["classes"][key]
+            
+    if shape is None:
+    
+        rows, cols, nbytes, digest = scan_shape(txtfile)
+        
+        shape = {"rows": rows, "cols": cols, "blocks": [[rows, nbytes, digest]], "classes": {}}
+        
+        if labeled:
+        
+            tags, vals = read_b_labeled(txtfile)
+            
+            for key, mask in classify_b_labeled(tags):
+                shape["classes"][key] = int(mask.sum())
+        
+    ofstream = open(txtfile + ".shape.tmp",'w')
+    ofstream.write("format chimes_shape-1\n")
+    ofstream.write("size "  + str(stat.st_size)     + '\n')
+    ofstream.write("mtime " + str(stat.st_mtime_ns) + '\n')
+    ofstream.write("rows "  + str(shape["rows"])    + '\n')
+    ofstream.write("cols "  + str(shape["cols"])    + '\n')
+    
+    for block in shape["blocks"]:
+        ofstream.write("block " + ' '.join([str(field) for field in block]) + '\n')
+        
+    for key in shape["classes"]:
+        ofstream.write("class " + key + " " + str(shape["classes"][key]) + '\n')
+        
+    ofstream.close()
+    
+    os.rename(txtfile + ".shape.tmp", txtfile + ".shape")
+    
+    return shape
+    
+def read_shape(amat, labeled=False):
+
+    """ 
+    
+    Returns a dictionary with the rows, cols, blocks ([rows, bytes, sha1] each), and 
+    label-class counts (labeled files only) of a text matrix/vector file, or the rows 
+    and cols of a binary store or block manifest (see write_store).
+    
+    Usage: rows = read_shape("b_comb.txt")["rows"]
+    
+    Notes: For text files, the shape manifest written by write_shape is used as long as 
+           the file's size and modification time are unchanged; otherwise the file is 
+           scanned once and the manifest (re)written. Use this instead of wc -l or 
+           helpers.wc_l for large files.
+    
+    """
+    
+    header = read_store_header(amat)
+    
+    if header is not None:
+        return {"rows": int(header["rows"]), "cols": int(header["cols"]), "blocks": [], "classes": {}}
+    
+    if os.path.isfile(amat + ".shape"):
+    
+        stat  = os.stat(amat)
+        shape = {"blocks": [], "classes": {}}
+        
+        for line in open(amat + ".shape",'r'):
+        
+            fields = line.split()
+            
+            if len(fields) == 0:
+                continue
+            elif fields[0] == "block":
+                shape["blocks"].append([int(fields[1]), int(fields[2]), fields[3]])
+            elif fields[0] == "class":
+                shape["classes"][fields[1]] = int(fields[2])
+            else:
+                shape[fields[0]] = fields[1]
+            
+        if (int(shape["size"]) == stat.st_size) and (int(shape["mtime"]) == stat.st_mtime_ns) and ((not labeled) or (len(shape["classes"]) > 0) or (shape["rows"] == "0")):
+        
+            shape["rows"] = int(shape["rows"])
+            shape["cols"] = int(shape["cols"])
+            
+            return shape
+            
+    return write_shape(amat, labeled=labeled)
+    
+INDEX_STRIDE = 4096     # Keep the byte offset of every INDEX_STRIDE-th line in line-offset indices
+COPY_BYTES   = 64*2**20 # Buffer size for scanning/copying large text files
+
+def index_lines(txtfile, nworkers=1, stride=INDEX_STRIDE):
+
+    """ 
+    
+    Returns a sparse line-offset index for a (large) text file, building it in parallel 
+    over nworkers byte ranges if a valid one hasn't been saved yet.
+    
+    Usage: index = index_lines("A_comb.txt", 8)
+    
+    Notes: The index is saved to <txtfile>.idx (numpy .npz) and reused as long as the 
+           file's size and modification time are unchanged, e.g. on restarts.
+           For each byte range, it holds the range's start, its number of newlines, and
+           the offsets of every stride-th line start within it. See line_offset.
+    
+    """
+    
+    import numpy as np
+    
+    stat = os.stat(txtfile)
+    
+    if os.path.isfile(txtfile + ".idx"):
+    
+        with np.load(txtfile + ".idx") as contents:
+            index = {key: contents[key] for key in contents.files}
+            
+        if (int(index["size"]) == stat.st_size) and (int(index["mtime"]) == stat.st_mtime_ns) and (int(index["stride"]) == stride):
+            return index
+    
+    nranges = max(1, min(nworkers, stat.st_size // COPY_BYTES + 1))
+    starts  = [stat.st_size*i//nranges for i in range(nranges)]
+    tasks   = [[txtfile, starts[i], stat.st_size*(i+1)//nranges, stride] for i in range(nranges)]
+
+    if nworkers > 1:
+        pool    = multiprocessing.Pool(nworkers)
+        results = pool.map(index_range, tasks, 1)
+        pool.close()
+        pool.join()
+    else:
+        results = [index_range(task) for task in tasks]
+        
+    index = {}
+    index["size"]    = np.array(stat.st_size)
+    index["mtime"]   = np.array(stat.st_mtime_ns)
+    index["stride"]  = np.array(stride)
+    index["starts"]  = np.array(starts, dtype=np.int64)
+    index["counts"]  = np.array([r[0] for r in results], dtype=np.int64)
+    index["ptr"]     = np.cumsum([0] + [len(r[1]) for r in results]).astype(np.int64)
+    index["offsets"] = np.concatenate([r[1] for r in results]).astype(np.int64)
+    
+    # A final line without a trailing newline still counts
+    
+    index["lines"]   = np.array(int(index["counts"].sum()))
+    
+    if stat.st_size > 0:
+        with open(txtfile,'rb') as ifstream:
+            ifstream.seek(stat.st_size-1)
+            if ifstream.read(1) != b'\n':
+                index["lines"] += 1
+    
+    with open(txtfile + ".idx.tmp",'wb') as ofstream:
+        np.savez(ofstream, **index)
+        
+    os.rename(txtfile + ".idx.tmp", txtfile + ".idx")
+    
+    return index
+    
+def index_range(task):
+
+    """ 
+    
+    Counts the newlines in a byte range of a text file, returning the count and the 
+    offsets of the line starts following every stride-th newline in the range.
+    
+    Usage: index_range([txtfile, start, end, stride]) 
+    
+    Notes: Worker for index_lines.
+    
+    """
+    
+    import numpy as np
+
+    txtfile, start, end, stride = task
+    
+    count   = 0
+    offsets = []
+    
+    with open(txtfile,'rb') as ifstream:
+    
+        ifstream.seek(start)
+        pos = start
+        
+        while pos < end:
+        
+            buf     = ifstream.read(min(COPY_BYTES, end-pos))
+            found   = np.flatnonzero(np.frombuffer(buf, dtype=np.uint8) == 10)
+            
+            # Local (1-based) newline numbers are count+1 ... count+len(found)
+            
+            first   = (-count-1) % stride
+            offsets.append(found[first::stride] + pos + 1)
+            
+            count  += len(found)
+            pos    += len(buf)
+            
+    return count, np.concatenate(offsets + [np.zeros(0, dtype=np.int64)])
+    
+def line_offset(txtfile, index, line):
+
+    """ 
+    
+    Returns the byte offset at which (0-based) line no. line of txtfile starts, using
+    an index from index_lines. 
+    
+    Usage: line_offset("A_comb.txt", index, 1000)
+    
+    Notes: At most stride lines are scanned.
+    
+    """
+    
+    import numpy as np
+    
+    if line <= 0:
+        return 0
+        
+    if line >= int(index["lines"]):
+        return int(index["size"])
+    
+    # Line no. line starts after newline no. line (1-based). Find the byte range holding it.
+    
+    prefix = np.cumsum(index["counts"])
+    r      = int(np.searchsorted(prefix, line))
+    j      = line - (int(prefix[r]) - int(index["counts"][r])) # Local newline number within range r
+    stride = int(index["stride"])
+    k      = j // stride
+    
+    if k > 0:
+        pos = int(index["offsets"][int(index["ptr"][r]) + k - 1])
+    else:
+        pos = int(index["starts"][r])
+    
+    skip = j - k*stride
+    
+    if skip == 0:
+        return pos
+        
+    with open(txtfile,'rb') as ifstream:
+    
+        ifstream.seek(pos)
+        
+        while True:
+        
+            buf   = ifstream.read(2**20)
+            found = np.flatnonzero(np.frombuffer(buf, dtype=np.uint8) == 10)
+            
+            if len(found) >= skip:
+                return pos + int(found[skip-1]) + 1
+                
+            skip -= len(found)
+            pos  += len(buf)
+    
+def copy_range(task):
+
+    """ 
+    
+    Copies bytes [start,end) of a file to a new file.
+    
+    Usage: copy_range([src, dst, start, end])
+    
+    Notes: Uses os.sendfile where available, otherwise large buffered copies. 
+           Worker for split_amat.
+    
+    """
+    
+    src, dst, start, end = task
+    
+    with open(src,'rb') as ifstream, open(dst,'wb') as ofstream:
+    
+        pos = start
+        
+        try:
+            while pos < end:
+                sent = os.sendfile(ofstream.fileno(), ifstream.fileno(), pos, min(COPY_BYTES, end-pos))
+                if sent == 0:
+                    break
+                pos += sent
+                
+        except (AttributeError, OSError):
+        
+            ofstream.seek(pos-start)
+            ofstream.truncate()
+            ifstream.seek(pos)
+            
+            while pos < end:
+                buf  = ifstream.read(min(COPY_BYTES, end-pos))
+                ofstream.write(buf)
+                pos += len(buf)
+                
+def export_range(task):
+
+    """ 
+    
+    Exports rows [start,stop) of a binary store or block manifest to a text file.
+    
+    Usage: export_range([storefile, txtfile, start, stop])
+    
+    Notes: Worker for split_amat.
+    
+    """
+    
+    export_store(*task)
+
+def join_amats(outfile, amats, colfile=None, batch_lines=4096):
+
+    """ 
+    
+    Joins text A-matrices column-wise (i.e., as "paste amats[0] amats[1] ... > outfile"), 
+    reading all of them in lock-step, in a single pass.
+    
+    Usage: join_amats("GEN_FF/A.txt", ["GEN_FF-0/A.txt", "GEN_FF-1/A.txt"], "GEN_FF/hyper_cols.txt")
+    
+    Notes: Output is identical to that of paste. If colfile is given, the first column 
+           and number of columns of each input are written to it, one line per input
+           (see read_hyper_cols). All inputs must have the same number of rows.
+    
+    """
+    
+    ifstreams = [open(amat,'r', buffering=COPY_BYTES) for amat in amats]
+    ofstream  = open(outfile + ".tmp",'w', buffering=COPY_BYTES)
+    
+    cols  = None
+    rows  = 0
+    
+    while True:
+    
+        blocks = [ifstream.readlines(batch_lines*64) for ifstream in ifstreams] # Size hint in bytes
         
-    modify_FES.clean_up(args["method"])
+        # Inputs differ in width, so read on until all have the same number of lines
+        
+        nlines = max([len(block) for block in blocks])
+        
+        for i in range(len(blocks)):
+            while len(blocks[i]) < nlines:
+                line = ifstreams[i].readline()
+                if not line:
+                    break
+                blocks[i].append(line)
+                
+        if nlines == 0:
+            break
+            
+        if min([len(block) for block in blocks]) != nlines:
+            print("ERROR: A-matrices to be joined have different numbers of rows:", amats)
+            exit()
+            
+        if cols is None:
+            cols = [len(block[0].split()) for block in blocks]
+            
+        ofstream.write(''.join(['\t'.join(line) + '\n' for line in zip(*[[line.rstrip('\n') for line in block] for block in blocks])]))
+        
+        rows += nlines
+        
+    for ifstream in ifstreams:
+        ifstream.close()
+    ofstream.close()
+    
+    os.rename(outfile + ".tmp", outfile)
+    
+    if cols is None:
+        cols = [0]*len(amats)
+    
+    print("Joined", len(amats), "A-matrices with", rows, "rows and", cols, "columns")
+    
+    if colfile is not None:
+    
+        ofstream = open(colfile,'w')
         
+        for i in range(len(amats)):
+            ofstream.write(str(sum(cols[:i])) + " " + str(cols[i]) + '\n')
             
+        ofstream.close()
+        
+def read_hyper_cols(colfile="GEN_FF/hyper_cols.txt"):
 
+    """ 
+    
+    Returns a list of [first column, number of columns] for each joined A-matrix, as 
+    saved by join_amats, or None if there's no such file.
+    
+    Usage: cols = read_hyper_cols()
+    
+    """
+    
+    if not os.path.isfile(colfile):
+        return None
+        
+    return [[int(field) for field in line.split()] for line in open(colfile,'r') if line.strip()]
 
-def split_amat(amat, bvec, nproc, ppn):
+def split_amat(amat, bvec, nproc, ppn, nworkers=1):
 
     """ 
     
     Splits an amat into the desired number of A.XXXX.txt files.
     Generates corresponding dim.XXXX.txt files as well.
     
-    Takes roughly 30 minutes to split a ~800 Gb amat
+    Usage: split_amat("A_comb.txt", "b_comb.txt", 8, 36, 8)
     
-    Usage: split_amat("A_comb.txt", "b_comb.txt", 8, 36)
+    Notes: Line-aligned byte ranges are taken from a line-offset index (see index_lines), 
+           which is reused on restarts, and copied to the A.XXXX.txt files over 
+           nworkers processes. 
+           amat can also be a binary store file or block manifest (see write_store), 
+           in which case the A.XXXX.txt files are exported directly from the store.
+           bvec is no longer read, since the line count comes from the index.
                
     """
 
-    infile = amat
-    lines  = helpers.wc_l(bvec)
     nfiles = nproc*ppn
+    header = read_store_header(amat)
     
+    if header is not None:
+        lines = int(header["rows"])
+        cols  = int(header["cols"])
+    else:
+        index = index_lines(amat, nworkers)
+        lines = int(index["lines"])
+        cols  = 0
+        if lines > 0:
+            cols = len(helpers.head(amat,1)[0].split())
+            
+    print("Counted", cols, "columns")
+
     # Ensure we always generate n <= nfiles new files
     
-    lines_per_file = int(m.ceil(float(lines)/float(nfiles)))
+    lines_per_file = max(1, int(m.ceil(float(lines)/float(nfiles))))
 
     print("Will write", nfiles, "files with", lines_per_file, "lines per file")
-
-    # Read the file line by line, print chunks to new numbered files
-
+    
+    tasks    = []
     file_idx = 0
-    line_idx = 0
-    line_srt = None
-    cols     = 0
-
-    #Aname = "A." + str(file_idx).rjust(len(str(nfiles))+1,'0') + ".txt"
-    Aname = "A." + str(file_idx).rjust(4,'0') + ".txt"
-    Afstream = open(Aname,'w')
-
-    with open(infile) as ifstream:
-
-            for line in ifstream:
-
-                    if line_idx == 0 and file_idx == 0:
-
-                            cols = line
-                            cols = len(cols.split())
-
-                            line_srt  = line_idx
-
-                            print("Counted", cols, "columns")
-
-            
-                    if line_idx > 0 and line_idx % lines_per_file == 0:
-                    
-                        if file_idx >= nfiles:
-                            print("LOGIC ERROR: Building too many files")
-                            exit()
-            
-                        print("Working on a new file no.", file_idx)
-                        
-                        # Close the previous A.*.txt file and write the corresponding dim.*.txt file
-                        
-                        Afstream.close()
-                        
-                        #Dname = "dim." + str(file_idx).rjust(len(str(nfiles))+1,'0') + ".txt"
-                        Dname = "dim." + str(file_idx).rjust(4,'0') + ".txt"
-                        Dfstream = open(Dname,'w')
-                        Dfstream.write(str(cols) + " " + str(line_srt) + " " + str(line_idx-1) + " " + str(lines) + "\n") 
-                        Dfstream.close()              
-            
-                        # Start up the next A.*.txt file
-            
-                        file_idx += 1
-                        line_srt  = line_idx
-
-                        Aname = "A." + str(file_idx).rjust(4,'0') + ".txt"
-                        #Aname = "A." + str(file_idx).rjust(len(str(nfiles))+1,'0') + ".txt"
-                        Afstream = open(Aname,'w')
-            
-            
-                    Afstream.write(line)
-                    line_idx += 1
-            
-    if not Afstream.closed:
-        Afstream.close()
-            
+    
+    for line_srt in range(0, max(lines,1), lines_per_file):
+    
+        if file_idx >= nfiles:
+            print("LOGIC ERROR: Building too many files")
+            exit()
+    
+        line_end = min(line_srt+lines_per_file, lines)
+        
+        Aname = "A."   + str(file_idx).rjust(4,'0') + ".txt"
         Dname = "dim." + str(file_idx).rjust(4,'0') + ".txt"
-        #Dname = "dim." + str(file_idx).rjust(len(str(nfiles))+1,'0') + ".txt"
+        
+        if header is not None:
+            tasks.append([amat, Aname, line_srt, line_end])
+        else:
+            tasks.append([amat, Aname, line_offset(amat, index, line_srt), line_offset(amat, index, line_end)])
+            
         Dfstream = open(Dname,'w')
-        Dfstream.write(str(cols) + " " + str(line_srt) + " " + str(line_idx-1) + " " + str(lines) + "\n") 
+        Dfstream.write(str(cols) + " " + str(line_srt) + " " + str(line_end-1) + " " + str(lines) + "\n") 
         Dfstream.close()
         
-    return file_idx+1
+        file_idx += 1
+        
+    print("Writing", file_idx, "files over", nworkers, "processes")
+    
+    worker = export_range if header is not None else copy_range
+    
+    if nworkers > 1:
+        pool = multiprocessing.Pool(nworkers)
+        pool.map(worker, tasks, 1)
+        pool.close()
+        pool.join()
+    else:
+        for task in tasks:
+            worker(task)
+        
+    return file_idx
     
+WEIGHT_NPARAMS = {"A": 1, "B": 2, "C": 3, "D": 4, "E": 1, "F": 4} # Number of parameters taken by each weighting method
+
 def gen_weights_one(w_method, this_ALC, b_labeled_i, natoms_i):
 
     """ 
@@ -196,76 +1277,53 @@ def gen_weights_one(w_method, this_ALC, b_labeled_i, natoms_i):
     
     Example wXX value: ["C",[a0,a1,a2]]
     
+    Notes: b_labeled_i and natoms_i may be numpy arrays, in which case an array of 
+           weights is returned.
                
     """
     
-    weight = 0.0
+    import numpy as np
     
+    if w_method[0] not in WEIGHT_NPARAMS:
+        print("ERROR: Unknown weight method!")
+        exit()
+
+    if len(w_method[1]) != WEIGHT_NPARAMS[w_method[0]]:
+        print("ERROR: Found weight request with wrong number of parameters:")
+        print(w_method)
+        exit()
+        
+    a = [float(i) for i in w_method[1]]
+    X = np.asarray(b_labeled_i, dtype=np.float64)
+    N = np.asarray(natoms_i,    dtype=np.float64)
 
     if w_method[0] == "A":
     
-        if len(w_method[1]) != 1:
-            print("ERROR: Found weight request with wrong number of parameters:")
-            print(w_method)
-            exit()
-    
-        weight =  float(w_method[1][0])
+        weight = np.full(X.shape, a[0])
         
     elif w_method[0] == "B":
     
-        if len(w_method[1]) != 2:
-            print("ERROR: Found weight request with wrong number of parameters:")
-            print(w_method)
-            exit()
-    
         eff_ALC = this_ALC
         if eff_ALC == 0:
             eff_ALC = 1
-            
         
-        weight =  float(w_method[1][0]) * float(eff_ALC) ** float(w_method[1][1])
+        weight = np.full(X.shape, a[0] * float(eff_ALC) ** a[1])
         
     elif w_method[0] == "C":
     
-        if len(w_method[1]) != 3:
-            print("ERROR: Found weight request with wrong number of parameters:")
-            print(w_method)
-            exit()
-    
-        weight =  float(w_method[1][0]) * m.exp( float(w_method[1][1]) * abs(float(b_labeled_i)) / float(w_method[1][2]) )        
-         
+        weight = a[0] * np.exp( a[1] * np.abs(X) / a[2] )
         
     elif w_method[0] == "D":
     
-        if len(w_method[1]) != 4:
-            print("ERROR: Found weight request with wrong number of parameters:")
-            print(w_method)
-            exit()
-    
-        weight =  float(w_method[1][0]) * m.exp( float(w_method[1][1]) * (float(b_labeled_i)-float(w_method[1][2])) / float(w_method[1][3]) )        
-        
-    
+        weight = a[0] * np.exp( a[1] * (X-a[2]) / a[3] )
+
     elif w_method[0] == "E":
-    
-        if len(w_method[1]) != 1:
-            print("ERROR: Found weight request with wrong number of parameters:")
-            print(w_method)
-            exit()
 
-        weight =  float(natoms_i)**float(w_method[1][0])
+        weight = N ** a[0]
 	
     elif w_method[0] == "F":
     
-        if len(w_method[1]) != 4:
-            print("ERROR: Found weight request with wrong number of parameters:")
-            print(w_method)
-            exit()
-    
-        weight =  float(w_method[1][0]) * m.exp( float(w_method[1][1]) * (float(b_labeled_i)/float(natoms_i)-float(w_method[1][2])) / float(w_method[1][3]) )        
-
-    else:
-        print("ERROR: Unknown weight method!")
-        exit()
+        weight = a[0] * np.exp( a[1] * (X/N-a[2]) / a[3] )
         
     return weight
         
@@ -295,6 +1353,7 @@ def gen_weights(w_method, this_ALC, b_labeled_i, natoms_i):
     
     Example wXX value: [ ["A","B","C"] , [[a0],[a0,a1],[a0,a1,a2]] ]
     
+    Notes: b_labeled_i and natoms_i may be numpy arrays (see gen_weights_one).
                
     """
 
@@ -316,6 +1375,198 @@ def gen_weights(w_method, this_ALC, b_labeled_i, natoms_i):
         weight *= gen_weights_one( [methods[i], wparams[i]], this_ALC, b_labeled_i, natoms_i)
         
     return weight
+    
+def read_b_labeled(b_labeled):
+
+    """ 
+    
+    Reads a b-labeled.txt file, returning numpy arrays of its labels and values.
+    
+    Usage: tags, vals = read_b_labeled("b-labeled.txt")
+    
+    """
+    
+    import numpy as np
+    
+    with open(b_labeled,'r') as ifstream:
+        contents = ifstream.read()
+        
+    tokens = contents.split()
+    
+    if len(tokens) != 2*contents.count('\n'): # Not strictly "<label> <value>" lines
+        tokens = [i for line in contents.splitlines() for i in line.split()[:2]]
+        
+    return np.array(tokens[0::2]), np.array(tokens[1::2], dtype=np.float64)
+    
+WEIGHT_KEYS = ["weights_energy_gas", "weights_energy", "weights_stress", "weights_force_gas", "weights_force"]
+
+def classify_b_labeled(tags):
+
+    """ 
+    
+    Classifies b-labeled.txt rows by the weights_* set that applies to them.
+    
+    Usage: for key, mask in classify_b_labeled(tags): ...
+    
+    Notes: Rows are energies (label contains "+1"), stresses ("s_"), or forces, and 
+           gas phase ("G_") or not. Returns a [key, mask] pair for each of WEIGHT_KEYS.
+    
+    """
+    
+    import numpy as np
+    
+    is_ener  = np.char.find(tags, "+1") >= 0
+    is_gas   = np.char.find(tags, "G_") >= 0
+    is_stres = (~is_ener) & (np.char.find(tags, "s_") >= 0)
+    is_force = (~is_ener) & (~is_stres)
+    
+    return [["weights_energy_gas", is_ener  &   is_gas ],
+            ["weights_energy",     is_ener  & (~is_gas)],
+            ["weights_stress",     is_stres            ],
+            ["weights_force_gas",  is_force &   is_gas ],
+            ["weights_force",      is_force & (~is_gas)]]
+    
+def write_weights(weightfile, b_labeled, natoms, this_ALC, **kwargs):
+
+    """ 
+    
+    Generates weights for every entry of b-labeled.txt and writes them to weightfile.
+    
+    Usage: write_weights("weights.dat", "b-labeled.txt", "natoms.txt", 1, weights_force = ..., <etc>)
+    
+    Notes: Each class of rows (see classify_b_labeled) is weighted with the 
+           corresponding weights_* set (see gen_weights). 
+           Required keys: WEIGHT_KEYS.
+    
+    """
+    
+    import numpy as np
+    
+    tags, vals = read_b_labeled(b_labeled)
+    
+    natoms_i = np.loadtxt(natoms, dtype=np.float64, ndmin=1)
+    
+    if len(natoms_i) != len(vals):
+        print("ERROR: Inconsistent numbers of entries in:",b_labeled,natoms)
+        exit()
+    
+    weights = np.zeros(len(vals))
+    
+    for key, mask in classify_b_labeled(tags):
+        if mask.any():
+            weights[mask] = gen_weights(kwargs[key], this_ALC, vals[mask], natoms_i[mask])
+    
+    with open(weightfile,'w') as ofstream:
+        if len(weights) > 0:
+            ofstream.write('\n'.join(map(str, weights.tolist())) + '\n')
+            
+    return weights
+    
+def weights_meta(this_ALC, user_specified, **kwargs):
+
+    """ 
+    
+    Returns the store header entries recording how a block's weights were generated.
+    
+    Usage: write_store("weights.bin", "weights.dat", meta=weights_meta(1, False, **args))
+    
+    """
+    
+    meta = {}
+    meta["weights_ALC"]  = str(this_ALC)
+    meta["weights_user"] = str(user_specified)
+    
+    for key in WEIGHT_KEYS:
+        meta[key] = repr(kwargs[key]).replace(" ","")
+        
+    return meta
+    
+def update_weights(weightfile, b_labeled, natoms, newfile, **kwargs):
+
+    """ 
+    
+    Brings a (previous ALC's) weights store up to date with the current weights_* 
+    settings, returning weightfile if nothing changed, or newfile, which holds the
+    updated weights.
+    
+    Usage: update_weights("../../ALC-0/GEN_FF/weights.bin", "../../ALC-0/GEN_FF/b-labeled.txt", 
+                          "../../ALC-0/GEN_FF/natoms.bin", "weights.ALC-0.bin", weights_force = ..., <etc>)
+    
+    Notes: Each block's weights are generated with that block's own ALC number, and the 
+           settings used are recorded in its header (see weights_meta). Only classes whose
+           settings have changed are updated: if only the parameters of row-independent 
+           methods (A, and the ALC-dependent B) changed, old weights are rescaled in closed
+           form; otherwise they are regenerated from b-labeled.txt and natoms.
+           User-specified weights, and stores without recorded settings, are kept as-is.
+    
+    """
+    
+    import numpy as np
+    import ast
+    
+    header = read_store_header(weightfile)
+    
+    if ("weights_ALC" not in header) or (header["weights_user"] == "True"):
+        return weightfile
+        
+    this_ALC = int(header["weights_ALC"])
+    meta     = weights_meta(this_ALC, False, **kwargs)
+    changed  = [key for key in WEIGHT_KEYS if header[key] != meta[key]]
+    
+    if len(changed) == 0:
+        return weightfile
+        
+    print("Updating", weightfile, "for changed settings:", ' '.join(changed))
+        
+    tags, vals = read_b_labeled(b_labeled)
+    weights    = np.array(read_store(weightfile)[0][:,0], dtype=np.float64)
+    natoms_i   = read_store(natoms)[0][:,0]
+    
+    for key, mask in classify_b_labeled(tags):
+    
+        if (key not in changed) or (not mask.any()):
+            continue
+            
+        old = ast.literal_eval(header[key])
+        new = kwargs[key]
+        
+        # Rescale in closed form if the methods are unchanged, and all changed parameters 
+        # belong to methods whose factors don't depend on the row
+        
+        rescale    = (list(old[0]) == list(new[0]))
+        old_factor = 1.0
+        new_factor = 1.0
+        
+        for i in range(len(new[0])):
+        
+            if not rescale:
+                break
+            
+            if new[0][i] in ["A", "B"]:
+                old_factor *= gen_weights_one([old[0][i], old[1][i]], this_ALC, 0.0, 1.0)
+                new_factor *= gen_weights_one([new[0][i], new[1][i]], this_ALC, 0.0, 1.0)
+            elif list(old[1][i]) != list(new[1][i]):
+                rescale = False
+        
+        if rescale and (old_factor != 0.0):
+            weights[mask] *= new_factor / old_factor
+        else:
+            weights[mask] = gen_weights(new, this_ALC, vals[mask], natoms_i[mask])
+    
+    header = dict(header)
+    header.update(meta)
+    header["source"] = os.path.abspath(weightfile)
+    
+    store = open_store(newfile + ".tmp", header)
+    
+    if len(weights) > 0:
+        store[:,0] = weights
+        store.flush()
+    del store
+    
+    os.rename(newfile + ".tmp", newfile)
+    
+    return newfile
 
 
 def solve_amat_started(n_hyper_sets=1):
@@ -420,6 +1671,10 @@ def restart_solve_amat(my_ALC, **kwargs):
     ################################
     
     os.chdir("GEN_FF")    
+    
+    # Use the resources planned by solve_amat, if any (see planner.plan)
+    
+    args["job_nodes"], args["job_walltime"] = planner.read_plan("plan.txt", args["job_nodes"], args["job_walltime"])
 
     if not "dlasso" in args["regression_alg"]:
     
@@ -483,7 +1738,7 @@ def restart_solve_amat(my_ALC, **kwargs):
     
     do_split = False
 
-    if helpers.wc_l("b_comb.txt") >= (int(args["job_nodes"]) * int(args["job_ppn"]) ):
+    if read_shape("b_comb.txt")["rows"] >= (int(args["job_nodes"]) * int(args["job_ppn"]) ):
 
         do_split = True
 
@@ -526,6 +1781,8 @@ def restart_solve_amat(my_ALC, **kwargs):
     
     if ("dlasso" in args["regression_alg"]) and do_split:
         job_task += " --A A.txt "
+    elif os.path.isfile("column_map.txt"):
+        job_task += " --A A_prune.txt "
     else:
         job_task += " --A A_comb.txt "
         
@@ -565,12 +1822,59 @@ def restart_solve_amat(my_ALC, **kwargs):
     
     return run_py_jobid.split()[0]
     
+def parse_hyper_set(task):
+
+    """
+    
+    Generates GEN_FF-<i>/x.txt, Ax.txt, force.txt and params.txt for one hyper set. 
+    
+    Usage: parse_hyper_set([i, x_i, job_executable])
+    
+    Notes: Worker for parse_hyper_params; x_i is hyper set i's slice of GEN_FF/x.txt.
+           Reads GEN_FF-<i>/A.txt, or the A.bin store if there's no text A-matrix.
+    
+    """
+    
+    import numpy as np
+    
+    i, x, job_executable = task
+    
+    gen_ff_dir = "GEN_FF-" + str(i)
+    amat       = gen_ff_dir + "/A.txt"
+    
+    if (not os.path.isfile(amat)) and os.path.isfile(gen_ff_dir + "/A.bin"):
+        amat = gen_ff_dir + "/A.bin"
+    
+    # Stream A*x to disk
+    
+    write_amat_product(amat, x, [gen_ff_dir + "/force.txt", gen_ff_dir + "/Ax.txt"])
+    
+    np.savetxt(gen_ff_dir + "/x.txt", x)
+    
+    # Convert x.txt to a real params.txt file
+    
+    print("...Generating param.txt file for " + gen_ff_dir)
+    
+    job_task  = "cd " + gen_ff_dir + " ; "
+    job_task += job_executable + "  --algorithm=dlasso --read_output True  " + " > params.txt "
+    exit_code = os.system(job_task)
+    
+    # Check the exit code to see if the command ran successfully
+    
+    if exit_code == 0:
+        print("Command executed successfully")
+    else:
+        print("Command failed with exit code:", exit_code)
+
 def parse_hyper_params(**kwargs):
 
     """
     
     Post-process x.txt file from a fit with multiple unique fm_setup.in files that culminated in an A-matrix that was "pasted" from the A-matrix from each unique fm_setup.in
     Result is a params.txt for each fm_setup.in
+    
+    Notes: Each A-matrix is streamed in row blocks (see write_amat_product), and hyper 
+           sets are processed concurrently over up to nworkers processes.
 
 
     """
@@ -579,13 +1883,14 @@ def parse_hyper_params(**kwargs):
     # 0. Set up an argument parser
     ################################
     
-    default_keys   = [""]*2
-    default_values = [""]*2
+    default_keys   = [""]*3
+    default_values = [""]*3
     
     # Paths
     
     default_keys[0] = "n_hyper_sets"      ; default_values[0] =     1   # Number of unique fm_setup.in files; allows fitting, e.g., multiple overlapping models to the same data
     default_keys[1] = "job_executable"    ; default_values[1] =     ""  # Full path to executable for ChIMES lsq job
+    default_keys[2] = "nworkers"          ; default_values[2] =     1   # Number of local processes used to evaluate the hyper sets
 
     args = dict(list(zip(default_keys, default_values)))
     args.update(kwargs)    
@@ -594,49 +1899,36 @@ def parse_hyper_params(**kwargs):
     
     # Read in all the raw parameters
     
-    x = helpers.cat_to_var("GEN_FF/x.txt")
+    x = np.loadtxt("GEN_FF/x.txt", dtype=np.float64, ndmin=1)
     
-    # Determine how many parameters are associated with each GEN_FF-* folder
+    # Determine which parameters are associated with each GEN_FF-* folder, from the column 
+    # ranges saved by join_amats if available
     
-    dim  = []
-    npar = 0
+    cols  = read_hyper_cols()
+    tasks = []
+    npar  = 0
     
     for i in range(int(args["n_hyper_sets"])):
     
-        dim.append(int(helpers.head("GEN_FF-" + str(i) + "/dim.txt")[0].split()[0]))
-        
-    
-    # Read GEN_FF-(i)/A.txt matrix
-        A = np.loadtxt("GEN_FF-" + str(i) + "/A.txt")
-        A = np.array(A, dtype=float)
-        A = A.astype('float64')
-    
-    # Reshape x to a matrix
-        x_numeric = np.array(x[npar:npar+dim[i]], dtype=float)
-        x_matrix = np.reshape(x[npar:npar+dim[i]], (dim[i], 1))
-        x_matrix = x_matrix.astype('float64')
-    
-    # Perform matrix multiplication
-        result_matrix = np.dot(A, x_matrix)
-    
-    # Save the result_matrix to a file
-        np.savetxt("GEN_FF-" + str(i) + "/force.txt", result_matrix)
-        np.savetxt("GEN_FF-" + str(i) + "/Ax.txt", result_matrix)
-        np.savetxt("GEN_FF-" + str(i) + "/x.txt", x_matrix)
-    
-        npar += dim[i]
-
-    # Convert x.txt to a real params.txt file
-        os.chdir("GEN_FF-" + str(i))
-        print("...Generating param.txt file for GEN_FF-" + str(i))
-        job_task = args["job_executable"] + "  --algorithm=dlasso --read_output True  " + " > params.txt "
-        exit_code = os.system(job_task)
-	# Check the exit code to see if the command ran successfully
-        if exit_code == 0:
-            print("Command executed successfully")
+        if cols is not None:
+            npar, dim = cols[i]
         else:
-            print("Command failed with exit code:", exit_code)
-        os.chdir("..")
+            dim = int(helpers.head("GEN_FF-" + str(i) + "/dim.txt")[0].split()[0])
+        
+        tasks.append([i, x[npar:npar+dim], args["job_executable"]])
+        
+        npar += dim
+        
+    nworkers = min(int(args["nworkers"]), len(tasks))
+        
+    if nworkers > 1:
+        pool = multiprocessing.Pool(nworkers)
+        pool.map(parse_hyper_set, tasks, 1)
+        pool.close()
+        pool.join()
+    else:
+        for task in tasks:
+            parse_hyper_set(task)
 
 
 def build_amat(my_ALC, **kwargs):  
@@ -664,8 +1956,8 @@ def build_amat(my_ALC, **kwargs):
     # 0. Set up an argument parser
     ################################
     
-    default_keys   = [""]*27
-    default_values = [""]*27
+    default_keys   = [""]*30
+    default_values = [""]*30
     
     # Paths
     
@@ -686,6 +1978,9 @@ def build_amat(my_ALC, **kwargs):
     default_keys[14] = "correction_exe"    ; default_values[13] =     None                   # Executable for method being corrected
     default_keys[15] = "correction_temps"  ; default_values[14] =     None                   # How to handle electron temperatures for 1st ALC
     default_keys[16] = "n_hyper_sets"      ; default_values[15] =     1                      # Number of unique fm_setup.in files; allows fitting, e.g., multiple overlapping models to the same data
+    default_keys[27] = "subtract_batch"    ; default_values[27] =     False                  # Evaluate all frames of a trajectory file with one MD code call when subtracting contributions?
+    default_keys[28] = "subtract_nproc"    ; default_values[28] =     1                      # Number of local processes to use when subtracting contributions
+    default_keys[29] = "subtract_cache"    ; default_values[29] =     None                   # Directory for the persistent contribution cache
     
     
         
@@ -928,7 +2223,10 @@ def build_amat(my_ALC, **kwargs):
                 method       = args["hierarch_method"],
                 trajectories = traj_files,
                 temperatures = temper_file,
-                parameters   = args["hierarch_files"])
+                parameters   = args["hierarch_files"],
+                batch        = args["subtract_batch"],
+                nproc        = args["subtract_nproc"],
+                cache        = args["subtract_cache"])
     
         ################################
         # Correction
@@ -941,7 +2239,10 @@ def build_amat(my_ALC, **kwargs):
                 method       = args["correction_method"],
                 trajectories = traj_files,
                 temperatures = temper_file,
-                parameters   = args["correction_files"])
+                parameters   = args["correction_files"],
+                batch        = args["subtract_batch"],
+                nproc        = args["subtract_nproc"],
+                cache        = args["subtract_cache"])
             
         ################################
         # 3. Set up and submit the .cmd file for the job
@@ -1017,8 +2318,8 @@ def solve_amat(my_ALC, **kwargs):
     # 0. Set up an argument parser
     ################################
     
-    default_keys   = [""]*24
-    default_values = [""]*24
+    default_keys   = [""]*36
+    default_values = [""]*36
     
     # Weights
     
@@ -1039,6 +2340,18 @@ def solve_amat(my_ALC, **kwargs):
     default_keys[8 ] = "regression_nrm"    ; default_values[8 ] =     "True"      # Normalizes the a-mat by default ... may not give best result
     default_keys[9 ] = "split_files"       ; default_values[9 ] =     False       # !!! UNUSED
     default_keys[23] = "n_hyper_sets"      ; default_values[23] =     1                      # Number of unique fm_setup.in files; allows fitting, e.g., multiple overlapping models to the same data
+    default_keys[24] = "amat_store"        ; default_values[24] =     None        # None: keep A/b/weights/natoms as text. "float64" or "float32": keep them as binary stores, exporting text only for the solver
+    default_keys[25] = "split_nproc"       ; default_values[25] =     1           # Number of local processes used to index/split/read the A-matrix
+    default_keys[26] = "solve_local"       ; default_values[26] =     False       # Solve in-process (see solve_amat_local) rather than submitting a job? True, False, or "auto" (decide by size)
+    default_keys[27] = "solve_local_max"   ; default_values[27] =     1.0E8       # Largest A-matrix (rows*cols) solved in-process when solve_local is "auto"
+    default_keys[28] = "regression_sweep"  ; default_values[28] =     None        # List of regression_var values to evaluate in one pass during in-process solves (see sweep_regress_var)
+    default_keys[29] = "regression_holdout"; default_values[29] =     0.1         # Fraction of rows held out when evaluating regression_sweep
+    default_keys[30] = "regression_warm"   ; default_values[30] =     False       # Warm-start in-process lasso solves from the previous ALC's x.txt?
+    default_keys[31] = "prune_columns"     ; default_values[31] =     False       # Remove all-zero and duplicate A-matrix columns before solving (see prune_amat)?
+    default_keys[32] = "plan_history"      ; default_values[32] =     None        # Run history file; if set, job_nodes and job_walltime are planned from it (see planner.plan)
+    default_keys[33] = "plan_max_nodes"    ; default_values[33] =     None        # Most nodes the planner may request (default: job_nodes)
+    default_keys[34] = "plan_max_time"     ; default_values[34] =     None        # Longest walltime the planner may request (default: job_walltime)
+    default_keys[35] = "plan_node_mem"     ; default_values[35] =     None        # Memory per node (GB) available to the planner
     
     
     # Overall job controls
@@ -1069,7 +2382,6 @@ def solve_amat(my_ALC, **kwargs):
         os.mkdir("GEN_FF")  # Create the GEN_FF directory
 
     # Copy common files from GEN_FF-0 and GEN_FF-1 to GEN_FF
-        helpers.run_bash_cmnd("cp " + " GEN_FF-0/A.txt" + " GEN_FF")
         helpers.run_bash_cmnd("cp " + " GEN_FF-0/b.txt" + " GEN_FF")
         helpers.run_bash_cmnd("cp " + " GEN_FF-0/b-labeled.txt" + " GEN_FF")
         helpers.run_bash_cmnd("cp " + " GEN_FF-0/natoms.txt" + " GEN_FF")
@@ -1083,10 +2395,10 @@ def solve_amat(my_ALC, **kwargs):
             helpers.run_bash_cmnd("mv " + " GEN_FF/fm_setup.in" + " GEN_FF/0.fm_setup.in")
             helpers.run_bash_cmnd("cp " + f" GEN_FF-{i}/fm_setup.in" + " GEN_FF")
             helpers.run_bash_cmnd("mv " + " GEN_FF/fm_setup.in" + f" GEN_FF/{i}.fm_setup.in")
-            paste_cmd = f"paste GEN_FF/A.txt GEN_FF-{i}/A.txt > tmp"
-            print(paste_cmd)
-            os.system(paste_cmd)
-            os.rename("tmp", "GEN_FF/A.txt")               
+            
+        # Join the A-matrices column-wise in a single pass, saving each set's column range for parse_hyper_params
+            
+        join_amats("GEN_FF/A.txt", ["GEN_FF-" + str(i) + "/A.txt" for i in range(int(args["n_hyper_sets"]))], "GEN_FF/hyper_cols.txt")
 
     os.chdir("GEN_FF")
     helpers.run_bash_cmnd("rm -f weights.dat")
@@ -1102,47 +2414,91 @@ def solve_amat(my_ALC, **kwargs):
         
     if (not user_specified):
     
-        weightfi = open("weights.dat",'w')
+        write_weights("weights.dat", "b-labeled.txt", "natoms.txt", my_ALC, **args)
     
-        ifstream = open("b-labeled.txt",'r')
-        contents = ifstream.readlines()
-        ifstream .close()
+    # If requested, convert this ALC's A-mat, b, natoms, and weights to binary stores (see write_store)
     
-        ifstream = open("natoms.txt",'r')
-        natoms   = ifstream.readlines()
-        ifstream .close()    
+    if args["amat_store"]:
     
-        for i in range(len(contents)):
+        for name, txtfile, dtype in [["A", "A.txt", args["amat_store"]], ["b", "b.txt", "float64"], ["natoms", "natoms.txt", "float64"], ["weights", "weights.dat", "float64"]]:
+            
+            if os.path.isfile(txtfile): # A.txt is removed once converted, in case of restarts 
+                write_store(name + ".bin.tmp", txtfile, dtype, meta=weights_meta(my_ALC, user_specified, **args) if name == "weights" else None)
+                os.rename(name + ".bin.tmp", name + ".bin")
+                
+        helpers.run_bash_cmnd("rm -f A.txt")
+        
+        # Save this block's contribution to the normal equations (see write_gram)
+        
+        write_gram("gram.npz", "A.bin", "b.bin", "weights.bin")
     
-            tag = contents[i].split()[0]
-            val = contents[i].split()[1]
+    os.chdir("..")
+
     
-            if "+1" in tag:
-                if "G_" in tag:
-                    weightfi.write(str(gen_weights(args["weights_energy_gas"], my_ALC, val, natoms[i]))+'\n')
-                else:
-                    weightfi.write(str(gen_weights(args["weights_energy"]    , my_ALC, val, natoms[i]))+'\n')
+    ################################
+    # 2. Combine current weights, A.txt, and b.txt with previous ALC's
+    #    ... Only needed for ALC >= 1
+    ################################
+    
+    
+    if args["amat_store"]:
+    
+        # Each ALC keeps only its own rows; the *_comb.blocks manifests list the 
+        # blocks of all ALCs so far (see write_manifest)
+    
+        os.chdir("GEN_FF")
+        
+        this_gen_ff = "../../ALC-" + repr(my_ALC)   + "/GEN_FF/"
+        prev_gen_ff = "../../ALC-" + repr(my_ALC-1) + "/GEN_FF/"
+        
+        blocks = {}
+        
+        for name, txtfile, block in [["A", "A_comb.txt", "A.bin"], ["b", "b_comb.txt", "b.bin"], ["natoms", "natoms_comb.txt", "natoms.bin"], ["weights", "weights_comb.dat", "weights.bin"], ["b-labeled", None, "b-labeled.txt"], ["gram", None, "gram.npz"]]:
+        
+            if (my_ALC == 0) or ((my_ALC == 1) and (not args["do_cluster"])):
+                blocks[name] = []
+                
+            elif os.path.isfile(prev_gen_ff + name + "_comb.blocks"):
+                blocks[name] = read_manifest(prev_gen_ff + name + "_comb.blocks", resolve=False)
+                
+            elif name == "b-labeled":
+                blocks[name] = [prev_gen_ff + "b-labeled_comb.txt"]
+                
+            elif name == "gram": # The combined stores exist, since gram is handled last
+                write_gram(prev_gen_ff + "gram_comb.npz", prev_gen_ff + "A_comb.bin", prev_gen_ff + "b_comb.bin", prev_gen_ff + "weights_comb.bin")
+                blocks[name] = [prev_gen_ff + "gram_comb.npz"]
+                
+            else: # Previous ALC didn't use manifests; use (or convert, once) its combined file as a single block
+            
+                if not os.path.isfile(prev_gen_ff + name + "_comb.bin"):
+                    write_store(prev_gen_ff + name + "_comb.bin", prev_gen_ff + txtfile, args["amat_store"] if name == "A" else "float64")
                     
-            elif "s_" in tag:
-                weightfi.write(str(gen_weights(args["weights_stress"], my_ALC, val, natoms[i]))+'\n')
-            else:
-                if "G_" in tag:
-                    weightfi.write(str(gen_weights(args["weights_force_gas"], my_ALC, val, natoms[i]))+'\n')
-                else:
-                    weightfi.write(str(gen_weights(args["weights_force"],     my_ALC, val, natoms[i]))+'\n')
+                blocks[name] = [prev_gen_ff + name + "_comb.bin"]
                 
-        weightfi.close()
-    
-    os.chdir("..")
-
-    
-    ################################
-    # 2. Combine current weights, A.txt, and b.txt with previous ALC's
-    #    ... Only needed for ALC >= 1
-    ################################
-    
+            blocks[name].append(this_gen_ff + block)
+            
+        # Previous blocks' weights are reused unless the weights_* settings have changed since
+        # they were generated; then only the affected blocks (and their grams) are updated here
+        
+        for i in range(len(blocks["weights"])-1):
+        
+            weightfile = update_weights(blocks["weights"][i], blocks["b-labeled"][i], blocks["natoms"][i], "weights.block-" + str(i) + ".bin", **args)
+            
+            if weightfile != blocks["weights"][i]:
+                blocks["weights"][i] = this_gen_ff + weightfile
+                blocks["gram"   ][i] = this_gen_ff + "gram.block-" + str(i) + ".npz"
+                write_gram("gram.block-" + str(i) + ".npz", blocks["A"][i], blocks["b"][i], weightfile)
+            
+        for name in blocks:
+            write_manifest(name + "_comb.blocks", blocks[name])
+            
+        # The solver reads text; A_comb.txt is only exported if it won't be split (see section 3)
+            
+        export_store("b_comb.blocks",       "b_comb.txt")
+        export_store("natoms_comb.blocks",  "natoms_comb.txt")
+        export_store("weights_comb.blocks", "weights_comb.dat")
 
-    if (my_ALC == 0) or ((my_ALC == 1) and (not args["do_cluster"])):
+    elif (my_ALC == 0) or ((my_ALC == 1) and (not args["do_cluster"])):
     
         os.chdir("GEN_FF")
         
@@ -1171,15 +2527,34 @@ def solve_amat(my_ALC, **kwargs):
 
         helpers.cat_specific("GEN_FF/weights_comb.dat",  ["../ALC-" + repr(my_ALC-1) + "/GEN_FF/weights_comb.dat",  "GEN_FF/weights.dat"]   )
 
+        # Shape manifests for the combined files reuse those of the previous ALC (see write_shape)
+
+        for comb, this in [["A_comb.txt", "A.txt"], ["b_comb.txt", "b.txt"], ["b-labeled_comb.txt", "b-labeled.txt"], ["natoms_comb.txt", "natoms.txt"], ["weights_comb.dat", "weights.dat"]]:
+            write_shape("GEN_FF/" + comb, ["../ALC-" + repr(my_ALC-1) + "/GEN_FF/" + comb, "GEN_FF/" + this], labeled = (this == "b-labeled.txt"))
+
         os.chdir("GEN_FF")
 
     
+    amat_comb = "A_comb.txt"
+    
+    if args["amat_store"]:
+        amat_comb = "A_comb.blocks"
+        
+    # If requested, remove all-zero and duplicate columns; amat_txt is what the solver reads
+        
+    helpers.run_bash_cmnd("rm -f column_map.txt x_prune.txt")
+        
+    if str(args["prune_columns"]) == "True":
+        amat_comb = prune_amat(amat_comb, split_dups = not (("lasso" in args["regression_alg"]) or ("lars" in args["regression_alg"])))
+        
+    amat_txt = "A_prune.txt" if os.path.isfile("column_map.txt") else "A_comb.txt"
+
     if "dlasso" in args["regression_alg"]:
     
         # If we are using dlars/dlasso, need to create the dim.txt file
-    
-        nvars = len(helpers.head("A_comb.txt",1)[0].split())
-        nline =     helpers.wc_l("b_comb.txt")
+        
+        nvars = read_shape(amat_comb)["cols"]
+        nline = read_shape(amat_comb)["rows"]
     
         ofstream = open("dim.txt",'w')
         ofstream.write(repr(nvars) + " " + repr(nline) + '\n') # no. vars, first line, last line, total possible lines
@@ -1187,10 +2562,18 @@ def solve_amat(my_ALC, **kwargs):
     
     # Sanity checks    ... As written, these only make sense when a single A-mat is being read
     
-    print("A-mat entries:  ",helpers.run_bash_cmnd("wc -l A_comb.txt"      ).split()[0])
-    print("b-mat entries:  ",helpers.run_bash_cmnd("wc -l b_comb.txt"      ).split()[0])
-    print("natoms entries: ",helpers.run_bash_cmnd("wc -l natoms_comb.txt" ).split()[0])
-    print("weight entries: ",helpers.run_bash_cmnd("wc -l weights_comb.dat").split()[0])
+    comb = ["A_comb.txt", "b_comb.txt", "natoms_comb.txt", "weights_comb.dat"]
+    
+    if args["amat_store"]:
+        comb = ["A_comb.blocks", "b_comb.blocks", "natoms_comb.blocks", "weights_comb.blocks"]
+    
+    print("A-mat entries:  ",read_shape(comb[0])["rows"])
+    print("b-mat entries:  ",read_shape(comb[1])["rows"])
+    print("natoms entries: ",read_shape(comb[2])["rows"])
+    print("weight entries: ",read_shape(comb[3])["rows"])
+    
+    if not args["amat_store"]:
+        print("b-labeled classes:", read_shape("b-labeled_comb.txt", labeled=True)["classes"])
     
     if "dlasso" in args["regression_alg"]:
         
@@ -1198,14 +2581,57 @@ def solve_amat(my_ALC, **kwargs):
         
     
     ################################
-    # 3. Decide whether to split the A-mat
+    # 3. For small enough A-matrices, solve in-process rather than submitting a job
+    ################################
+    
+    solve_local = (str(args["solve_local"]) == "True")
+    
+    if str(args["solve_local"]) == "auto":
+    
+        nentries = read_shape(amat_comb)["rows"] * read_shape(amat_comb)["cols"]
+            
+        solve_local = (nentries <= float(args["solve_local_max"]))
+        
+        print("A-matrix has", nentries, "entries; will solve", "locally" if solve_local else "via the queue")
+        
+    if solve_local:
+    
+        prev_x = None
+        
+        if str(args["regression_warm"]) == "True":
+            prev_x = "../../ALC-" + repr(my_ALC-1) + "/GEN_FF/x.txt"
+    
+        solve_amat_local(amat_comb, prev_x, **args)
+        
+        os.chdir("..")
+        
+        return None
+
+    ################################
+    # 4. Decide whether to split the A-mat
     ################################
+    
+    # If requested, size the job from the run history; restart_solve_amat reuses the plan
+    
+    helpers.run_bash_cmnd("rm -f plan.txt")
+    
+    if args["plan_history"] is not None:
+    
+        max_nodes = args["job_nodes"   ] if args["plan_max_nodes"] is None else args["plan_max_nodes"]
+        max_time  = args["job_walltime"] if args["plan_max_time" ] is None else args["plan_max_time" ]
+    
+        args["job_nodes"], args["job_walltime"] = planner.plan(args["plan_history"], "solve", [read_shape(amat_comb)["rows"], read_shape(amat_comb)["cols"]], 
+            args["job_ppn"], args["job_nodes"], max_nodes, args["job_walltime"], max_time, args["plan_node_mem"])
+            
+        ofstream = open("plan.txt",'w')
+        ofstream.write(str(args["job_nodes"]) + " " + args["job_walltime"] + '\n')
+        ofstream.close()
 
     do_split = False
     
     if "dlasso" in args["regression_alg"]:
 
-        if helpers.wc_l("b_comb.txt") >= (int(args["job_nodes"]) * int(args["job_ppn"])):
+        if read_shape(amat_comb)["rows"] >= (int(args["job_nodes"]) * int(args["job_ppn"])):
         
             do_split = True
         
@@ -1213,7 +2639,7 @@ def solve_amat(my_ALC, **kwargs):
         
             helpers.run_bash_cmnd("rm -f A.*.txt dim.*.txt")
 
-            no_files = split_amat("A_comb.txt", "b_comb.txt", int(args["job_nodes"]), int(args["job_ppn"]))
+            no_files = split_amat(amat_comb, "b_comb.txt", int(args["job_nodes"]), int(args["job_ppn"]), int(args["split_nproc"]))
         
             print("    ...split complete")
 
@@ -1221,8 +2647,11 @@ def solve_amat(my_ALC, **kwargs):
             print("ERROR: Number of split files greater than available procs - code implementation error")
             exit()
 
+    if args["amat_store"] and (not do_split):
+        export_store(amat_comb, amat_txt)
+
     ################################
-    # 4. Run the actual fit
+    # 5. Run the actual fit
     ################################
     
     # Create the task string
@@ -1232,7 +2661,7 @@ def solve_amat(my_ALC, **kwargs):
     if ("dlasso" in args["regression_alg"]) and do_split:
         job_task += " --A A.txt "
     else:
-        job_task += " --A A_comb.txt "
+        job_task += " --A " + amat_txt + " "
         
     job_task += " --b b_comb.txt --weights weights_comb.dat --algorithm " + args["regression_alg"]  + " "
     
@@ -1254,7 +2683,7 @@ def solve_amat(my_ALC, **kwargs):
     
     elif "svd" in args["regression_alg"]:
         job_task += " --eps "   + str(args["regression_var"])
-    elif "lasso" in args["regression_alg"]:
+    elif ("lasso" in args["regression_alg"]) or ("ridge" in args["regression_alg"]):
         job_task += " --alpha " + str(args["regression_var"])        
     else:
         print("ERROR: unknown regression algorithm: ", args["regression_alg"])
@@ -1283,6 +2712,466 @@ def solve_amat(my_ALC, **kwargs):
     return run_py_jobid.split()[0]
 
 
+def prune_amat(amat, split_dups=False, mapfile="column_map.txt", block_rows=4096):
+
+    """ 
+    
+    Removes all-zero and exactly duplicated columns from an A-matrix, returning the name 
+    of the reduced A-matrix, or amat if there was nothing to remove. 
+    
+    Usage: amat_comb = prune_amat("A_comb.txt") or prune_amat("A_comb.txt", True)
+    
+    Notes: amat can be a text A-matrix (reduced to A_prune.txt, keeping the original 
+           text of each entry), or a binary store or block manifest (reduced to the 
+           A_prune.bin store). Columns are compared via per-column hashes, streaming 
+           the A-matrix once; the first of a set of duplicates is kept.
+           The kept columns and their duplicates are saved to mapfile (see 
+           read_column_map), which is used to expand solutions back to full length 
+           (see expand_x).
+           Set split_dups for L2-penalized or minimum-norm solves (ridge, svd), which 
+           split a coefficient evenly over duplicates: each kept column is then scaled
+           by sqrt(number of copies), which gives the reduced problem the same singular
+           values and ridge penalty as the full one. Otherwise (lasso/lars), the kept 
+           column is unscaled, and carries the combined coefficient of its copies. 
+    
+    """
+    
+    import numpy as np
+    import hashlib
+    import operator
+    
+    helpers.run_bash_cmnd("rm -f " + mapfile + " A_prune.txt A_prune.bin")
+    
+    # Detect all-zero and duplicate columns
+    
+    nonzero = None
+    hashes  = None
+    
+    for A in iter_rows(amat, block_rows):
+    
+        if nonzero is None:
+            nonzero = np.zeros(A.shape[1], dtype=bool)
+            hashes  = [hashlib.sha1() for j in range(A.shape[1])]
+            
+        nonzero |= (A != 0.0).any(axis=0)
+        
+        A = np.ascontiguousarray(A.T)
+        
+        for j in range(len(A)):
+            hashes[j].update(A[j].tobytes())
+            
+    if nonzero is None:
+        return amat
+            
+    kept   = []
+    groups = {} # kept column: all of its copies
+    seen   = {}
+    
+    for j in range(len(hashes)):
+    
+        if not nonzero[j]:
+            continue
+            
+        digest = hashes[j].digest()
+        
+        if digest not in seen:
+            seen[digest] = j
+            kept.append(j)
+            groups[j] = []
+            
+        groups[seen[digest]].append(j)
+        
+    scale = np.ones(len(kept))
+    
+    if split_dups:
+        scale = np.sqrt([float(len(groups[j])) for j in kept])
+            
+    nzero = len(hashes) - np.count_nonzero(nonzero)
+    ndups = np.count_nonzero(nonzero) - len(kept)
+    
+    print("Pruning A-matrix columns:", nzero, "all-zero and", ndups, "duplicate columns of", len(hashes), "- keeping", len(kept))
+    
+    if len(kept) == 0:
+        print("ERROR: All columns of A-matrix", amat, "are zero; nothing to fit")
+        exit()
+        
+    if len(kept) == len(hashes):
+        return amat
+        
+    # Write the reduced A-matrix
+        
+    if read_store_header(amat) is not None:
+    
+        header = dict(read_store_header(amat))
+        header["format"] = "chimes_store-1"
+        header["cols"]   = str(len(kept))
+        header["source"] = os.path.abspath(amat)
+        
+        store = open_store("A_prune.bin", header)
+        row   = 0
+        
+        for A in iter_rows(amat, block_rows):
+            store[row:row+len(A)] = A[:,kept] * scale
+            row += len(A)
+            
+        if row > 0:
+            store.flush()
+        del store
+        
+        pruned = "A_prune.bin"
+        
+    else:
+    
+        getter = operator.itemgetter(*kept)
+        
+        if len(kept) == 1:
+            getter = lambda fields: [fields[kept[0]]]
+            
+        scaled = [i for i in range(len(kept)) if scale[i] != 1.0] # Only these entries are reformatted
+    
+        with open(amat,'r') as ifstream, open("A_prune.txt",'w') as ofstream:
+            for line in ifstream:
+                if line.strip():
+                
+                    fields = list(getter(line.split()))
+                    
+                    for i in scaled:
+                        fields[i] = repr(float(fields[i])*float(scale[i]))
+                        
+                    ofstream.write(' '.join(fields) + '\n')
+                    
+        pruned = "A_prune.txt"
+        
+    ofstream = open(mapfile,'w')
+    ofstream.write("# full_columns " + str(len(hashes)) + " split_dups " + str(bool(split_dups)) + '\n')
+    ofstream.write(''.join([' '.join([str(k) for k in groups[j]]) + '\n' for j in kept]))
+    ofstream.close()
+    
+    return pruned
+    
+def read_column_map(mapfile="column_map.txt"):
+
+    """ 
+    
+    Returns the kept column indices, full number of columns, the copies of each kept 
+    column (including itself), and the kept columns' scaling factors, as saved by 
+    prune_amat, or None if there's no column map.
+    
+    Usage: kept, ncols, groups, scale = read_column_map()
+    
+    Notes: Each line of mapfile lists a kept column, followed by its duplicates.
+    
+    """
+    
+    import numpy as np
+    
+    if not os.path.isfile(mapfile):
+        return None
+        
+    header = helpers.head(mapfile,1)[0].split()
+    ncols  = int(header[2])
+    groups = [[int(j) for j in line.split()] for line in helpers.readlines(mapfile)[1:] if line.strip()]
+    scale  = np.ones(len(groups))
+    
+    if (len(header) > 4) and (header[4] == "True"):
+        scale = np.sqrt([float(len(group)) for group in groups])
+    
+    return np.array([group[0] for group in groups], dtype=int), ncols, groups, scale
+    
+def expand_x(x, column_map):
+
+    """ 
+    
+    Expands a solution for a pruned A-matrix (see prune_amat) back to full length. 
+    All-zero columns get zero coefficients.
+    
+    Usage: x = expand_x(x, read_column_map())
+    
+    Notes: For scaled (split_dups) columns, the coefficient is split evenly over the 
+           copies; otherwise the first copy carries it, and the others get zero. 
+           Either way, Ax is unchanged.
+    
+    """
+    
+    import numpy as np
+    
+    if column_map is None:
+        return x
+    
+    kept, ncols, groups, scale = column_map
+    
+    full = np.zeros(ncols)
+    
+    for i in range(len(groups)):
+        if scale[i] == 1.0:
+            full[groups[i][0]] = x[i]
+        else:
+            full[groups[i]]    = x[i]/scale[i]
+    
+    return full
+    
+def prune_x(x, column_map):
+
+    """ 
+    
+    Returns the solution for a pruned A-matrix (see prune_amat) equivalent to a full 
+    length solution, i.e. the inverse of expand_x.
+    
+    Usage: x0 = prune_x(x0, read_column_map())
+    
+    """
+    
+    import numpy as np
+    
+    if column_map is None:
+        return x
+        
+    kept, ncols, groups, scale = column_map
+    
+    return np.array([x[group].sum() for group in groups]) / scale
+    
+def expand_pruned_solution(**kwargs):
+
+    """ 
+    
+    If the last solve was for a pruned A-matrix (see prune_amat), expands GEN_FF/x.txt 
+    back to full length, and regenerates GEN_FF/params.txt from it.
+    
+    Usage: expand_pruned_solution(job_executable = config.CHIMES_SOLVER)
+    
+    Notes: Runs from the ALC folder, once the solve has completed and before 
+           post-processing. The reduced solution is kept as x_prune.txt. 
+           Ax.txt is unchanged by pruning. Does nothing if x.txt is already full length.
+    
+    """
+    
+    import numpy as np
+    
+    os.chdir("GEN_FF")
+    
+    column_map = read_column_map()
+    
+    if column_map is not None:
+    
+        x = np.loadtxt("x.txt", dtype=np.float64, ndmin=1)
+        
+        if len(x) == len(column_map[0]):
+        
+            print("Expanding pruned solution from", len(x), "to", column_map[1], "coefficients")
+        
+            os.rename("x.txt", "x_prune.txt")
+            np.savetxt("x.txt", expand_x(x, column_map))
+            
+            if (not os.path.isfile("A_comb.txt")) and os.path.isfile("A_comb.blocks"):
+                export_store("A_comb.blocks", "A_comb.txt")
+            
+            helpers.run_bash_cmnd_to_file("params.txt", kwargs["job_executable"] + " --A A_comb.txt --b b_comb.txt --algorithm dlasso --read_output True")
+            
+    os.chdir("..")
+    
+def solve_amat_local(amat_comb, prev_x=None, **kwargs):
+
+    """ 
+    
+    Solves the combined A-matrix in-process (see local_lsq.py), writing the same x.txt, 
+    Ax.txt, and params.txt files as a solve_amat job would.
+    
+    Usage: solve_amat_local("A_comb.txt", "../../ALC-0/GEN_FF/x.txt", <arguments>)
+    
+    Notes: Runs from the GEN_FF folder, after solve_amat has set up the *_comb files. 
+           Works from the weighted normal equations, which are read from the per-ALC 
+           gram files for binary stores, or computed from the text files (over 
+           split_nproc processes). params.txt is generated from x.txt by the ChIMES 
+           solver in --read_output mode, as for hyperparameter sets. 
+           For pruned A-matrices (see prune_amat), x.txt is expanded to full length.
+           Lasso solves are warm-started from prev_x (e.g. the previous ALC's x.txt),
+           if given and compatible; the A-matrix only gained rows since then.
+           If regression_sweep is set, also runs sweep_regress_var.
+           Recognized arguments: regression_alg, regression_var, regression_nrm, 
+           amat_store, split_nproc, job_executable, and those of sweep_regress_var.
+    
+    """
+    
+    import numpy as np
+    
+    print("Solving A-matrix locally with", kwargs["regression_alg"])
+    
+    column_map = read_column_map()
+    
+    if kwargs["amat_store"]:
+    
+        gram = read_gram("gram_comb.blocks")
+        
+        if column_map is not None: # The normal equations of the kept (and scaled) columns are a submatrix
+            gram["AtWA"] = gram["AtWA"][np.ix_(column_map[0],column_map[0])] * np.outer(column_map[3], column_map[3])
+            gram["AtWb"] = gram["AtWb"][column_map[0]] * column_map[3]
+    else:
+        gram = text_gram(amat_comb, "b_comb.txt", "weights_comb.dat", int(kwargs["split_nproc"]))
+        
+    x0 = None
+    
+    if (prev_x is not None) and os.path.isfile(prev_x):
+    
+        x0 = np.loadtxt(prev_x, dtype=np.float64, ndmin=1)
+        
+        if (column_map is not None) and (len(x0) == column_map[1]):
+            x0 = prune_x(x0, column_map)
+        
+        if len(x0) == len(gram["AtWb"]):
+            print("Warm-starting from", prev_x, "with", np.count_nonzero(x0), "active coefficients")
+        else:
+            print("Can't warm-start from", prev_x, "- expected", len(gram["AtWb"]), "coefficients, found", len(x0))
+            x0 = None
+        
+    x = local_lsq.solve(gram, kwargs["regression_alg"], kwargs["regression_var"], kwargs["regression_nrm"], x0)
+    
+    np.savetxt("x.txt",  expand_x(x, column_map))
+    np.savetxt("Ax.txt", amat_product(amat_comb, x))
+    
+    if kwargs["amat_store"]:
+        export_store("A_comb.blocks", "A_comb.txt")
+    
+    helpers.run_bash_cmnd_to_file("params.txt", kwargs["job_executable"] + " --A A_comb.txt --b b_comb.txt --algorithm dlasso --read_output True")
+    
+    if kwargs["regression_sweep"]:
+        sweep_regress_var(amat_comb, **kwargs)
+    
+
+SWEEP_CLASSES = {"weights_force": "force", "weights_energy": "energy", "weights_stress": "stress", "weights_force_gas": "gas_force", "weights_energy_gas": "gas_energy"}
+
+def read_b_labeled_comb():
+
+    """ 
+    
+    Returns the labels and values of the combined b-labeled data (see read_b_labeled), 
+    from b-labeled_comb.blocks if present, or b-labeled_comb.txt.
+    
+    Usage: tags, vals = read_b_labeled_comb()
+    
+    """
+    
+    import numpy as np
+    
+    if os.path.isfile("b-labeled_comb.blocks"):
+        blocks = [read_b_labeled(f) for f in read_manifest("b-labeled_comb.blocks")]
+        return np.concatenate([b[0] for b in blocks]), np.concatenate([b[1] for b in blocks])
+    
+    return read_b_labeled("b-labeled_comb.txt")
+    
+def sweep_regress_var(amat_comb, **kwargs):
+
+    """ 
+    
+    Evaluates a list of regularization values (lasso alpha, ridge penalty, or svd eps)
+    in a single pass over the A-matrix, reporting train and hold-out RMS errors by 
+    label class.
+    
+    Usage: sweep_regress_var("A_comb.txt", <arguments>)
+    
+    Notes: Runs from the GEN_FF folder, after solve_amat_local. Every n-th group of 
+           64 consecutive rows (n = 1/regression_holdout) is held out, so rows from 
+           the same frame tend to stay together. The weighted training normal equations 
+           and the unweighted per class/set terms needed for RMS errors are accumulated 
+           in one pass, and all values are solved from one shared factorization (see 
+           local_lsq.solve_path). 
+           Writes sweep/var-<value>/{x.txt,Ax.txt,params.txt} for each value, and a 
+           summary table, sweep/sweep.dat. RMS errors are in the units of b.
+           Recognized arguments: regression_sweep, regression_holdout, regression_alg,
+           regression_nrm, job_executable.
+    
+    """
+    
+    import numpy as np
+    
+    values  = [float(v) for v in kwargs["regression_sweep"]]
+    stride  = max(2, int(round(1.0/float(kwargs["regression_holdout"]))))
+    
+    print("Sweeping", kwargs["regression_alg"], "regularization over", values, "holding out 1 of every", stride, "row groups")
+    
+    tags, vals = read_b_labeled_comb()
+    b          = np.loadtxt("b_comb.txt",       dtype=np.float64, ndmin=1)
+    w          = np.loadtxt("weights_comb.dat", dtype=np.float64, ndmin=1)
+    classes    = classify_b_labeled(tags)
+    holdout    = (np.arange(len(b)) // 64) % stride == stride-1
+    
+    # Accumulate everything in one pass over A
+    
+    train = None
+    stats = {}
+    row   = 0
+    
+    for A in iter_rows(amat_comb):
+    
+        end = row + len(A)
+        
+        if train is None:
+            train = new_gram(A.shape[1])
+        
+        mask = ~holdout[row:end]
+        add_gram(train, A[mask], b[row:end][mask], w[row:end][mask])
+        
+        for key, cmask in classes:
+            for dataset, smask in [["train", ~holdout[row:end]], ["holdout", holdout[row:end]]]:
+            
+                m_i = cmask[row:end] & smask
+                
+                if not m_i.any():
+                    continue
+                
+                if (key, dataset) not in stats:
+                    stats[(key, dataset)] = {"AtA": np.zeros((A.shape[1],A.shape[1])), "Atb": np.zeros(A.shape[1]), "btb": 0.0, "n": 0}
+                    
+                stat = stats[(key, dataset)]
+                stat["AtA"] += A[m_i].T @ A[m_i]
+                stat["Atb"] += A[m_i].T @ b[row:end][m_i]
+                stat["btb"] += b[row:end][m_i] @ b[row:end][m_i]
+                stat["n"  ] += np.count_nonzero(m_i)
+                
+        row = end
+        
+    xs = local_lsq.solve_path(train, kwargs["regression_alg"], values, kwargs["regression_nrm"])
+    
+    # Report RMS errors, from ||Ax-b||^2 = xAtAx - 2xAtb + btb
+    
+    helpers.run_bash_cmnd("rm -rf sweep")
+    os.mkdir("sweep")
+    
+    columns = [(key, dataset) for key, cmask in classes for dataset in ["train", "holdout"] if (key, dataset) in stats]
+    
+    ofstream = open("sweep/sweep.dat",'w')
+    ofstream.write("# " + kwargs["regression_alg"] + " value nonzero " + ' '.join([SWEEP_CLASSES[key] + "_" + dataset for key, dataset in columns]) + '\n')
+    
+    for i in range(len(values)):
+    
+        rms = []
+        
+        for key, dataset in columns:
+            stat = stats[(key, dataset)]
+            rms.append(m.sqrt(max(xs[i] @ stat["AtA"] @ xs[i] - 2.0 * xs[i] @ stat["Atb"] + stat["btb"], 0.0) / stat["n"]))
+            
+        ofstream.write(str(values[i]) + " " + str(np.count_nonzero(xs[i])) + " " + ' '.join(["%.6e" % r for r in rms]) + '\n')
+        
+    ofstream.close()
+    
+    print(''.join(helpers.cat_to_var("sweep/sweep.dat")))
+    
+    # Write the solver outputs for each value
+    
+    Ax = amat_product(amat_comb, np.array(xs).T)
+    
+    for i in range(len(values)):
+    
+        vardir = "sweep/var-" + str(values[i])
+        
+        os.mkdir(vardir)
+        np.savetxt(vardir + "/x.txt",  expand_x(xs[i], read_column_map()))
+        np.savetxt(vardir + "/Ax.txt", Ax[:,i])
+        
+        os.chdir(vardir)
+        helpers.run_bash_cmnd_to_file("params.txt", kwargs["job_executable"] + " --A ../../A_comb.txt --b ../../b_comb.txt --algorithm dlasso --read_output True")
+        os.chdir("../..")
+        
+
 def split_weights():
 
     """ 
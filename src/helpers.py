@@ -9,6 +9,10 @@ import math
 import sys
 import os
 
+# Local modules
+
+import local_sched
+
 """ Small helper functions and utilities general to the ALC process. """
 
 def findinfile(search_str,search_file):
@@ -301,27 +305,30 @@ def head(*argv):
     """    
     
     nlines = 10
-    
+
     if len(argv) == 2:
         nlines = int(argv[1])
     elif len(argv) > 2:
         print("ERROR: Unrecognized head command: ", argv)
         exit()
-        
-    possible = wc_l(argv[0])
-    
-    if possible < nlines:
-        nlines = possible
-        
+
+    # Stop at EOF rather than counting the file's lines first
+
     ifstream = open(argv[0],'r')
-    
+
     contents = []
-    
+
     for i in range(nlines):
-            contents.append(ifstream.readline())
-    
+
+            line = ifstream.readline()
+
+            if not line:
+                break
+
+            contents.append(line)
+
     ifstream.close()
-    
+
     return contents
     
 def tail(*argv):
@@ -371,15 +378,25 @@ def wc_l(infile):
     Usage: wc_l("my_file.txt")
     
     Notes: Linux wildcards will not work as expected. Use the glob if needed.
-    
-    """    
+           Counts newlines in large binary blocks rather than iterating over lines.
+
+    """
 
     nlines = 0
-    
-    with open(infile, "r") as ifstream:
-        for line in ifstream:
-            nlines += 1
-    return nlines        
+    last   = b"\n"
+
+    with open(infile, "rb") as ifstream:
+        while True:
+            block = ifstream.read(2**24)
+            if not block:
+                break
+            nlines += block.count(b"\n")
+            last    = block[-1:]
+
+    if last != b"\n": # Unterminated last line still counts
+        nlines += 1
+
+    return nlines
     
 def count_xyzframes_general(infile):
 
@@ -390,37 +407,12 @@ def count_xyzframes_general(infile):
     Usage: count_xyzframes_general("my_file.xyz")
     
     Notes: Linux wildcards will not work as expected. Use the glob if needed.
-    
-    """    
+           Frames whose printing did not finish are not counted.
+           Uses (and if needed, builds) the file's frame index; see Trajectory.
 
-    nframes = 0
-    natoms  = []
-    nlines  = 0
-    
-    with open(infile, "r") as ifstream:
-        for line in ifstream:
-            
-            nlines +=1
-        
-            if len(line.split()) == 1:
-                
-                # Try/except for cases where print isn't finished
-                
-                try:
-                    natoms.append(int(line.split()[0]))
-                except:
-                    break
-                nframes += 1
-                
-    sanity = len(natoms)*2 + sum(natoms)
-    
-    # Check whether frame finished printing
-    
-    if sanity > nlines:
-        nframes -= 1 
-    
-    
-    return nframes    
+    """
+
+    return len(Trajectory(infile))
     
 def count_genframes_general(infile):
 
@@ -468,17 +460,202 @@ def list_natoms(infile):
     Usage: list_natoms("my_file.txt")
     
     Notes: Linux wildcards will not work as expected. Use the glob if needed.
-    
-    """    
+           Uses (and if needed, builds) the file's frame index; see Trajectory.
+
+    """
+
+    return list(Trajectory(infile).natoms)
+
+def read_xyzframes(infile):
+
+    """
+
+    Generator yielding the frames of a .xyz(f) file one at a time.
+
+    Usage: for frame in read_xyzframes("my_file.xyzf"): ...
+
+    Notes: Each frame is returned as a list of its 2+natoms lines, as readlines() would.
+           The file is streamed in a single pass; only one frame is held in memory.
+           Frames whose printing did not finish are not returned.
+
+    """
 
-    natoms = []
-    
     with open(infile, "r") as ifstream:
-        for line in ifstream:
-            if len(line.split()) == 1:
-                natoms.append(int(line.split()[0]))
-    return natoms        
-        
+
+        while True:
+
+            line = ifstream.readline()
+
+            if not line:
+                return
+
+            # Try/except for cases where print isn't finished
+
+            try:
+                natoms = int(line)
+            except ValueError:
+                return
+
+            frame = [line]
+
+            for i in range(natoms+1):
+                frame.append(ifstream.readline())
+
+            if not frame[-1].endswith('\n'):
+                return
+
+            yield frame
+
+
+# In-process cache of frame indices, keyed by absolute path
+
+TRAJ_INDEX_CACHE = {}
+
+class Trajectory:
+
+    """
+
+    Frame index for a .xyz(f) file, giving O(1) frame counts and random frame access.
+
+    Usage: traj = helpers.Trajectory("my_file.xyzf")
+           len(traj), traj.natoms[j], traj.nfields[j], traj.frame(j), traj[j]
+
+    Notes: The index is built in a single pass and saved to a sidecar file,
+           <infile>.frameidx, holding the file size and mtime followed by one
+           "<byte offset> <natoms> <no. header fields>" line per frame. The sidecar
+           is rebuilt whenever the size or mtime of the trajectory changes.
+           Frames whose printing did not finish are not indexed.
+           If the sidecar can't be written, the index is only kept in memory.
+
+    """
+
+    def __init__(self, infile):
+
+        self.name    = infile
+        self.idxfile = infile + ".frameidx"
+
+        stat         = os.stat(infile)
+        self.size    = stat.st_size
+        self.mtime   = stat.st_mtime_ns
+
+        self.offsets = []
+        self.natoms  = []
+        self.nfields = []
+
+        key    = os.path.abspath(infile)
+        cached = TRAJ_INDEX_CACHE.get(key)
+
+        if cached is not None and cached.size == self.size and cached.mtime == self.mtime:
+            self.offsets = cached.offsets
+            self.natoms  = cached.natoms
+            self.nfields = cached.nfields
+            return
+
+        if not self.read_index():
+            self.build_index()
+            self.write_index()
+
+        TRAJ_INDEX_CACHE[key] = self
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, j):
+        return self.frame(j)
+
+    def read_index(self):
+
+        """ Loads the sidecar index; returns False if it is missing or stale. """
+
+        if not os.path.isfile(self.idxfile):
+            return False
+
+        with open(self.idxfile, "r") as ifstream:
+
+            header = ifstream.readline().split()
+
+            if len(header) != 3 or int(header[0]) != self.size or int(header[1]) != self.mtime:
+                return False
+
+            for line in ifstream:
+                line = line.split()
+                self.offsets.append(int(line[0]))
+                self.natoms .append(int(line[1]))
+                self.nfields.append(int(line[2]))
+
+        if len(self.offsets) != int(header[2]):
+            self.offsets = []; self.natoms = []; self.nfields = []
+            return False
+
+        return True
+
+    def build_index(self):
+
+        """ Scans the trajectory once, recording where each complete frame starts. """
+
+        offset = 0
+
+        with open(self.name, "rb") as ifstream:
+
+            while True:
+
+                line = ifstream.readline()
+
+                if not line:
+                    break
+
+                # Try/except for cases where print isn't finished
+
+                try:
+                    natoms = int(line)
+                except ValueError:
+                    break
+
+                start   = offset
+                offset += len(line)
+
+                header  = ifstream.readline()
+                offset += len(header)
+
+                complete = header.endswith(b"\n")
+
+                for i in range(natoms):
+
+                    line    = ifstream.readline()
+                    offset += len(line)
+
+                    if not line.endswith(b"\n"):
+                        complete = False
+                        break
+
+                if not complete:
+                    break
+
+                self.offsets.append(start)
+                self.natoms .append(natoms)
+                self.nfields.append(len(header.split()))
+
+    def write_index(self):
+
+        """ Saves the index next to the trajectory; silently skipped if not possible. """
+
+        try:
+            with open(self.idxfile, "w") as ofstream:
+                ofstream.write(str(self.size) + " " + str(self.mtime) + " " + str(len(self.offsets)) + '\n')
+                for j in range(len(self.offsets)):
+                    ofstream.write(str(self.offsets[j]) + " " + str(self.natoms[j]) + " " + str(self.nfields[j]) + '\n')
+        except (IOError, OSError):
+            pass
+
+    def frame(self, j):
+
+        """ Returns the 2+natoms lines of frame j, as readlines() would. """
+
+        with open(self.name, "rb") as ifstream:
+            ifstream.seek(self.offsets[j])
+            return [ifstream.readline().decode() for i in range(self.natoms[j]+2)]
+
+
 def email_user(base, address, status):
 
     """ 
@@ -507,8 +684,11 @@ def create_and_launch_job(*argv, **kwargs):
     Usage: create_and_launch_job(<arguments>)
     
     Notes: if "job_executable" is empty, uses the commands specified in *argv.
+           If "job_depend" is given, the job won't start until the listed jobs have 
+           ended, as set by "job_depend_type" (see submit_job).
            See function definition in helpers.py for a full list of options.
-           Currently, function only supports SLURM systems.
+           Supports SLURM systems, torque (#PBS lines), and the "local" scheduler 
+           (see local_sched.py), which reads the same #SBATCH lines as SLURM.
     
     """    
 
@@ -516,8 +696,8 @@ def create_and_launch_job(*argv, **kwargs):
     # 0. Set up an argument parser
     ################################
     
-    default_keys   = [""]*12
-    default_values = [""]*12
+    default_keys   = [""]*14
+    default_values = [""]*14
 
     # Overall job controls
     
@@ -533,6 +713,8 @@ def create_and_launch_job(*argv, **kwargs):
     default_keys[9 ] = "job_email"         ; default_values[9 ] =     True           # Should emails be sent?
     default_keys[10] = "job_modules"       ; default_values[10] =     ""             # Name of the resulting submit script    
     default_keys[11] = "job_mem"           ; default_values[11] =     "128"             # GB
+    default_keys[12] = "job_depend"        ; default_values[12] =     None           # List of jobids this job depends on
+    default_keys[13] = "job_depend_type"   ; default_values[13] =     "afterok"      # Dependency type: afterok, afternotok, or afterany
     
 
     args = dict(list(zip(default_keys, default_values)))
@@ -546,25 +728,38 @@ def create_and_launch_job(*argv, **kwargs):
     run_bash_cmnd("rm -f " + args["job_file"])
     
     JOB = []
-    JOB.append(" -J " + args["job_name"])
-    JOB.append(" -N " + args["job_nodes"])
-    JOB.append(" --ntasks-per-node " + args["job_ppn"])
-    if args["job_mem"] and args["job_system"] == "UM-ARC":
-        JOB.append("--mem-per-cpu="+str(int(int(args["job_mem"])/int(args["job_ppn"])))+"G")
-    JOB.append(" -t " + args["job_walltime"])             
-    JOB.append(" -p " + args["job_queue"])
-    if args["job_email"]:
-        JOB.append(" --mail-type=ALL")   
-    JOB.append(" -A " + args["job_account"])  
-    JOB.append(" -V " )
-    JOB.append(" -o " + "stdoutmsg")
+    
+    if args["job_system"] == "torque": # PBS equivalents of the SLURM options below
+        JOB.append(" -N " + args["job_name"])
+        JOB.append(" -l nodes=" + args["job_nodes"] + ":ppn=" + args["job_ppn"])
+        JOB.append(" -l walltime=" + args["job_walltime"])
+        JOB.append(" -q " + args["job_queue"])
+        if args["job_email"]:
+            JOB.append(" -m abe")
+        JOB.append(" -A " + args["job_account"])
+        JOB.append(" -V " )
+        JOB.append(" -j oe")
+        JOB.append(" -o " + "stdoutmsg")
+    else:
+        JOB.append(" -J " + args["job_name"])
+        JOB.append(" -N " + args["job_nodes"])
+        JOB.append(" --ntasks-per-node " + args["job_ppn"])
+        if args["job_mem"] and args["job_system"] == "UM-ARC":
+            JOB.append("--mem-per-cpu="+str(int(int(args["job_mem"])/int(args["job_ppn"])))+"G")
+        JOB.append(" -t " + args["job_walltime"])             
+        JOB.append(" -p " + args["job_queue"])
+        if args["job_email"]:
+            JOB.append(" --mail-type=ALL")   
+        JOB.append(" -A " + args["job_account"])  
+        JOB.append(" -V " )
+        JOB.append(" -o " + "stdoutmsg")
     
     ofstream = open(args["job_file"],'w')
     ofstream.write("#!/bin/bash\n")
     
     for i in range(len(JOB)):
     
-        if args["job_system"] == "slurm" or "TACC" or "UM-ARC":
+        if args["job_system"] in ["slurm", "TACC", "UM-ARC", "local"]: # local_sched reads the #SBATCH lines
             JOB[i] = "#SBATCH" + JOB[i]
         elif args["job_system"] == "torque":
             JOB[i] = "#PBS"  + JOB[i]
@@ -574,6 +769,9 @@ def create_and_launch_job(*argv, **kwargs):
             
         ofstream.write(JOB[i] + '\n')
         
+    if args["job_system"] == "torque": # PBS jobs start in the home directory
+        ofstream.write("cd ${PBS_O_WORKDIR}\n")
+        
     if args["job_modules"]:
         ofstream.write("module load " + args["job_modules"] + '\n')
     
@@ -593,28 +791,192 @@ def create_and_launch_job(*argv, **kwargs):
     # 2. Launch the job file
     ################################
 
-    jobid = None
+    return submit_job(args["job_file"], args["job_system"], args["job_depend"], args["job_depend_type"])
+    
+JOB_ARRAY = None # While collecting jobs for a job array (see begin_job_array), a list of [work dir, job file]
+JOB_CHAIN = None # While chaining continuation jobs (see begin_job_chain), a list of their jobids
+
+CONDITIONAL_JOBS = [] # Jobs that only run if their dependencies fail (afternotok), and are cancelled otherwise; dropped once monitor_jobs sees them end
+
+def submit_job(job_file, job_system="slurm", job_depend=None, job_depend_type="afterok"):
+
+    """ 
+    
+    Submits a job file from the current directory and returns its jobid. 
+    
+    Usage: submit_job("run.cmd", "slurm") or submit_job("run.cmd", "slurm", ["2116091"], "afternotok")
+    
+    Notes: If job_depend (a list of jobids) is given, the job is held until they end. 
+           With job_depend_type "afterok", it runs only if they all completed 
+           successfully; with "afternotok", only if they failed (e.g. timed out); with 
+           "afterany", regardless. A job whose dependency can't be satisfied is cancelled.
+           While jobs are being collected for a job array (see begin_job_array), the job 
+           file isn't submitted; it's added to the array, and a placeholder jobid 
+           ("array-<index>") is returned instead.
+           While continuation jobs are being chained (see begin_job_chain), each job 
+           submitted without dependencies is followed by a copy that depends on it with
+           afternotok (see write_continuation).
+           For job_system "local", the job is run on this machine by local_sched.
+    
+    """
+    
+    global JOB_ARRAY
+    
+    depend = None
+    
+    if job_depend:
+        depend = job_depend_type + ":" + ':'.join([str(jobid).split()[0] for jobid in job_depend])
+    
+    if job_system == "local":
+    
+        jobid = local_sched.submit(job_file, depend)
+    
+    elif job_system == "slurm" or job_system == "TACC" or job_system == "UM-ARC":
     
-    if args["job_system"] == "slurm" or args["job_system"] == "TACC" or args["job_system"] == "UM-ARC":
-        jobid = run_bash_cmnd("sbatch " + args["job_file"]).split()[-1]
+        if JOB_ARRAY is not None:
+        
+            if depend:
+                print("WARNING: Job dependencies are ignored for jobs collected into a job array")
+        
+            JOB_ARRAY.append([os.getcwd(), job_file])
+            
+            return "array-" + str(len(JOB_ARRAY)-1)
+            
+        cmnd = "sbatch "
+        
+        if depend:
+            cmnd += "--dependency=" + depend + " --kill-on-invalid-dep=yes "
+    
+        jobid = run_bash_cmnd(cmnd + job_file).split()[-1]
     else:    
-        jobid = run_bash_cmnd("qsub " + args["job_file"])
+    
+        cmnd = "qsub "
+        
+        if depend:
+            cmnd += "-W depend=" + depend + " "
+    
+        jobid = run_bash_cmnd(cmnd + job_file).replace('\n', '')
+        
+    if depend and (job_depend_type == "afternotok"):
+        CONDITIONAL_JOBS.append(jobid)
+        
+    if (JOB_CHAIN is not None) and (not depend):
+        JOB_CHAIN.append(submit_job(write_continuation(job_file), job_system, [jobid], "afternotok"))
+        
+    return jobid
+    
+def write_continuation(job_file):
 
-    return jobid    
+    """ 
     
-def wait_for_job(active_job, **kwargs):
+    Writes a copy of a job file, for use as a continuation job (see begin_job_chain), 
+    and returns its name: continue.<job_file>.
+    
+    Usage: submit_job(write_continuation("run_qm.cmd"), "slurm", [jobid], "afternotok")
+    
+    Notes: The copy's output goes to <output file>.continue (e.g. stdoutmsg.continue), 
+           both for the job's -o file and for job array tasks (see submit_job_array), 
+           so the failed run's log isn't overwritten.
+    
+    """
+    
+    cont_file = "continue." + job_file
+    contents  = []
+    
+    for line in readlines(job_file):
+    
+        fields = line.split()
+        
+        if (len(fields) > 2) and (fields[0] in ["#SBATCH", "#PBS"]) and (fields[1] == "-o"):
+            line = line.rstrip() + ".continue\n"
+        elif "> stdoutmsg " in line:
+            line = line.replace("> stdoutmsg ", "> stdoutmsg.continue ")
+            
+        contents.append(line)
+        
+    writelines(cont_file, contents)
+    
+    return cont_file
+
+def begin_job_chain(enabled=True):
 
     """ 
     
-    Pauses the code until a single SLURM job completes.
+    Starts chaining continuation jobs: until end_job_chain, each job submitted without 
+    dependencies (see submit_job) is immediately followed by a resubmission of the same 
+    job file that only runs if the first fails, e.g. by running out of walltime.
     
-    Usage: wait_for_job(2116091,<arguments>)
+    Usage: begin_job_chain(config.HPC_JOB_CHAIN)
+    
+    Notes: Does nothing if enabled is false. Only for job files that can safely be 
+           rerun, i.e. that skip work completed by a previous run (e.g. the QM drivers'
+           run_<code>.cmd files). The continuation waits in the queue alongside the 
+           original, rather than being submitted by the driver once the original ends.
+    
+    """
+    
+    global JOB_CHAIN
+    
+    if enabled:
+        JOB_CHAIN = []
+        
+def end_job_chain():
+
+    """ 
+    
+    Stops chaining continuation jobs (see begin_job_chain), and returns the list of 
+    continuation jobids submitted since begin_job_chain.
+    
+    Usage: active_jobs += end_job_chain()
+    
+    """
+    
+    global JOB_CHAIN
+    
+    jobids    = JOB_CHAIN or []
+    JOB_CHAIN = None
+    
+    return jobids
+
+def begin_job_array(enabled=True):
+
+    """ 
+    
+    Starts collecting submitted jobs (see submit_job) for a single job array submission.
     
-    Notes: Accepts a jobid and queries the queueing system to determine
-           whether the job is active. Doesn't return until job completes.
+    Usage: begin_job_array(config.HPC_JOB_ARRAYS)
+    
+    Notes: Does nothing if enabled is false. See submit_job_array.
+    
+    """
+    
+    global JOB_ARRAY
+    
+    if enabled:
+        JOB_ARRAY = []
+        
+def submit_job_array(jobids, **kwargs):
+
+    """ 
+    
+    Submits the jobs collected since begin_job_array as SLURM job array(s), and returns 
+    the list of array jobids. 
+    
+    Usage: active_jobs = submit_job_array(active_jobs, job_name = "ALC-1-md")
+    
+    Notes: jobids is the list of (placeholder) jobids returned while collecting, and is 
+           returned unchanged if no jobs were collected.
+           Jobs are grouped by their #SBATCH resource requests (ignoring job name and 
+           output file); each group is submitted as one array. Task i of an array reads 
+           its work directory and job file from line i+1 of the <job_name>.<group>.array.dat 
+           manifest, and runs the job file there with bash, sending its output to the 
+           work directory's stdoutmsg, as for a stand-alone job.
+           If given, job_array_max limits the number of simultaneously running tasks.
            See function definition in helpers.py for a full list of options.
     
-    """    
+    """
+    
+    global JOB_ARRAY
 
     ################################
     # 0. Set up an argument parser
@@ -623,55 +985,240 @@ def wait_for_job(active_job, **kwargs):
     default_keys   = [""]*3
     default_values = [""]*3
     
-    default_keys  [0] = "job_system" ; default_values[0] = "slurm"
-    default_keys  [1] = "verbose"    ; default_values[1] = False 
-    default_keys  [2] = "job_name"   ; default_values[2] = "unspecified" 
+    default_keys  [0] = "job_name"      ; default_values[0] = "job_array"
+    default_keys  [1] = "job_system"    ; default_values[1] = "slurm" 
+    default_keys  [2] = "job_array_max" ; default_values[2] = None 
     
     args = dict(list(zip(default_keys, default_values)))
     args.update(kwargs)
     
-    active_job = str(active_job).split()[0]
+    tasks     = JOB_ARRAY
+    JOB_ARRAY = None
+    
+    if not tasks: # Nothing collected, e.g. jobs were submitted directly on non-SLURM systems
+        return jobids
+        
+    ################################
+    # 1. Group the collected jobs by resource request
+    ################################
+    
+    groups = {}
     
+    for work_dir, job_file in tasks:
     
+        header = [line.rstrip() for line in readlines(work_dir + "/" + job_file) if line.startswith("#SBATCH")]
+        header = tuple([line for line in header if not (line.split()[1] in ["-J", "-o"])])
+        
+        if header not in groups:
+            groups[header] = []
+            
+        groups[header].append([work_dir, job_file])
+        
     ################################
-    # 1. Determine job status, hold until complete
+    # 2. Write the manifests and array job files, and submit
     ################################
+    
+    array_ids = []
+    
+    for i, header in enumerate(groups):
+    
+        manifest = os.getcwd() + "/" + args["job_name"] + "." + str(i) + ".array.dat"
+        job_file = args["job_name"] + "." + str(i) + ".array.cmd"
+        
+        writelines(manifest, [work_dir + " " + task_file + '\n' for work_dir, task_file in groups[header]])
+        
+        array_range = "0-" + str(len(groups[header])-1)
+        
+        if args["job_array_max"]:
+            array_range += "%" + str(args["job_array_max"])
+        
+        JOB = []
+        JOB.append("#!/bin/bash\n")
+        JOB.append("#SBATCH -J " + args["job_name"] + "\n")
+        JOB += [line + '\n' for line in header]
+        JOB.append("#SBATCH -o " + args["job_name"] + "." + str(i) + ".%a.out\n")
+        JOB.append("#SBATCH --array=" + array_range + "\n")
+        JOB.append("read WORK_DIR JOB_FILE <<< $(sed -n \"$((SLURM_ARRAY_TASK_ID+1))p\" " + manifest + ")\n")
+        JOB.append("cd ${WORK_DIR}\n")
+        JOB.append("bash ${JOB_FILE} > stdoutmsg 2>&1\n")
+        
+        writelines(job_file, JOB)
+        
+        print("Submitting", len(groups[header]), "jobs as job array", job_file)
+        
+        array_ids.append(submit_job(job_file, args["job_system"]))
+        
+    return array_ids
+    
+JOB_POLL_MIN    = 10  # Seconds between queue checks right after submission, or after a job finishes
+JOB_POLL_MAX    = 300 # Longest time (s) between queue checks
+JOB_POLL_GROWTH = 1.5 # Factor by which the time between checks grows while jobs keep running
 
-    while True:
+def query_active_jobs(jobids, **kwargs):
+
+    """ 
+    
+    Returns the subset of jobids still known to the queueing system (pending, running, 
+    completing, ...), from a single squeue call, or None if squeue failed.
+    
+    Usage: still_active = query_active_jobs(["2116091", "2116092"])
+    
+    Notes: Lists all of the user's jobs at once, rather than running squeue per job. 
+           A job array's id counts as active while any of its tasks are.
+           The squeue command can be replaced via job_squeue (e.g. for testing).
+    
+    """
+    
+    default_keys   = [""]*2
+    default_values = [""]*2
+    
+    default_keys  [0] = "job_squeue" ; default_values[0] = "squeue"
+    default_keys  [1] = "job_user"   ; default_values[1] = os.environ.get("USER", "")
+    
+    args = dict(list(zip(default_keys, default_values)))
+    args.update(kwargs)
+    
+    cmnd = args["job_squeue"].split() + ["-h", "-o", "%i|%T"]
+    
+    if args["job_user"]:
+        cmnd += ["-u", args["job_user"]]
+    
+    try:
+        queue = check_output(cmnd).decode('utf-8')
+    except (CalledProcessError, OSError) as err_msg:
+        print("WARNING: Could not query the queue:", err_msg)
+        return None
         
-        check_job = ""
+    listed = set([line.split("|")[0].strip() for line in queue.splitlines() if line.strip()])
+    
+    active = set()
+    
+    for jobid in jobids:
+        for listed_id in listed:
+            if (listed_id == jobid) or listed_id.startswith(jobid + "_"):
+                active.add(jobid)
+                break
+                
+    return active
+    
+def query_exit_states(jobids, **kwargs):
+
+    """ 
+    
+    Returns {jobid: [state, exit code]} for finished jobs, from a single sacct call. 
+    
+    Usage: states = query_exit_states(["2116091", "2116092"])
+    
+    Notes: For job arrays, the first task that didn't complete determines the state.
+           Jobs sacct doesn't know about (or if sacct is unavailable) get state "UNKNOWN"
+           and exit code None. The sacct command can be replaced via job_sacct.
+    
+    """
+    
+    default_keys   = [""]*1
+    default_values = [""]*1
+    
+    default_keys  [0] = "job_sacct" ; default_values[0] = "sacct"
+    
+    args = dict(list(zip(default_keys, default_values)))
+    args.update(kwargs)
+    
+    states = {}
+    
+    for jobid in jobids:
+        states[jobid] = ["UNKNOWN", None]
+    
+    if len(jobids) == 0:
+        return states
+        
+    try:
+        acct = check_output(args["job_sacct"].split() + ["-n", "-P", "-X", "-o", "JobID,State,ExitCode", "-j", ','.join(jobids)]).decode('utf-8')
+    except (CalledProcessError, OSError) as err_msg:
+        print("WARNING: Could not query job exit states:", err_msg)
+        return states
+        
+    for line in acct.splitlines():
+    
+        fields = line.strip().split("|")
         
-        if args["job_system"] == "slurm" or "TACC" or "UM-ARC":
-            check_job = "squeue -j " + active_job
+        if len(fields) < 3:
+            continue
             
-        elif args["job_system"] == "torque":
-            print("ERROR: torque support not yet implemented in wait_for_job")
-        else:
-            print("ERROR: Unknown job_system: ", args["job_system"])
-            exit()
+        jobid = fields[0].split("_")[0]
+        state = fields[1].split()[0] if fields[1].strip() else "UNKNOWN"
+        
+        if jobid not in states:
+            continue
+        
+        if (states[jobid][0] == "UNKNOWN") or ((states[jobid][0] == "COMPLETED") and (state != "COMPLETED")):
+            states[jobid] = [state, fields[2]]
             
-        if active_job in  run_bash_cmnd(check_job):
+    return states
+    
+def query_active_jobs_torque(jobids, **kwargs):
+
+    """ 
+    
+    Returns the subset of jobids still queued, running, or held under torque, from a 
+    single qstat call, or None if qstat failed.
+    
+    Usage: still_active = query_active_jobs_torque(["2116091.server", "2116092.server"])
+    
+    Notes: Counterpart of query_active_jobs. Jobs are matched on the numeric part of 
+           their id, so "2116091" and "2116091.server" are the same job, and a job array
+           ("2116091[]") counts as active while listed. Completed (C) and exiting (E) 
+           jobs are taken to have finished. The qstat command can be replaced via 
+           job_qstat (e.g. for testing).
+    
+    """
+    
+    default_keys   = [""]*1
+    default_values = [""]*1
+    
+    default_keys  [0] = "job_qstat" ; default_values[0] = "qstat"
+    
+    args = dict(list(zip(default_keys, default_values)))
+    args.update(kwargs)
+    
+    try:
+        queue = check_output(args["job_qstat"].split()).decode('utf-8')
+    except (CalledProcessError, OSError) as err_msg:
+        print("WARNING: Could not query the queue:", err_msg)
+        return None
         
-            if args["verbose"]:
-                print("Sleeping for 60 more seconds while waiting for job ", active_job, "...", args["job_name"])
+    listed = set()
+    
+    for line in queue.splitlines():
+    
+        fields = line.split()
         
-            time.sleep(60) # sleep for 60 seconds
-        else:        
-            print("Breaking ... ")
-            break                
+        if (len(fields) < 2) or (not fields[0][0].isdigit()): # Header or separator
+            continue
             
-    return
+        if fields[-2] in ["C", "E"]:
+            continue
+            
+        listed.add(fields[0].split(".")[0].split("[")[0])
+        
+    return set([jobid for jobid in jobids if jobid.split(".")[0].split("[")[0] in listed])
     
-def wait_for_jobs(*argv, **kwargs):
+def monitor_jobs(jobids, **kwargs):
 
     """ 
     
-    Pauses the code until SLURM job completes.
+    Pauses the code until all of a list of queued jobs complete, and returns their exit 
+    states as {jobid: [state, exit code]} (see query_exit_states).
     
-    Usage: wait_for_jobs([2116091, 2116092], <arguments>)
+    Usage: states = monitor_jobs(["2116091", "2116092"], <arguments>)
     
-    Notes: Accepts list of jobid and queries the queueing system to determine
-           whether any jobs are active. Doesn't return until job completes.
+    Notes: All outstanding jobs are checked with a single squeue call per poll. Polls 
+           start JOB_POLL_MIN seconds apart, growing by JOB_POLL_GROWTH up to 
+           JOB_POLL_MAX while nothing finishes, and return to JOB_POLL_MIN whenever a 
+           job finishes. Failed squeue calls are retried at the next poll rather than 
+           taken to mean that jobs have finished. Jobs that didn't complete successfully
+           are reported. For job_system "local", local_sched is polled instead, every 
+           poll_min seconds. For job_system "torque", qstat is polled (see
+           query_active_jobs_torque), and exit states are all "UNKNOWN".
            See function definition in helpers.py for a full list of options.
     
     """
@@ -680,61 +1227,115 @@ def wait_for_jobs(*argv, **kwargs):
     # 0. Set up an argument parser
     ################################
 
-    default_keys   = [""]*3
-    default_values = [""]*3
+    default_keys   = [""]*5
+    default_values = [""]*5
     
     default_keys  [0] = "job_system" ; default_values[0] = "slurm"
     default_keys  [1] = "verbose"    ; default_values[1] = False 
     default_keys  [2] = "job_name"   ; default_values[2] = "unspecified" 
+    default_keys  [3] = "poll_min"   ; default_values[3] = JOB_POLL_MIN
+    default_keys  [4] = "poll_max"   ; default_values[4] = JOB_POLL_MAX
     
     args = dict(list(zip(default_keys, default_values)))
     args.update(kwargs)
     
-    active_jobs = argv[0] # Pointer!
-    
+    query_args = {key: args[key] for key in ["job_squeue", "job_user", "job_sacct", "job_qstat"] if key in args}
 
     ################################
     # 1. Determine job status, hold until complete
     ################################
-
-    njobs  = len(active_jobs)
-
-    active = [True]*njobs
     
+    outstanding = [str(jobid).split()[0] for jobid in jobids]
+    finished    = []
+    interval    = float(args["poll_min"])
+
     while True:
     
-        for i in range(njobs):
-            check_job = ""
-            
-            if type(active_jobs[i]) == type(1):
-                active_jobs[i] = str(active_jobs[i])
+        if args["job_system"] == "local":
+            active   = local_sched.query_active_jobs(outstanding)
+            interval = float(args["poll_min"])
+        elif args["job_system"] == "torque":
+            active = query_active_jobs_torque(outstanding, **query_args)
+        else:
+            active = query_active_jobs(outstanding, **query_args)
         
-            if args["job_system"] == "slurm" or "TACC":
-
-                check_job = "squeue -j " + active_jobs[i]
-            
-            elif args["job_system"] == "torque":
-                print("ERROR: torque support not yet implemented in wait_for_job")
-            else:
-                print("ERROR: Unknown job_system: ", args["job_system"])
-                exit()
-            
-            if active_jobs[i] in  run_bash_cmnd(check_job):
-                active[i] = True
-            else:
-                active[i] = False
+        if active is not None:
+        
+            done        = [jobid for jobid in outstanding if jobid not in active]
+            outstanding = [jobid for jobid in outstanding if jobid     in active]
+            finished   += done
             
+            if len(done) > 0:
+                interval = float(args["poll_min"])
+                
+        if len(outstanding) == 0:
+            print("Breaking ... ")
+            break
+    
+        if args["verbose"]:
+            print("Sleeping for", int(interval), "more seconds while waiting for", len(outstanding), "job(s)", outstanding[:10], "...", args["job_name"])
         
-        if True in active:
+        time.sleep(interval)
         
-            if args["verbose"]:
-                print("Sleeping for 60 more seconds while waiting for jobs ", active_jobs, "...", args["job_name"])
+        interval = min(interval*JOB_POLL_GROWTH, float(args["poll_max"]))
         
-            time.sleep(60) # sleep for 60 seconds
-        else:        
-            print("Breaking ... ")
-            break                    
-    return  
+    if args["job_system"] == "local":
+        states = local_sched.query_exit_states(finished)
+    elif args["job_system"] == "torque": # No accounting is queried; jobs aren't checked for failure
+        states = {jobid: ["UNKNOWN", None] for jobid in finished}
+    else:
+        states = query_exit_states(finished, **query_args)
+    
+    for jobid in finished:
+        if (states[jobid][0] == "CANCELLED") and (jobid in CONDITIONAL_JOBS): # Original job succeeded
+            continue
+        if states[jobid][0] not in ["COMPLETED", "UNKNOWN"]:
+            print("WARNING: Job", jobid, "(", args["job_name"], ") ended with state", states[jobid][0], "and exit code", states[jobid][1])
+            
+    CONDITIONAL_JOBS[:] = [jobid for jobid in CONDITIONAL_JOBS if jobid not in finished] # Done with these
+            
+    return states
+
+def wait_for_job(active_job, **kwargs):
+
+    """ 
+    
+    Pauses the code until a single SLURM job completes, and returns its [state, exit code].
+    
+    Usage: wait_for_job(2116091,<arguments>)
+    
+    Notes: See monitor_jobs. Returns immediately if active_job is None.
+           See function definition in helpers.py for a full list of options.
+    
+    """    
+
+    if active_job is None: # Nothing was submitted, e.g. the task was run in-process
+        return None
+    
+    active_job = str(active_job).split()[0]
+    
+    return monitor_jobs([active_job], **kwargs)[active_job]
+    
+def wait_for_jobs(*argv, **kwargs):
+
+    """ 
+    
+    Pauses the code until a list of SLURM jobs complete, and returns their exit states.
+    
+    Usage: wait_for_jobs([2116091, 2116092], <arguments>)
+    
+    Notes: See monitor_jobs. 
+           See function definition in helpers.py for a full list of options.
+    
+    """
+
+    active_jobs = argv[0] # Pointer!
+    
+    for i in range(len(active_jobs)):
+        if type(active_jobs[i]) == type(1):
+            active_jobs[i] = str(active_jobs[i])
+    
+    return monitor_jobs(active_jobs, **kwargs)
 
 def str2bool(v):
 
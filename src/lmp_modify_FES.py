@@ -7,7 +7,7 @@ def clean_up():
     files   = ' '.join(glob.glob("*data.in"))
     files  += ' '.join(glob.glob("params* "))
     files  += ' '.join(glob.glob("*in.dallmps"))
-    files  += "run_lmpmd.cmd *rank* traj_bad_r.lt.rin.xyz traj_bad_r.lt.rin+dp.xyz restart.bak traj_bad_r.ge.rin+dp_dftbfrq.xyz traj.lammpstrj stdoutmsg lmp.out out.lmp"
+    files  += "run_lmpmd.cmd *rank* traj_bad_r.lt.rin.xyz traj_bad_r.lt.rin+dp.xyz restart.bak traj_bad_r.ge.rin+dp_dftbfrq.xyz traj.lammpstrj stdoutmsg lmp.out out.lmp frames.lammpstrj frames.xyz forceout-batch.txt"
 
     helpers.run_bash_cmnd("rm -f " + files)
 
@@ -45,7 +45,7 @@ def extract_masses(param_file,natomtyps):
                     masses.append(line.split()[-1])        
     return masses
 
-def gen_input_file(param_file, xyz_file):
+def gen_input_file(param_file, xyz_file, rerun_file=None):
     
     """ 
     
@@ -54,6 +54,9 @@ def gen_input_file(param_file, xyz_file):
     
     Usage: gen_input_file(param_file, xyz_file)
     
+    Notes: If rerun_file (a LAMMPS dump file) is given, lmp.in evaluates every
+           snapshot in it via "rerun" rather than running a single point on xyz_file.
+    
     WARNING: This does not current support triclinic cells!
     
     """
@@ -83,7 +86,10 @@ def gen_input_file(param_file, xyz_file):
     ofstream.write("\ndump            1 all custom 1 traj.lammpstrj id type element xu yu zu fx fy fz")
     ofstream.write("\ndump_modify     1 sort id element " + " ".join(atmtyps))
     ofstream.write("\ntimestep        0.1")
-    ofstream.write("\nrun             0")
+    if rerun_file:
+        ofstream.write("\nrerun           " + rerun_file + " dump x y z box yes")
+    else:
+        ofstream.write("\nrun             0")
     ofstream.write("\n")
     ofstream.close()
     
@@ -159,3 +165,183 @@ def get_FES(xyz_file,param_file, md_driver):
     # Return results
     
     return tmp_ener, tmp_stress, "forceout.txt"
+
+def get_FES_loop(xyz_file, param_file, md_driver):
+
+    """ 
+    
+    Evaluates every frame of a multi-frame .xyz file with one single point calculation
+    per frame. Fallback for get_FES_batch; returns the same quantities.
+    
+    Usage: get_FES_loop("frames.xyz", param_file, md_driver)
+    
+    """
+    
+    tmp_ener   = []
+    tmp_stress = []
+    
+    ofstream = open("forceout-batch.txt",'w')
+    
+    for frame in helpers.read_xyzframes(xyz_file):
+    
+        helpers.writelines("tmp.xyz", frame)
+        
+        ener, stress, force_file = get_FES("tmp.xyz", param_file, md_driver)
+        
+        tmp_ener  .append(ener)
+        tmp_stress.append(stress)
+        
+        with open(force_file,'r') as ifstream:
+            for line in ifstream:
+                ofstream.write(line)
+                
+    ofstream.close()
+    
+    return tmp_ener, tmp_stress, "forceout-batch.txt"
+
+def write_dumpfile(xyz_file, atmtyps, dump_file):
+
+    """ 
+    
+    Converts a multi-frame .xyz file into a LAMMPS custom dump file, for use with rerun.
+    
+    Usage: write_dumpfile("frames.xyz", ["C","H"], "frames.lammpstrj")
+    
+    Notes: Returns the number of frames written, or None if the frames can't share a
+           single data file (i.e. atom types/ordering differ between frames) or have
+           triclinic cells.
+    
+    """
+    
+    elements = None
+    nframes  = 0
+    
+    ofstream = open(dump_file,'w')
+    
+    for frame in helpers.read_xyzframes(xyz_file):
+    
+        natoms = int(frame[0])
+        lines  = [frame[k].split() for k in range(2,natoms+2)]
+        
+        if elements is None:
+            elements = [line[0] for line in lines]
+        elif elements != [line[0] for line in lines]:
+            ofstream.close()
+            return None
+        
+        boxline = frame[1].split()
+        
+        if boxline[0] == "NON_ORTHO":
+            for k in [2,3,4,6,7,8]:
+                if abs(float(boxline[k])) > 0.0001:
+                    ofstream.close()
+                    return None
+            boxline = [boxline[1], boxline[5], boxline[9]]
+        
+        ofstream.write("ITEM: TIMESTEP\n" + str(nframes) + "\n")
+        ofstream.write("ITEM: NUMBER OF ATOMS\n" + str(natoms) + "\n")
+        ofstream.write("ITEM: BOX BOUNDS pp pp pp\n")
+        ofstream.write("0.0 " + boxline[0] + "\n")
+        ofstream.write("0.0 " + boxline[1] + "\n")
+        ofstream.write("0.0 " + boxline[2] + "\n")
+        ofstream.write("ITEM: ATOMS id type x y z\n")
+        
+        for k in range(natoms):
+            ofstream.write(str(k+1) + " " + str(atmtyps.index(lines[k][0])+1) + " " + " ".join(lines[k][1:4]) + "\n")
+            
+        nframes += 1
+        
+    ofstream.close()
+    
+    return nframes
+
+def get_FES_batch(xyz_file, param_file, md_driver):
+
+    """ 
+    
+    Evaluates every frame of a multi-frame .xyz file with a single LAMMPS "rerun".
+    
+    Usage: get_FES_batch("frames.xyz", param_file, md_driver)
+    
+    Notes: Returns a list of energies, a list of stress tensors (GPa) and the name
+           of a file holding the forces (kcal/mol/Ang) of all frames, one component per
+           line, in frame order. If the frames can't be run as a single rerun (see 
+           write_dumpfile), they are evaluated one by one instead.
+    
+    """
+    
+    atmtyps = check_atomtypes(param_file)
+    
+    nframes = write_dumpfile(xyz_file, atmtyps, "frames.lammpstrj")
+    
+    if not nframes:
+        return get_FES_loop(xyz_file, param_file, md_driver)
+        
+    # The data file only supplies atom types and masses; coordinates come from the dump file
+        
+    for frame in helpers.read_xyzframes(xyz_file):
+        helpers.writelines("tmp.xyz", frame)
+        break
+        
+    gen_input_file(param_file, "tmp.xyz", "frames.lammpstrj")
+    
+    # Run all frames at once
+    
+    helpers.run_bash_cmnd("rm -f traj.lammpstrj")
+    helpers.writelines("lmp.out",helpers.run_bash_cmnd(md_driver + " -i lmp.in"))
+    
+    # Parse/save the output: one thermo line per frame...
+    
+    tmp_ener   = []
+    tmp_stress = []
+    
+    found = False
+    
+    with open("log.lammps",'r') as ifstream:
+        for line in ifstream:
+        
+            line = line.split()
+            
+            if not found:
+                found = (len(line) > 0) and (line[0] == "Step")
+                continue
+                
+            if (len(line) > 0) and (line[0] == "Loop"):
+                break
+                
+            try:
+                int(line[0])
+            except (ValueError, IndexError):
+                continue
+                
+            # Convert LAMMPS pressure (atm, since real units) to GPa
+                
+            tmp_ener  .append(float(line[3]))
+            tmp_stress.append([float(k)/9869.23 for k in line[7:13]])
+            
+    if len(tmp_ener) != nframes:
+        print("ERROR: Expected",nframes,"frames of LAMMPS rerun output, found",len(tmp_ener))
+        print("       See log.lammps and lmp.out in", helpers.run_bash_cmnd("pwd"))
+        exit()
+    
+    # ... and one dump frame per frame
+    
+    ofstream = open("forceout-batch.txt",'w')
+    
+    with open("traj.lammpstrj",'r') as ifstream:
+        while True:
+        
+            header = [ifstream.readline() for k in range(9)]
+            
+            if not header[0]:
+                break
+                
+            for k in range(int(header[3])):
+                line = ifstream.readline().split()[6:]
+                ofstream.write(line[0] + "\n")
+                ofstream.write(line[1] + "\n")
+                ofstream.write(line[2] + "\n")
+                
+    ofstream.close()
+    
+    return tmp_ener, tmp_stress, "forceout-batch.txt"
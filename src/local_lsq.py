@@ -0,0 +1,246 @@
+# Global (python) modules
+
+import math as m
+
+# See gen_ff.solve_amat for how these are used
+
+def normalize_gram(gram):
+
+    """
+
+    Returns column scaling factors that give the weighted A-matrix unit-norm columns,
+    and the correspondingly scaled AtWA and AtWb.
+
+    Usage: scale, AtWA, AtWb = normalize_gram(gram)
+
+    Notes: gram is a dictionary of normal equation terms (see gen_ff.write_gram).
+           All-zero columns are left unscaled. Solve for the scaled x, then divide
+           by scale to recover the unscaled x. Columns are not centered: the fitted
+           model has no intercept term.
+
+    """
+
+    import numpy as np
+
+    scale = np.sqrt(np.diag(gram["AtWA"]).copy())
+    scale[scale == 0.0] = 1.0
+
+    return scale, gram["AtWA"] / np.outer(scale, scale), gram["AtWb"] / scale
+
+
+def normalizes(regression_alg, regression_nrm):
+
+    """
+
+    Returns True if the columns are normalized (see normalize_gram) for an algorithm,
+    i.e. if the ChIMES solver job would be passed --normalize (see gen_ff.solve_amat).
+
+    Usage: if normalizes("dlasso", True): ...
+
+    Notes: Only the dlasso job takes --normalize; other algorithms are always solved
+           with unscaled columns, which changes svd cutoffs and ridge/lasso penalties.
+
+    """
+
+    return (str(regression_nrm) == "True") and ("dlasso" in regression_alg)
+
+
+def factor_gram(AtWA):
+
+    """
+
+    Returns the eigendecomposition (eigenvalues, eigenvectors) of AtWA, i.e. the squared
+    singular values and right singular vectors of the weighted A-matrix.
+
+    Usage: evals, V = factor_gram(AtWA)
+
+    Notes: Shared by solve_svd and solve_ridge, so that several regularization values
+           can be evaluated from one factorization (see solve_path).
+
+    """
+
+    import scipy.linalg
+
+    return scipy.linalg.eigh(AtWA)
+
+
+def solve_svd(factors, AtWb, eps):
+
+    """
+
+    Solves the weighted least-squares problem through an SVD of the weighted A-matrix,
+    given the factorization of AtWA from factor_gram.
+
+    Usage: x = solve_svd(factor_gram(AtWA), AtWb, 1.0E-5)
+
+    Notes: As in the ChIMES solver, singular values smaller than eps times the largest
+           are discarded.
+
+    """
+
+    import numpy as np
+
+    evals, V = factors
+
+    svals = np.sqrt(np.clip(evals, 0.0, None))
+    keep  = svals > float(eps)*svals.max()
+
+    print("Keeping", np.count_nonzero(keep), "of", len(svals), "singular values")
+
+    return V[:,keep] @ ((V[:,keep].T @ AtWb) / evals[keep])
+
+
+def solve_ridge(factors, AtWb, alpha):
+
+    """
+
+    Solves the ridge regression problem min ||W^0.5(Ax-b)||^2 + alpha*||x||^2, given
+    the factorization of AtWA from factor_gram.
+
+    Usage: x = solve_ridge(factor_gram(AtWA), AtWb, 1.0E-5)
+
+    """
+
+    evals, V = factors
+
+    return V @ ((V.T @ AtWb) / (evals + float(alpha)))
+
+
+def solve_lasso(AtWA, AtWb, rows, alpha, x0=None, tol=1.0E-6, max_iter=10000):
+
+    """
+
+    Solves the lasso problem min 1/(2*rows)*||W^0.5(Ax-b)||^2 + alpha*||x||_1 by
+    coordinate descent on the normal equations.
+
+    Usage: x = solve_lasso(AtWA, AtWb, 1000, 1.0E-5)
+
+    Notes: Uses the same alpha convention as sklearn's Lasso/LassoLars. After each
+           full sweep, only the active (non-zero) coordinates are iterated until they
+           converge. Converged when no coordinate changes by more than tol times the
+           largest |x|. x0 is an optional initial guess (warm start), whose non-zero
+           coordinates are taken as the initial active set.
+
+    """
+
+    import numpy as np
+
+    G     = AtWA / float(rows)
+    c     = AtWb / float(rows)
+    alpha = float(alpha)
+    ncols = len(c)
+
+    x = np.zeros(ncols) if x0 is None else np.array(x0, dtype=np.float64)
+    r = c - G @ x # Negative gradient of the smooth term
+
+    def sweep(cols):
+
+        max_delta = 0.0
+
+        for j in cols:
+
+            if G[j,j] <= 0.0:
+                continue
+
+            rho = r[j] + G[j,j]*x[j]
+            new = m.copysign(max(abs(rho) - alpha, 0.0), rho) / G[j,j]
+
+            delta = new - x[j]
+
+            if delta != 0.0:
+                r[:] -= G[:,j]*delta
+                x[j]  = new
+                max_delta = max(max_delta, abs(delta))
+
+        return max_delta
+
+    active = np.flatnonzero(x) # For warm starts, begin from x0's active set
+
+    for i in range(max_iter):
+
+        for k in range(max_iter):
+            if sweep(active) <= tol*max(np.abs(x).max(), 1.0E-300):
+                break
+
+        max_delta = sweep(range(ncols))
+
+        if max_delta <= tol*max(np.abs(x).max(), 1.0E-300):
+            print("Lasso converged after", i+1, "sweeps;", np.count_nonzero(x), "of", ncols, "coefficients are non-zero")
+            return x
+
+        active = np.flatnonzero(x)
+
+    print("WARNING: Lasso did not converge after", max_iter, "sweeps")
+
+    return x
+
+
+def solve_path(gram, regression_alg, regression_vars, regression_nrm=True, x0=None):
+
+    """
+
+    Solves the weighted least-squares problem described by a set of normal equation
+    terms (see gen_ff.write_gram) for each of a list of regularization values,
+    returning the corresponding list of unscaled solutions.
+
+    Usage: xs = solve_path(gram, "dlasso", [1.0E-3, 1.0E-4, 1.0E-5], True)
+
+    Notes: "svd" uses the values as singular value cutoffs, "ridge" as ridge penalties,
+           and any lasso/lars algorithm (e.g. "dlasso", "dlars", "lassolars") as lasso
+           alphas, solved by coordinate descent. Problems are solved with normalized
+           columns (see normalize_gram) when the queued solve would be (see normalizes).
+           The normalization and factorization (svd, ridge) are shared by all values;
+           lasso solutions are warm-started along a descending alpha path, beginning
+           from the (unscaled) x0, if given.
+           Memory use is O(ncol^2), independent of the number of rows.
+
+    """
+
+    import numpy as np
+
+    if normalizes(regression_alg, regression_nrm):
+        scale, AtWA, AtWb = normalize_gram(gram)
+    else:
+        scale, AtWA, AtWb = np.ones(len(gram["AtWb"])), gram["AtWA"], gram["AtWb"]
+
+    xs = [None]*len(regression_vars)
+
+    if ("svd" in regression_alg) or ("ridge" in regression_alg):
+
+        factors = factor_gram(AtWA)
+
+        for i in range(len(regression_vars)):
+            if "svd" in regression_alg:
+                xs[i] = solve_svd  (factors, AtWb, regression_vars[i])
+            else:
+                xs[i] = solve_ridge(factors, AtWb, regression_vars[i])
+
+    elif ("lasso" in regression_alg) or ("lars" in regression_alg):
+
+        x = None if x0 is None else np.asarray(x0, dtype=np.float64) * scale
+
+        for i in sorted(range(len(regression_vars)), key=lambda i: -float(regression_vars[i])):
+            x     = solve_lasso(AtWA, AtWb, gram["rows"], regression_vars[i], x)
+            xs[i] = x.copy()
+
+    else:
+        print("ERROR: unknown regression algorithm for local solve: ", regression_alg)
+        exit()
+
+    return [x / scale for x in xs]
+
+
+def solve(gram, regression_alg, regression_var, regression_nrm=True, x0=None):
+
+    """
+
+    Solves the weighted least-squares problem described by a set of normal equation
+    terms (see gen_ff.write_gram), returning the unscaled solution x.
+
+    Usage: x = solve(gram, "dlasso", 1.0E-5, True)
+
+    Notes: See solve_path. x0 is an optional (unscaled) initial guess for lasso solves.
+
+    """
+
+    return solve_path(gram, regression_alg, [regression_var], regression_nrm, x0)[0]
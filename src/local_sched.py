@@ -0,0 +1,250 @@
+# Global (python) modules
+
+import os
+import subprocess
+
+""" A minimal local scheduler, used in place of SLURM when HPC_SYSTEM is "local". """
+
+# See helpers.submit_job and helpers.monitor_jobs for how these are used
+
+LOCAL_CORES = os.cpu_count() # Cores shared by all local jobs; see set_cores
+
+QUEUED   = [] # Jobs waiting for cores or dependencies, in submission order: [jobid, work dir, job file, cores, dependency]
+RUNNING  = {} # jobid: [process, cores]
+FINISHED = {} # jobid: exit code, or None if cancelled
+NEXT_ID  = 0
+
+def set_cores(cores=None):
+
+    """
+
+    Sets the number of cores shared by all local jobs.
+
+    Usage: set_cores(config.HPC_LOCAL_CORES)
+
+    Notes: If cores is None, all cores on the machine (os.cpu_count()) are used.
+
+    """
+
+    global LOCAL_CORES
+
+    LOCAL_CORES = int(cores) if cores else os.cpu_count()
+
+
+def job_cores(job_file):
+
+    """
+
+    Returns the number of cores requested by a job file, i.e. nodes times tasks per
+    node, from its #SBATCH -N/--nodes and --ntasks-per-node (or -n/--ntasks) lines.
+
+    Usage: job_cores("run.cmd")
+
+    Notes: Missing values are taken to be 1.
+
+    """
+
+    nodes = 1
+    ppn   = 1
+    tasks = None
+
+    for line in open(job_file,'r'):
+
+        fields = line.replace("=", " ").split()
+
+        if (len(fields) < 3) or (fields[0] != "#SBATCH"):
+            continue
+
+        if fields[1] in ["-N", "--nodes"]:
+            nodes = int(fields[2].split("-")[0])
+        elif fields[1] == "--ntasks-per-node":
+            ppn   = int(fields[2])
+        elif fields[1] in ["-n", "--ntasks"]:
+            tasks = int(fields[2])
+
+    if tasks is not None:
+        return tasks
+
+    return nodes*ppn
+
+
+def job_output(job_file):
+
+    """
+
+    Returns the output file of a job file, from its #SBATCH -o/--output line, or
+    stdoutmsg if there isn't one.
+
+    Usage: job_output("run.cmd")
+
+    """
+
+    for line in open(job_file,'r'):
+
+        fields = line.replace("=", " ").split()
+
+        if (len(fields) >= 3) and (fields[0] == "#SBATCH") and (fields[1] in ["-o", "--output"]):
+            return fields[2]
+
+    return "stdoutmsg"
+
+
+def dependency_state(depend):
+
+    """
+
+    Returns True if a dependency ("type:jobid:jobid...", as for sbatch --dependency) is
+    satisfied, False if it never can be, and None if it's still pending.
+
+    Usage: dependency_state("afterok:local-0:local-1")
+
+    Notes: Supports afterok (all jobs succeeded), afternotok (all jobs failed or were
+           cancelled), and afterany. Unknown jobids are taken to have succeeded.
+
+    """
+
+    if depend is None:
+        return True
+
+    fields = depend.split(":")
+
+    if len([jobid for jobid in fields[1:] if (jobid not in FINISHED) and (jobid.startswith("local-"))]) > 0:
+        return None
+
+    codes = [FINISHED.get(jobid, 0) for jobid in fields[1:]]
+
+    if fields[0] == "afterok":
+        return all([code == 0 for code in codes])
+    elif fields[0] == "afternotok":
+        return all([code != 0 for code in codes])
+
+    return True
+
+
+def schedule():
+
+    """
+
+    Reaps finished jobs and starts queued jobs while cores are free.
+
+    Usage: schedule()
+
+    Notes: Jobs are started in submission order, but a job that doesn't fit in the free
+           cores doesn't hold up smaller jobs behind it (backfill). Jobs wait for their
+           dependencies, and are cancelled if they can't be satisfied. Each job is run
+           with bash from its work directory, with output to its -o file (see 
+           job_output), as for SLURM jobs created by helpers.create_and_launch_job.
+
+    """
+
+    for jobid in list(RUNNING):
+
+        code = RUNNING[jobid][0].poll()
+
+        if code is not None:
+            FINISHED[jobid] = code
+            del RUNNING[jobid]
+
+    free = LOCAL_CORES - sum([RUNNING[jobid][1] for jobid in RUNNING])
+
+    for job in list(QUEUED):
+
+        jobid, work_dir, job_file, cores, depend = job
+
+        ready = dependency_state(depend)
+
+        if ready is False:
+            FINISHED[jobid] = None
+            QUEUED.remove(job)
+            continue
+
+        if (ready is None) or (cores > free):
+            continue
+
+        stdout = open(work_dir + "/" + job_output(work_dir + "/" + job_file), 'w')
+
+        RUNNING[jobid] = [subprocess.Popen(["bash", job_file], cwd=work_dir, stdout=stdout, stderr=subprocess.STDOUT), cores]
+
+        stdout.close()
+
+        QUEUED.remove(job)
+
+        free -= cores
+
+
+def submit(job_file, depend=None):
+
+    """
+
+    Queues a job file from the current directory, and returns its (synthetic) jobid.
+
+    Usage: jobid = submit("run.cmd") or submit("run.cmd", "afterok:local-0")
+
+    Notes: Jobs requesting more than LOCAL_CORES cores are run on LOCAL_CORES cores.
+           See dependency_state for supported dependencies.
+
+    """
+
+    global NEXT_ID
+
+    cores = job_cores(job_file)
+
+    if cores > LOCAL_CORES:
+        print("WARNING: Job", os.getcwd() + "/" + job_file, "requests", cores, "cores; only", LOCAL_CORES, "are available. Running on", LOCAL_CORES)
+        cores = LOCAL_CORES
+
+    jobid    = "local-" + str(NEXT_ID)
+    NEXT_ID += 1
+
+    QUEUED.append([jobid, os.getcwd(), job_file, cores, depend])
+
+    schedule()
+
+    return jobid
+
+
+def query_active_jobs(jobids):
+
+    """
+
+    Returns the subset of jobids that are still queued or running.
+
+    Usage: active = query_active_jobs(["local-0", "local-1"])
+
+    Notes: Counterpart of helpers.query_active_jobs; also advances the schedule.
+
+    """
+
+    schedule()
+
+    queued = [job[0] for job in QUEUED]
+
+    return [jobid for jobid in jobids if (jobid in RUNNING) or (jobid in queued)]
+
+
+def query_exit_states(jobids):
+
+    """
+
+    Returns {jobid: [state, exit code]} for a list of jobids, using SLURM state names.
+
+    Usage: states = query_exit_states(["local-0", "local-1"])
+
+    Notes: Counterpart of helpers.query_exit_states. Unknown jobids are UNKNOWN.
+
+    """
+
+    states = {}
+
+    for jobid in jobids:
+
+        if jobid not in FINISHED:
+            states[jobid] = ["UNKNOWN", None]
+        elif FINISHED[jobid] is None:
+            states[jobid] = ["CANCELLED", None]
+        elif FINISHED[jobid] == 0:
+            states[jobid] = ["COMPLETED", "0:0"]
+        else:
+            states[jobid] = ["FAILED", str(FINISHED[jobid]) + ":0"]
+
+    return states
@@ -7,7 +7,9 @@ import glob
 # Local modules
 
 import helpers
+import local_sched
 import gen_ff
+import planner
 import run_md
 import cluster
 import gen_selections
@@ -137,6 +139,9 @@ def main(args):
     
     verify_config.verify(config)
     
+    if config.HPC_SYSTEM == "local":
+        local_sched.set_cores(config.HPC_LOCAL_CORES)
+    
     print("The following has been set as the working directory:")
     print('\t', config.WORKING_DIR)
     print("The ALC-X contents of this directory will be overwritten.")
@@ -227,6 +232,13 @@ def main(args):
         config.USE_AL_STRS = ALC_LIST[-1]+1 # Set to one greater than the number of requested ALCs
 
 
+    # If requested, build_amat and solve_amat jobs are sized from the run history (see planner.plan)
+    
+    plan_history = None
+    
+    if config.PLAN_RESOURCES:
+        plan_history = config.WORKING_DIR + "/resource_history.dat"
+
     for THIS_ALC in ALC_LIST:
 
         THIS_ALC = int(THIS_ALC)
@@ -285,6 +297,9 @@ def main(args):
                         correction_files   = config.CORRECTED_TYPE_FILES,
                         correction_exe     = config.CORRECTED_TYPE_EXE,
                         correction_temps   = config.CORRECTED_TEMPS_BY_FILE,                        
+                        subtract_batch     = config.SUBTRACT_BATCH,
+                        subtract_nproc     = config.SUBTRACT_NPROC,
+                        subtract_cache     = config.SUBTRACT_CACHE,
                         prev_gen_path      = config.ALC0_FILES,
                         job_email          = config.HPC_EMAIL,
                         job_ppn            = str(config.HPC_PPN),
@@ -296,6 +311,9 @@ def main(args):
                         job_executable     = config.CHIMES_LSQ)
                         
                 helpers.wait_for_job(active_job, job_system = config.HPC_SYSTEM, verbose = True, job_name = "build_amat")
+                
+                if plan_history is not None:
+                    planner.record(plan_history, THIS_ALC, "build", gen_ff.amat_shape(False), config.CHIMES_BUILD_NODES, config.HPC_PPN, [active_job], job_system = config.HPC_SYSTEM)
 
                 restart_controller.update_file("BUILD_AMAT: COMPLETE" + '\n')
                 
@@ -305,6 +323,8 @@ def main(args):
 
             if not restart_controller.SOLVE_AMAT:
             
+                solve_jobs = [] # For the run history
+                
                 if not gen_ff.solve_amat_started(): 
                 
                     print("Starting solve_amat from scratch")            
@@ -320,6 +340,18 @@ def main(args):
                         regression_alg     = config.REGRESS_ALG,
                         regression_nrm     = config.REGRESS_NRM,
                         regression_var     = config.REGRESS_VAR,
+                        amat_store         = config.AMAT_STORE,
+                        split_nproc        = config.AMAT_SPLIT_NPROC,
+                        solve_local        = config.CHIMES_SOLVE_LOCAL,
+                        solve_local_max    = config.CHIMES_LOCAL_MAX,
+                        prune_columns      = config.AMAT_PRUNE,
+                        plan_history       = plan_history,
+                        plan_max_nodes     = config.PLAN_MAX_NODES,
+                        plan_max_time      = config.PLAN_MAX_TIME,
+                        plan_node_mem      = config.PLAN_NODE_MEM,
+                        regression_sweep   = config.REGRESS_SWEEP,
+                        regression_holdout = config.REGRESS_HOLDOUT,
+                        regression_warm    = config.REGRESS_WARM,
                         job_email          = config.HPC_EMAIL,
                         job_ppn            = str(config.HPC_PPN),
                         node_ppn           = config.HPC_PPN,
@@ -331,6 +363,8 @@ def main(args):
                         job_executable     = config.CHIMES_SOLVER)    
                         
                     helpers.wait_for_job(active_job, job_system = config.HPC_SYSTEM, verbose = True, job_name = "solve_amat")
+                    
+                    solve_jobs.append(active_job)
 
                 
                 # Check whether the amat_solve job has completed and keep track of how many times it has run
@@ -359,6 +393,17 @@ def main(args):
                     
                     helpers.wait_for_job(active_job, job_system = config.HPC_SYSTEM, verbose = True, job_name = "restart_solve_amat")
                     
+                    solve_jobs.append(active_job)
+                    
+                # If the A-matrix was pruned, expand x.txt back to full length and regenerate params.txt
+                
+                gen_ff.expand_pruned_solution(job_executable = config.CHIMES_SOLVER)
+                
+                if plan_history is not None:
+                    solve_nodes = planner.read_plan("GEN_FF/plan.txt", config.CHIMES_SOLVE_NODES, config.CHIMES_SOLVE_TIME)[0]
+                    
+                    planner.record(plan_history, THIS_ALC, "solve", gen_ff.amat_shape(), solve_nodes, config.CHIMES_SOLVE_PPN, [job for job in solve_jobs if job is not None], job_system = config.HPC_SYSTEM)
+                    
 
                 #if n_restarts > 0: # Then we need to manually build the parameter file
 
@@ -527,6 +572,9 @@ def main(args):
     
                 qm_driver.cleanup_and_setup(config.BULK_QM_METHOD, config.IGAS_QM_METHOD, ["all"], build_dir=".") # Always clean up, just in case    
 
+                helpers.begin_job_array(config.HPC_JOB_ARRAYS)
+                helpers.begin_job_chain(config.HPC_JOB_CHAIN)
+
                 active_jobs = qm_driver.setup_qm(THIS_ALC,config.BULK_QM_METHOD, config.IGAS_QM_METHOD, 
                         ["all"], 
                         config.ATOM_TYPES,
@@ -580,6 +628,9 @@ def main(args):
                         job_system     = config.HPC_SYSTEM,
                         job_email      = config.HPC_EMAIL)
 
+                active_jobs = helpers.submit_job_array(active_jobs, job_name = "ALC-" + str(THIS_ALC) + "-qm", job_system = config.HPC_SYSTEM, job_array_max = config.HPC_ARRAY_MAX)
+                active_jobs += helpers.end_job_chain()
+
                 helpers.wait_for_jobs(active_jobs, job_system = config.HPC_SYSTEM, verbose = True, job_name = "setup_qm")
 
                 restart_controller.update_file("INIT_QMJOB: COMPLETE" + '\n')    
@@ -595,9 +646,13 @@ def main(args):
 
                 while True:
 
+                    helpers.begin_job_array(config.HPC_JOB_ARRAYS)
+
                     active_jobs = qm_driver.continue_job(config.BULK_QM_METHOD, config.IGAS_QM_METHOD, 
                             ["all"], 
                             job_system     = config.HPC_SYSTEM)
+
+                    active_jobs = helpers.submit_job_array(active_jobs, job_name = "ALC-" + str(THIS_ALC) + "-qm-restarts", job_system = config.HPC_SYSTEM, job_array_max = config.HPC_ARRAY_MAX)
                             
                     print("active jobs: ", active_jobs)            
                             
@@ -633,9 +688,13 @@ def main(args):
 
                     while True:
 
+                        helpers.begin_job_array(config.HPC_JOB_ARRAYS)
+
                         active_jobs = qm_driver.continue_job(config.BULK_QM_METHOD, config.IGAS_QM_METHOD, 
                                 ["all"], 
                                 job_system     = config.HPC_SYSTEM)
+
+                        active_jobs = helpers.submit_job_array(active_jobs, job_name = "ALC-" + str(THIS_ALC) + "-qm-re-runs", job_system = config.HPC_SYSTEM, job_array_max = config.HPC_ARRAY_MAX)
                                 
                         print("active jobs: ", active_jobs)            
                                 
@@ -729,6 +788,12 @@ def main(args):
                 if THIS_ALC >= config.USE_AL_STRS:
                     do_stress = True
                 
+                build_nodes = config.CHIMES_BUILD_NODES
+                build_time  = config.CHIMES_BUILD_TIME
+                
+                if plan_history is not None:
+                    build_nodes, build_time = planner.plan(plan_history, "build", None, config.HPC_PPN, config.CHIMES_BUILD_NODES, config.PLAN_MAX_NODES, config.CHIMES_BUILD_TIME, config.PLAN_MAX_TIME, config.PLAN_NODE_MEM)
+                
                 if (not config.DO_CLUSTER) and (THIS_ALC == 1):    
                 
                     active_jobs = gen_ff.build_amat(THIS_ALC,
@@ -741,13 +806,16 @@ def main(args):
                             correction_files   = config.CORRECTED_TYPE_FILES,
                             correction_exe     = config.CORRECTED_TYPE_EXE,                            
                             correction_temps   = config.CORRECTED_TEMPS_BY_FILE,                            
+                            subtract_batch     = config.SUBTRACT_BATCH,
+                            subtract_nproc     = config.SUBTRACT_NPROC,
+                            subtract_cache     = config.SUBTRACT_CACHE,
                             n_hyper_sets       = config.N_HYPER_SETS,
                             do_cluster         = config.DO_CLUSTER,
                             prev_gen_path      = config.ALC0_FILES,
                             job_email          = config.HPC_EMAIL,
                             job_ppn            = str(config.HPC_PPN),
-                            job_nodes          = config.CHIMES_BUILD_NODES,
-                            job_walltime       = config.CHIMES_BUILD_TIME,    
+                            job_nodes          = build_nodes,
+                            job_walltime       = build_time,    
                             job_queue          = config.CHIMES_BUILD_QUEUE,        
                             job_account        = config.HPC_ACCOUNT, 
                             job_system         = config.HPC_SYSTEM,
@@ -767,14 +835,17 @@ def main(args):
                         correction_files = config.CORRECTED_TYPE_FILES,
                         correction_exe   = config.CORRECTED_TYPE_EXE,                            
                         correction_temps = config.CORRECTED_TEMPS_BY_FILE,  
+                        subtract_batch   = config.SUBTRACT_BATCH,
+                        subtract_nproc   = config.SUBTRACT_NPROC,
+                        subtract_cache   = config.SUBTRACT_CACHE,
                         n_hyper_sets     = config.N_HYPER_SETS,                      
                         do_cluster       = config.DO_CLUSTER,
                         include_stress   = do_stress,    
                         stress_style     = config.STRS_STYLE,
                         job_email        = config.HPC_EMAIL,
                         job_ppn          = str(config.HPC_PPN),
-                        job_nodes        = config.CHIMES_BUILD_NODES,
-                        job_walltime     = config.CHIMES_BUILD_TIME,    
+                        job_nodes        = build_nodes,
+                        job_walltime     = build_time,    
                         job_queue        = config.CHIMES_BUILD_QUEUE,                        
                         job_account      = config.HPC_ACCOUNT, 
                         job_system       = config.HPC_SYSTEM,
@@ -786,6 +857,9 @@ def main(args):
                     helpers.wait_for_job(active_jobs[0], job_system = config.HPC_SYSTEM, verbose = True, job_name = "build_amat")
                 else:
                     helpers.wait_for_jobs(active_jobs, job_system = config.HPC_SYSTEM, verbose = True, job_name = "build_amat")                    
+                    
+                if plan_history is not None:
+                    planner.record(plan_history, THIS_ALC, "build", gen_ff.amat_shape(False, config.N_HYPER_SETS), build_nodes, config.HPC_PPN, active_jobs, job_system = config.HPC_SYSTEM)
             
                 restart_controller.update_file("BUILD_AMAT: COMPLETE" + '\n')
                 
@@ -799,6 +873,8 @@ def main(args):
                 # Check whether we have previously started 
                 # only works for dlasso/dlars... for all other algorithms, assumes false
             
+                solve_jobs = [] # For the run history
+                
                 if not gen_ff.solve_amat_started(config.N_HYPER_SETS): 
                     print("Starting solve_amat from scratch")
             
@@ -814,6 +890,18 @@ def main(args):
                         regression_alg     = config.REGRESS_ALG,
                         regression_nrm     = config.REGRESS_NRM,
                         regression_var     = config.REGRESS_VAR,  
+                        amat_store         = config.AMAT_STORE,
+                        split_nproc        = config.AMAT_SPLIT_NPROC,
+                        solve_local        = config.CHIMES_SOLVE_LOCAL,
+                        solve_local_max    = config.CHIMES_LOCAL_MAX,
+                        prune_columns      = config.AMAT_PRUNE,
+                        plan_history       = plan_history,
+                        plan_max_nodes     = config.PLAN_MAX_NODES,
+                        plan_max_time      = config.PLAN_MAX_TIME,
+                        plan_node_mem      = config.PLAN_NODE_MEM,
+                        regression_sweep   = config.REGRESS_SWEEP,
+                        regression_holdout = config.REGRESS_HOLDOUT,
+                        regression_warm    = config.REGRESS_WARM,
 			            n_hyper_sets       = config.N_HYPER_SETS,  
                         job_email          = config.HPC_EMAIL,                    
                         job_ppn            = config.CHIMES_SOLVE_PPN,
@@ -828,6 +916,8 @@ def main(args):
                         )    
                         
                     helpers.wait_for_job(active_job, job_system = config.HPC_SYSTEM, verbose = True, job_name = "solve_amat")
+                    
+                    solve_jobs.append(active_job)
                 
                 # Check whether the amat_solve job has completed and keep track of how many times it has run
 
@@ -856,12 +946,24 @@ def main(args):
                         )    
                     
                     helpers.wait_for_job(active_job, job_system = config.HPC_SYSTEM, verbose = True, job_name = "restart_solve_amat")
+                    
+                    solve_jobs.append(active_job)
+                    
+                # If the A-matrix was pruned, expand x.txt back to full length and regenerate params.txt
+                
+                gen_ff.expand_pruned_solution(job_executable = config.CHIMES_SOLVER)
+                
+                if plan_history is not None:
+                    solve_nodes = planner.read_plan("GEN_FF/plan.txt", config.CHIMES_SOLVE_NODES, config.CHIMES_SOLVE_TIME)[0]
+                    
+                    planner.record(plan_history, THIS_ALC, "solve", gen_ff.amat_shape(), solve_nodes, config.CHIMES_SOLVE_PPN, [job for job in solve_jobs if job is not None], job_system = config.HPC_SYSTEM)
                 
                 if config.N_HYPER_SETS > 1:
                 
                     gen_ff.parse_hyper_params(
                         n_hyper_sets     = config.N_HYPER_SETS, 
-                        job_executable   = config.CHIMES_SOLVER
+                        job_executable   = config.CHIMES_SOLVER,
+                        nworkers         = config.AMAT_SPLIT_NPROC
                         )
                     
                 
@@ -922,6 +1024,8 @@ def main(args):
             
                 active_jobs = []
                 
+                helpers.begin_job_array(config.HPC_JOB_ARRAYS)
+                
                 #print "running for cases:", config.NO_CASES
 
                 for THIS_CASE in range(config.NO_CASES):
@@ -949,6 +1053,8 @@ def main(args):
         
                     active_jobs.append(active_job.split()[0])    
                                     
+                active_jobs = helpers.submit_job_array(active_jobs, job_name = "ALC-" + str(THIS_ALC) + "-md", job_system = config.HPC_SYSTEM, job_array_max = config.HPC_ARRAY_MAX)
+
                 helpers.wait_for_jobs(active_jobs, job_system = config.HPC_SYSTEM, verbose = True, job_name = "run_md")
 
                 restart_controller.update_file("RUN_MD: COMPLETE" + '\n')
@@ -1096,6 +1202,9 @@ def main(args):
 
                 qm_driver.cleanup_and_setup(config.BULK_QM_METHOD, config.IGAS_QM_METHOD, tasks, build_dir=".")
                 
+                helpers.begin_job_array(config.HPC_JOB_ARRAYS)
+                helpers.begin_job_chain(config.HPC_JOB_CHAIN)
+                
                 for THIS_CASE in range(config.NO_CASES):
 
                     qm_driver  .cleanup_and_setup(config.BULK_QM_METHOD, config.IGAS_QM_METHOD, tasks, THIS_CASE, build_dir=".") # Always clean up, just in case
@@ -1155,6 +1264,9 @@ def main(args):
                                                     
                     active_jobs += active_job
 
+                active_jobs = helpers.submit_job_array(active_jobs, job_name = "ALC-" + str(THIS_ALC) + "-qm", job_system = config.HPC_SYSTEM, job_array_max = config.HPC_ARRAY_MAX)
+                active_jobs += helpers.end_job_chain()
+
                 helpers.wait_for_jobs(active_jobs, job_system = config.HPC_SYSTEM, verbose = True, job_name = "setup_qm")
             
                 restart_controller.update_file("INIT_QMJOB: COMPLETE" + '\n')
@@ -1170,6 +1282,8 @@ def main(args):
                 
                     active_jobs = []
                 
+                    helpers.begin_job_array(config.HPC_JOB_ARRAYS)
+                
                     for THIS_CASE in range(config.NO_CASES):
 
                         active_job = qm_driver.continue_job(config.BULK_QM_METHOD, config.IGAS_QM_METHOD, tasks, THIS_CASE, 
@@ -1177,6 +1291,8 @@ def main(args):
                                 
                         active_jobs += active_job
                                 
+                    active_jobs = helpers.submit_job_array(active_jobs, job_name = "ALC-" + str(THIS_ALC) + "-qm-restarts", job_system = config.HPC_SYSTEM, job_array_max = config.HPC_ARRAY_MAX)
+
                     print("active jobs: ", active_jobs)            
                                 
                     if len(active_jobs) > 0:
@@ -1208,6 +1324,8 @@ def main(args):
                 
                         active_jobs = []
                 
+                        helpers.begin_job_array(config.HPC_JOB_ARRAYS)
+                
                         for THIS_CASE in range(config.NO_CASES):
 
                             # FIXED
@@ -1216,6 +1334,8 @@ def main(args):
                                     
                             active_jobs += active_job
                                     
+                        active_jobs = helpers.submit_job_array(active_jobs, job_name = "ALC-" + str(THIS_ALC) + "-qm-re-runs", job_system = config.HPC_SYSTEM, job_array_max = config.HPC_ARRAY_MAX)
+
                         print("active jobs: ", active_jobs)            
                                     
                         if len(active_jobs) > 0:
@@ -1,5 +1,10 @@
 import sys
 import os
+import glob
+import struct
+import fcntl
+import hashlib
+import multiprocessing
 import helpers
 import chimes_modify_FES
 import dftbplus_modify_FES
@@ -23,6 +28,8 @@ def write_full_FES(traj_files):
     
     Creates a b-labeled.txt file for a given set of trajectories
     
+    Notes: Each trajectory file is streamed frame by frame, in a single pass.
+    
     """
     
     kcalpermolAng2HperB = 1/627.50960803/1.889725989 # Multiply a value in kcal/mol/Ang by this to get H/B
@@ -46,82 +53,197 @@ def write_full_FES(traj_files):
         box_type, stress_type, energy_type = get_format(traj_files[i])
     
         # Process file frame by frame...
-        
-        natoms_per_frame = helpers.list_natoms(traj_files[i])
-        nframes          = helpers.count_xyzframes_general(traj_files[i])
-        
-        ener = [None]*nframes
-        sxx  = [None]*nframes; syy = [None]*nframes; szz = [None]*nframes; sxy = [None]*nframes; sxz = [None]*nframes; syz = [None]*nframes;
 
-        start_line = 0
+        for contents in helpers.read_xyzframes(traj_files[i]):
 
-        for j in range(nframes):
-    
-            frame_fx = [0.0]*natoms_per_frame[j]
-            frame_fy = [0.0]*natoms_per_frame[j]
-            frame_fz = [0.0]*natoms_per_frame[j]
-
-            # Parse and store info from the input.xyzf file
-    
-            nlines = 2+natoms_per_frame[j]
+            boxline, stress, ener = split_header(contents[1], stress_type, energy_type)
 
-            contents = helpers.readlines(traj_files[i],start_line, start_line+nlines)
-                        
-            start_line += nlines
+            for k in range(2,len(contents)):
             
-            boxline = contents[1].split()
-            
-            if energy_type == "yes":
-                ener[j] = float(boxline.pop())
-    
-            if stress_type == "all":
-                syz[j] = float(boxline.pop())
-                sxz[j] = float(boxline.pop())
-                sxy[j] = float(boxline.pop())
-    
-            if stress_type != "no":
-                szz[j] = float(boxline.pop())
-                syy[j] = float(boxline.pop())
-                sxx[j] = float(boxline.pop())            
-                
-
-            for k in range(natoms_per_frame[j]):
-            
-                line = contents[k+2].split()
+                line = contents[k].split()
 
                 full.write(line[0] + " " + str(float(line[4])/kcalpermolAng2HperB) + "\n")
                 full.write(line[0] + " " + str(float(line[5])/kcalpermolAng2HperB) + "\n")
                 full.write(line[0] + " " + str(float(line[6])/kcalpermolAng2HperB) + "\n")
 
             from_GPa = 6.9479
-	    
-            if stress_type == "all":	    
-                full.write("s_xx " + str(sxx[j]/from_GPa) + "\n")
-                full.write("s_xy " + str(sxy[j]/from_GPa) + "\n")
-                full.write("s_xz " + str(sxz[j]/from_GPa) + "\n")
-                full.write("s_yx " + str(sxy[j]/from_GPa) + "\n")
-                full.write("s_yy " + str(syy[j]/from_GPa) + "\n")
-                full.write("s_yz " + str(syz[j]/from_GPa) + "\n")
-                full.write("s_zx " + str(sxz[j]/from_GPa) + "\n")
-                full.write("s_zy " + str(syz[j]/from_GPa) + "\n")
-                full.write("s_zz " + str(szz[j]/from_GPa) + "\n")
-
-            elif stress_type != "no":	    
-                full.write("s_xx " + str(sxx[j]/from_GPa) + "\n")
-                full.write("s_yy " + str(syy[j]/from_GPa) + "\n")
-                full.write("s_zz " + str(szz[j]/from_GPa) + "\n")
-
-
-		
-            if energy_type == "yes":	    
-                full.write("+1 "  + str(ener[j]) + "\n")
-                full.write("+1 "  + str(ener[j]) + "\n")
-                full.write("+1 "  + str(ener[j]) + "\n")
+            
+            if stress_type == "all":
+                full.write("s_xx " + str(stress[0]/from_GPa) + "\n")
+                full.write("s_xy " + str(stress[3]/from_GPa) + "\n")
+                full.write("s_xz " + str(stress[4]/from_GPa) + "\n")
+                full.write("s_yx " + str(stress[3]/from_GPa) + "\n")
+                full.write("s_yy " + str(stress[1]/from_GPa) + "\n")
+                full.write("s_yz " + str(stress[5]/from_GPa) + "\n")
+                full.write("s_zx " + str(stress[4]/from_GPa) + "\n")
+                full.write("s_zy " + str(stress[5]/from_GPa) + "\n")
+                full.write("s_zz " + str(stress[2]/from_GPa) + "\n")
+
+            elif stress_type != "no":
+                full.write("s_xx " + str(stress[0]/from_GPa) + "\n")
+                full.write("s_yy " + str(stress[1]/from_GPa) + "\n")
+                full.write("s_zz " + str(stress[2]/from_GPa) + "\n")
+
+            if energy_type == "yes":
+                full.write("+1 "  + str(ener) + "\n")
+                full.write("+1 "  + str(ener) + "\n")
+                full.write("+1 "  + str(ener) + "\n")
             
         full.close()
 
 
-def subtract_off(param_file, md_driver, method, traj_files, temper_files=None):
+def split_header(header, stress_type, energy_type):
+
+    """
+    
+    Splits a .xyzf frame header (comment) line into its box, stress, and energy fields.
+    
+    Returns:
+        1. The remaining (box) fields, as a list of strings
+        2. Stresses as floats, ordered xx, yy, zz, xy, xz, yz (None where absent)
+        3. The energy as a float (None if absent)
+    
+    Usage: split_header(contents[1], stress_type, energy_type)
+    
+    """
+
+    boxline = header.split()
+    stress  = [None]*6
+    ener    = None
+    
+    if energy_type == "yes":
+        ener = float(boxline.pop())
+    
+    if stress_type == "all":
+        stress[5] = float(boxline.pop())
+        stress[4] = float(boxline.pop())
+        stress[3] = float(boxline.pop())
+    
+    if stress_type != "no":
+        stress[2] = float(boxline.pop())
+        stress[1] = float(boxline.pop())
+        stress[0] = float(boxline.pop())
+        
+    return boxline, stress, ener
+
+
+def strip_frame(contents, atmtyps):
+
+    """
+    
+    Removes atoms not described by a parameter file from a .xyzf frame.
+    
+    Returns the stripped frame (as a list of lines, with an updated atom count) 
+    and a list of booleans flagging which of the frame's atoms were kept.
+    
+    Usage: strip_frame(contents, ["C","H"])
+    
+    """
+
+    kept     = [contents[k].split()[0] in atmtyps for k in range(2,len(contents))]
+    stripped = [contents[k+2] for k in range(len(kept)) if kept[k]]
+    
+    return [str(len(stripped)) + '\n', contents[1]] + stripped, kept
+
+
+def subtract_frame(contents, kept, stress_type, energy_type, tmp_ener, tmp_stress, tmp_forces):
+
+    """
+    
+    Subtracts force/energy/stress contributions from a single .xyzf frame.
+    
+    Returns:
+        1. The modified frame, as a list of lines
+        2. The subtracted contributions, as a list of b-labeled-style lines
+    
+    Usage: subtract_frame(contents, kept, stress_type, energy_type, tmp_ener, tmp_stress, tmp_forces)
+    
+    Notes: kept is as returned by strip_frame. tmp_forces are in kcal/mol/Ang (one 
+           component per entry, as lines of forceout.txt or as numbers, e.g. from a
+           ContributionCache) and are ordered as the kept atoms. Removed forces are 
+           written as str(float), so the output doesn't depend on which was given.
+           Atoms that weren't kept are written back unchanged.
+    
+    """
+
+    kcalpermolAng2HperB = 1/627.50960803/1.889725989 # Multiply a value in kcal/mol/Ang by this to get H/B
+    from_GPa            = 6.9479
+
+    boxline, stress, ener = split_header(contents[1], stress_type, energy_type)
+    
+    # Update the forces, energies, and stresses
+    
+    if energy_type == "yes":
+        ener -= tmp_ener
+        
+    if stress_type != "no":
+        for k in range(3):
+            stress[k] -= tmp_stress[k]
+        if stress_type == "all":
+            for k in range(3,6):
+                stress[k] -= tmp_stress[k]
+
+    frame   = [str(len(kept)) + '\n']
+    removed = []
+    
+    header = ' '.join(boxline) + ' '
+    
+    if stress_type == "all":
+        header += ' '.join([str(k) for k in stress]) + ' '
+    elif stress_type == "diag":
+        header += ' '.join([str(k) for k in stress[0:3]]) + ' '
+    if energy_type == "yes":
+        header += str(ener)
+        
+    frame.append(header + '\n')
+
+    force_idx = 0
+
+    for k in range(len(kept)):
+    
+        if not kept[k]: # Then this atom didn't exist in the parameter file - no modification to forces
+        
+            atmtyp = contents[k+2].split()[0]
+        
+            removed.append(atmtyp + " 0.0\n")
+            removed.append(atmtyp + " 0.0\n")
+            removed.append(atmtyp + " 0.0\n")
+            
+            frame.append(contents[k+2])
+            
+            continue
+            
+        line = contents[k+2].split()
+        
+        fx = str(float(line[4]) - float(tmp_forces[3*force_idx  ])*kcalpermolAng2HperB)
+        fy = str(float(line[5]) - float(tmp_forces[3*force_idx+1])*kcalpermolAng2HperB)
+        fz = str(float(line[6]) - float(tmp_forces[3*force_idx+2])*kcalpermolAng2HperB)
+        
+        removed.append(line[0] + " " + str(float(tmp_forces[3*force_idx  ])) + '\n')
+        removed.append(line[0] + " " + str(float(tmp_forces[3*force_idx+1])) + '\n')
+        removed.append(line[0] + " " + str(float(tmp_forces[3*force_idx+2])) + '\n')
+        
+        frame.append(' '.join(line[0:4]) + ' ' + fx + ' ' + fy + ' ' + fz + '\n')
+        
+        force_idx += 1
+        
+    removed.append("s_xx " + str(tmp_stress[0]/from_GPa) + "\n")
+    removed.append("s_xy " + str(tmp_stress[3]/from_GPa) + "\n")
+    removed.append("s_xz " + str(tmp_stress[4]/from_GPa) + "\n")
+    removed.append("s_yx " + str(tmp_stress[3]/from_GPa) + "\n")
+    removed.append("s_yy " + str(tmp_stress[1]/from_GPa) + "\n")
+    removed.append("s_yz " + str(tmp_stress[5]/from_GPa) + "\n")
+    removed.append("s_zx " + str(tmp_stress[4]/from_GPa) + "\n")
+    removed.append("s_zy " + str(tmp_stress[5]/from_GPa) + "\n")
+    removed.append("s_zz " + str(tmp_stress[2]/from_GPa) + "\n")
+    removed.append("+1 "  + str(tmp_ener)      + "\n")
+    removed.append("+1 "  + str(tmp_ener)      + "\n")
+    removed.append("+1 "  + str(tmp_ener)      + "\n")
+    
+    return frame, removed
+
+
+def subtract_off(param_files, md_driver, method, traj_files, temper_files=None, batch=False, nproc=1, cache=None):
 
     """
     
@@ -137,11 +259,21 @@ def subtract_off(param_file, md_driver, method, traj_files, temper_files=None):
     
     Notes: See function definition in modify_FES.py for a full list of options. 
            Expects to be run from ???? folder           
+           param_files can be a single parameter file or a list of them; contributions
+           from all of them are subtracted in the same pass, with one contribution log
+           (b-labeled_subtracted.<param file>.traj_file_idx-<i>.dat) per parameter file.
+           Each trajectory file is streamed frame by frame, in a single pass.
+           If batch is True, all frames of a trajectory file are instead evaluated
+           with a single call to the reference code (see get_FES_batch), and the 
+           file is streamed twice.
+           If nproc > 1, frames are instead evaluated in parallel, over nproc worker
+           processes (see evaluate_parallel).
+           If cache (a directory) is given, contributions are looked up in/added to
+           a persistent store there (see ContributionCache), and only frames not 
+           already in the store are evaluated.
     
     """
     
-    kcalpermolAng2HperB = 1/627.50960803/1.889725989 # Multiply a value in kcal/mol/Ang by this to get H/B
-
     try:
         traj_files = list(traj_files)
     except:
@@ -149,22 +281,33 @@ def subtract_off(param_file, md_driver, method, traj_files, temper_files=None):
         
     if temper_files is not None:
         temper_files = list(temper_files)
+        
+    if not isinstance(param_files,list):
+        param_files = [param_files]
     
-    # Read the parameter file and determine which atom types it describes
+    # Read the parameter files and determine which atom types they describe
     
-    atmtyps = None
+    atmtyps = []
+    stores  = []
     
-    if method == "CHIMES":
-        atmtyps = chimes_modify_FES.check_atomtypes(param_file)
-    elif method == "DFTB":
-        atmtyps = dftbplus_modify_FES.check_atomtypes(param_file)
-    elif method == "LMP":
-        atmtyps = lmp_modify_FES.check_atomtypes(param_file)
-    else:
-        print("ERROR: Unknown method in modify_FES.py:",method)
-
+    for param_file in param_files:
+    
+        if method == "CHIMES":
+            atmtyps.append(chimes_modify_FES.check_atomtypes(param_file))
+        elif method == "DFTB":
+            atmtyps.append(dftbplus_modify_FES.check_atomtypes(param_file))
+        elif method == "LMP":
+            atmtyps.append(lmp_modify_FES.check_atomtypes(param_file))
+        else:
+            print("ERROR: Unknown method in modify_FES.py:",method)
 
-    print("Ignoring all atom types except:", atmtyps)
+        print("Ignoring all atom types except:", atmtyps[-1], "for parameter file:", param_file)
+    
+        stores.append(None)
+    
+        if cache is not None:
+            stores[-1] = ContributionCache(cache, param_file, method)
+            print("Using contribution cache:", stores[-1].name, "(" + str(len(stores[-1])) + " entries)")
         
     # Process the trajectory file
     
@@ -182,178 +325,597 @@ def subtract_off(param_file, md_driver, method, traj_files, temper_files=None):
         helpers.run_bash_cmnd("rm -f subtracted.xyzf")
         ofstream = open("subtracted.xyzf",'a')
         
-        print("\t\tReading temperatures from:",temper_files[i])
+        temperatures = None
         
-        temperature = 0.0
         if temper_files is not None:
-            temperatures = helpers.readlines(temper_files[i])
+            print("\t\tReading temperatures from:",temper_files[i])
+            temperatures = [int(float(k)) for k in helpers.readlines(temper_files[i]) if k.strip()]
 
-        print("\t\tOpening file:","b-labeled_subtracted." + param_file.split("/")[-1] + ".traj_file_idx-" + str(i)  + ".dat")
-        helpers.run_bash_cmnd("rm -f b-labeled_subtracted." + param_file.split("/")[-1] + ".traj_file_idx-" + str(i)  + ".dat")
-        removed = open("b-labeled_subtracted." + param_file.split("/")[-1] + ".traj_file_idx-" + str(i)  + ".dat",'a')
+        removed = []
+
+        for param_file in param_files:
+            print("\t\tOpening file:","b-labeled_subtracted." + param_file.split("/")[-1] + ".traj_file_idx-" + str(i)  + ".dat")
+            helpers.run_bash_cmnd("rm -f b-labeled_subtracted." + param_file.split("/")[-1] + ".traj_file_idx-" + str(i)  + ".dat")
+            removed.append(open("b-labeled_subtracted." + param_file.split("/")[-1] + ".traj_file_idx-" + str(i)  + ".dat",'a'))
 
         # Figure out what options the target .xyzf file has
     
         box_type, stress_type, energy_type = get_format(traj_files[i])
-    
-        # Process file frame by frame...
         
-        natoms_per_frame = helpers.list_natoms(traj_files[i])
-        nframes          = helpers.count_xyzframes_general(traj_files[i])
+        # Process file in parallel/all at once, or frame by frame...
         
-        ener = [None]*nframes
-        sxx  = [None]*nframes; syy = [None]*nframes; szz = [None]*nframes; sxy = [None]*nframes; sxz = [None]*nframes; syz = [None]*nframes;
-        fx   = []; fy  = []; fz  = [];
+        if batch or (nproc > 1):
         
-        start_line = 0
-
-        for j in range(nframes):
-
-            frame_fx = [0.0]*natoms_per_frame[j]
-            frame_fy = [0.0]*natoms_per_frame[j]
-            frame_fz = [0.0]*natoms_per_frame[j]
-
-            # Parse and store info from the input.xyzf file
-    
-            nlines = 2+natoms_per_frame[j]
-
-            contents = helpers.readlines(traj_files[i],start_line, start_line+nlines)
-                        
-            start_line += nlines
+            helpers.run_bash_cmnd("rm -rf subtract_scratch")
+        
+            results = []
             
-            # Remove atoms not described by parameter file
+            for p in range(len(param_files)):
+                results.append(evaluate_frames(traj_files[i], atmtyps[p], param_files[p], md_driver, method, temperatures, stress_type, energy_type, batch, nproc, stores[p], "subtract_scratch/params-" + str(p)))
             
-            popped = 0
-            popped_data = []
-
-            for k in range(natoms_per_frame[j]+1,1,-1):
-
-                if contents[k].split()[0] not in atmtyps:
-                    popped_data.insert(0,contents.pop(k))
-                    frame_fx[k-2] = -1
-                    frame_fy[k-2] = -1
-                    frame_fz[k-2] = -1
-                    popped += 1
+            apply_contributions(traj_files[i], atmtyps, stress_type, energy_type, results, ofstream, removed, stores, temperatures)
+            
+            helpers.run_bash_cmnd("rm -rf subtract_scratch")
+            
+        else:
+            for j, contents in enumerate(helpers.read_xyzframes(traj_files[i])):
+            
+                temperature = None
+            
+                if temperatures is not None:
+                    temperature = temperatures[j]
+                    
+                for p in range(len(param_files)):
 
-            boxline = contents[1].split()
+                    # Remove atoms not described by parameter file
             
-            if energy_type == "yes":
-                ener[j] = float(boxline.pop())
+                    stripped, kept = strip_frame(contents, atmtyps[p])
+                    
+                    # Look up the corresponding F/E/S...
                 
-            if stress_type == "all":
-                syz[j] = float(boxline.pop())
-                sxz[j] = float(boxline.pop())
-                sxy[j] = float(boxline.pop())
+                    key = None
                 
-            if stress_type != "no":
-                szz[j] = float(boxline.pop())
-                syy[j] = float(boxline.pop())
-                sxx[j] = float(boxline.pop())            
+                    if stores[p] is not None:
+                        key = stores[p].key(stripped, stress_type, energy_type, temperature)
+                    
+                    if (key is not None) and (key in stores[p]):
+                
+                        tmp_ener, tmp_stress, tmp_forces = stores[p].get(key)
+                
+                    else:
                 
-            # Save the frame to a temporary .xyz file
+                        # ... or obtain them from the reference md code, via a temporary .xyz file
+                    
+                        helpers.writelines("tmp.xyz",stripped)
+            
+                        print("\t\t\t Running file:",traj_files[i],"frame",j, "with T = ",temperature, "for parameter file:", param_files[p])
+
+                        tmp_ener, tmp_stress, force_file = get_FES("tmp.xyz",param_files[p], md_driver, method, temperature) 
 
-            contents[0] = str(natoms_per_frame[j]-popped) +'\n'
+                        tmp_forces = helpers.readlines(force_file)
+                    
+                        if stores[p] is not None:
+                            stores[p].put(key, tmp_ener, tmp_stress, tmp_forces)
+            
+                    # Subtract the contributions, save them
+            
+                    contents, contributions = subtract_frame(contents, kept, stress_type, energy_type, tmp_ener, tmp_stress, tmp_forces)
             
-            helpers.writelines("tmp.xyz",contents)
+                    removed[p].write(''.join(contributions))
+                    
+                # Output the modified frame
+                
+                ofstream.write(''.join(contents))
                 
-            # Obtain the corresponding F/E/S from the reference md code
+        ofstream.close()
+        
+        for p in range(len(param_files)):
+            removed[p].close()
             
-            print("\t\t\t Running file:",traj_files[i],"frame",j, "with T = ",int(float(temperatures[j])))
+        helpers.run_bash_cmnd("cp " + traj_files[i] + " " + traj_files[i] + ".original")
+        helpers.run_bash_cmnd("mv subtracted.xyzf " + traj_files[i])
+        
+    for store in stores:
+        if store is not None:
+            store.close()
+
 
-            tmp_ener, tmp_stress, force_file = get_FES("tmp.xyz",param_file, md_driver, method, int(float(temperatures[j]))) 
+def evaluate_frames(traj_file, atmtyps, param_file, md_driver, method, temperatures, stress_type, energy_type, batch=False, nproc=1, store=None, scratch="subtract_scratch"):
 
-            tmp_forces = helpers.readlines(force_file)
+    """
+    
+    Evaluates contributions for all frames of traj_file up front, rather than frame by frame:
+    Writes all (stripped) frames to <scratch>/frames.xyz, then evaluates them from within 
+    scratch with a single call to get_FES_batch (batch), or over nproc worker processes 
+    (see evaluate_parallel).
+    
+    Returns a list of (energies, stresses, force file) tuples, as returned by get_FES_batch,
+    for consecutive chunks of frames covering the whole file.
+    
+    Usage: evaluate_frames(traj_file, atmtyps, param_file, md_driver, method, temperatures, stress_type, energy_type, batch, nproc, store)
+    
+    Notes: If a ContributionCache is given as store, only frames missing from the store 
+           are evaluated, and their contributions are added to the store. The returned 
+           chunks then only cover those frames.
+           The scratch directory holds the returned force files, so should only be removed
+           once contributions have been applied.
+    
+    """
+    
+    # Evaluation runs from the scratch directory, so paths must be absolute
+    
+    scratch    = os.path.abspath(scratch)
+    param_file = os.path.abspath(param_file)
+    
+    md_driver = absolute_command(md_driver)
+        
+    os.makedirs(scratch)
+    
+    # Remove atoms not described by parameter file, save all frames to a temporary .xyz file
+    
+    tmpfile = open(scratch + "/frames.xyz",'w')
+    
+    temps   = None
+    keys    = []
+    pending = set()
+    natoms  = []
+    nframes = 0 # Number of frames to evaluate
+    ntotal  = 0 # Number of frames in traj_file
+    
+    if temperatures is not None:
+        temps = []
+    
+    for j, contents in enumerate(helpers.read_xyzframes(traj_file)):
+    
+        ntotal  += 1
+        stripped = strip_frame(contents, atmtyps)[0]
+        
+        temperature = None
+        
+        if temperatures is not None:
+            temperature = temperatures[j]
+        
+        if store is not None:
+        
+            key = store.key(stripped, stress_type, energy_type, temperature)
             
-            # Update the forces, energies, and stresses
+            if (key in store) or (key in pending):
+                continue
+                
+            pending.add(key)
+            keys   .append(key)
+            natoms .append(len(stripped)-2)
+        
+        tmpfile.write(''.join(stripped))
+        
+        if temps is not None:
+            temps.append(temperature)
             
-            if energy_type == "yes":
-                ener[j] -= tmp_ener     ; ener[j] = str(ener[j])
-            if stress_type != "no":
-                sxx [j] -= tmp_stress[0]; sxx [j] = str(sxx [j])
-                syy [j] -= tmp_stress[1]; syy [j] = str(syy [j])
-                szz [j] -= tmp_stress[2]; szz [j] = str(szz [j])
-                if stress_type == "all":
-                    sxy [j] -= tmp_stress[3]; sxy [j] = str(sxy [j])
-                    sxz [j] -= tmp_stress[4]; sxz [j] = str(sxz [j])
-                    syz [j] -= tmp_stress[5]; syz [j] = str(syz [j])
-            
-            contents_idx = 0            
-            popped_idx   = 0
+        nframes += 1
+        
+    tmpfile.close()
+    
+    # Obtain the corresponding F/E/S from the reference md code, for all frames
+    
+    if store is not None:
+        print("\t\t\t Found",ntotal-nframes,"of",ntotal,"frames of file:",traj_file,"in contribution cache")
+    
+    if nframes == 0:
+        return []
+        
+    try:
+    
+        if nproc > 1:
+    
+            results = evaluate_parallel(scratch + "/frames.xyz", param_file, md_driver, method, temps, nproc, batch, scratch)
+        
+        else:
+    
+            print("\t\t\t Running",nframes,"frames of file:",traj_file)
+    
+            results = [evaluate_chunk([scratch, param_file, md_driver, method, temps, batch])]
+            
+    except ChunkError as err_msg:
+        print("ERROR: Evaluation of frames from", traj_file, "failed:", err_msg)
+        print("Exiting.")
+        exit()
+    
+    if store is not None:
+    
+        j = 0
+        
+        for tmp_ener, tmp_stress, force_file in results:
+        
+            forces = open(force_file,'r')
+            
+            for k in range(len(tmp_ener)):
+                store.put(keys[j], tmp_ener[k], tmp_stress[k], [forces.readline() for m in range(3*natoms[j])])
+                j += 1
                 
+            forces.close()
+        
+    return results
+
+
+class ChunkError(Exception):
+
+    """ Raised by evaluate_chunk when the reference code fails, so that the caller can report it. """
 
-            for k in range(len(frame_fx)):
+
+def absolute_command(cmnd):
+
+    """
+    
+    Returns a command string with relative paths (e.g. the executable in "srun -n 1 ../lmp")
+    made absolute, so that it can be run from another directory.
+    
+    Usage: absolute_command("srun -n 1 ../lmp_mpi")
+    
+    Notes: Only tokens that contain a "/" and name an existing file or directory are 
+           changed; options, counts, and executables found through $PATH are left as-is.
+    
+    """
+    
+    tokens = cmnd.split(" ")
+    
+    for i in range(len(tokens)):
+        if ("/" in tokens[i]) and (not os.path.isabs(tokens[i])) and os.path.exists(tokens[i]):
+            tokens[i] = os.path.abspath(tokens[i])
             
-                if frame_fx[k] == -1: # Then this atom didn't exist in the parameter file - no modification to forces
-                
-                    popped_line = popped_data[popped_idx].split()
+    return ' '.join(tokens)
+
+
+def evaluate_parallel(xyz_file, param_file, md_driver, method, temperatures, nproc, batch=False, scratch="subtract_scratch"):
+
+    """
+    
+    Splits the frames of xyz_file into contiguous chunks, each written to its own scratch
+    directory, and evaluates the chunks over a pool of nproc worker processes. 
+    
+    Returns a list of (energies, stresses, force file) tuples, as returned by get_FES_batch,
+    one per chunk, in frame order.
+    
+    Usage: evaluate_parallel("frames.xyz", param_file, md_driver, method, temperatures, 36)
+    
+    Notes: Scratch directories are named <scratch>/chunk-<n>; they hold the returned 
+           force files, so should only be removed once contributions have been applied. 
+           If batch is True, each chunk is evaluated with get_FES_batch.
+           Raises ChunkError if any chunk fails (see evaluate_chunk).
+    
+    """
+    
+    nframes = helpers.count_xyzframes_general(xyz_file)
+    
+    if nframes == 0:
+        return []
+        
+    nchunks = min(nframes, 4*nproc) # A few chunks per worker, for load balancing
+    
+    # Workers run from their scratch directories, so paths must be absolute
+    
+    param_file = os.path.abspath(param_file)
+    
+    md_driver = absolute_command(md_driver)
+    
+    # Save each chunk's frames to its own scratch directory
+    
+    tasks   = []
+    tmpfile = None
+    
+    for j, contents in enumerate(helpers.read_xyzframes(xyz_file)):
+    
+        chunk = j*nchunks//nframes
+        
+        if len(tasks) == chunk:
+        
+            if tmpfile is not None:
+                tmpfile.close()
                 
-                    removed.write(popped_line[0] + " 0.0\n")
-                    removed.write(popped_line[0] + " 0.0\n")
-                    removed.write(popped_line[0] + " 0.0\n")
+            chunk_dir = os.path.abspath(scratch + "/chunk-" + str(chunk))
+            os.makedirs(chunk_dir)
+            
+            tasks.append([chunk_dir, param_file, md_driver, method, [], batch])
+            
+            if temperatures is None:
+                tasks[-1][4] = None
+            
+            tmpfile = open(chunk_dir + "/frames.xyz",'w')
+            
+        tmpfile.write(''.join(contents))
+        
+        if temperatures is not None:
+            tasks[-1][4].append(temperatures[j])
+            
+    tmpfile.close()
+    
+    # Obtain the corresponding F/E/S from the reference md code, for all chunks
+    
+    print("\t\t\t Running",nframes,"frames as",len(tasks),"chunks over",nproc,"processes")
+    
+    pool = multiprocessing.Pool(nproc)
+    
+    try:
+        results = pool.map(evaluate_chunk, tasks, 1)
+    except ChunkError:
+        pool.terminate() # Don't leave the remaining chunks running
+        raise
+        
+    pool.close()
+    pool.join()
+    
+    return results
+
+
 
-                    popped_idx += 1
+def evaluate_chunk(task):
+
+    """
     
-                    continue                    
-                else:
-                    line = contents[contents_idx+2].split()
-                    
-                    frame_fx[k] = str(float(line[4]) - float(tmp_forces[3*contents_idx  ])*kcalpermolAng2HperB)
-                    frame_fy[k] = str(float(line[5]) - float(tmp_forces[3*contents_idx+1])*kcalpermolAng2HperB)
-                    frame_fz[k] = str(float(line[6]) - float(tmp_forces[3*contents_idx+2])*kcalpermolAng2HperB)
+    Evaluates all frames in a directory's frames.xyz, from within that directory. 
+    Worker function for evaluate_parallel.
+    
+    Usage: evaluate_chunk([directory, param_file, md_driver, method, temperatures, batch])
+    
+    Notes: Returns a list of energies, a list of stress tensors (GPa), and the (absolute)
+           name of a file holding the forces for all frames in the chunk, i.e. as for
+           get_FES_batch. Raises ChunkError if the evaluation fails, including through
+           exit().
+    
+    """
+    
+    scratch, param_file, md_driver, method, temperatures, batch = task
+    
+    cwd = os.getcwd()
+    os.chdir(scratch)
+    
+    # The reference code wrappers exit() on failure; SystemExit would kill a pool worker 
+    # without a result, and leave Pool.map waiting forever
+    
+    try:
+    
+        if batch:
+    
+            tmp_ener, tmp_stress, force_file = get_FES_batch("frames.xyz", param_file, md_driver, method, temperatures)
+        
+        else:
+    
+            tmp_ener   = []
+            tmp_stress = []
+            force_file = "forceout-chunk.txt"
+        
+            ofstream = open(force_file,'w')
+        
+            for j, frame in enumerate(helpers.read_xyzframes("frames.xyz")):
+        
+                helpers.writelines("tmp.xyz", frame)
+            
+                temperature = None
+            
+                if temperatures is not None:
+                    temperature = temperatures[j]
+        
+                ener, stress, this_force_file = get_FES("tmp.xyz", param_file, md_driver, method, temperature)
+            
+                tmp_ener  .append(ener)
+                tmp_stress.append(stress)
+            
+                with open(this_force_file,'r') as ifstream:
+                    for line in ifstream:
+                        ofstream.write(line)
                     
-                    removed.write(line[0] + " " + tmp_forces[3*contents_idx  ])
-                    removed.write(line[0] + " " + tmp_forces[3*contents_idx+1])
-                    removed.write(line[0] + " " + tmp_forces[3*contents_idx+2])
+            ofstream.close()
+        
+        force_file = os.path.abspath(force_file)
+        
+    except (SystemExit, Exception) as err_msg:
+        raise ChunkError(scratch + ": " + (type(err_msg).__name__ + " " + str(err_msg)).strip())
+        
+    finally:
+        os.chdir(cwd)
+    
+    return tmp_ener, tmp_stress, force_file
 
-                    contents_idx += 1    
-                    
-            from_GPa = 6.9479
-                
-            removed.write("s_xx " + str(tmp_stress[0]/from_GPa) + "\n")
-            removed.write("s_xy " + str(tmp_stress[3]/from_GPa) + "\n")
-            removed.write("s_xz " + str(tmp_stress[4]/from_GPa) + "\n")
-            removed.write("s_yx " + str(tmp_stress[3]/from_GPa) + "\n")
-            removed.write("s_yy " + str(tmp_stress[1]/from_GPa) + "\n")
-            removed.write("s_yz " + str(tmp_stress[5]/from_GPa) + "\n")
-            removed.write("s_zx " + str(tmp_stress[4]/from_GPa) + "\n")
-            removed.write("s_zy " + str(tmp_stress[5]/from_GPa) + "\n")
-            removed.write("s_zz " + str(tmp_stress[2]/from_GPa) + "\n")
-            removed.write("+1 "  + str(tmp_ener)      + "\n")
-            removed.write("+1 "  + str(tmp_ener)      + "\n")
-            removed.write("+1 "  + str(tmp_ener)      + "\n")
-            
-            # Output the modified frame
-            
-            ofstream.write(str(natoms_per_frame[j]) + '\n')
-            ofstream.write(' '.join(boxline) + ' ')
+
+def apply_contributions(traj_file, atmtyps, stress_type, energy_type, results, ofstream, removed, stores=None, temperatures=None):
+
+    """
+    
+    Streams traj_file, subtracting precomputed contributions from each frame.
+    
+    Writes modified frames to ofstream and the subtracted contributions to removed. 
+    atmtyps, results, removed, and (optionally) stores are lists with one entry per 
+    parameter file, whose contributions are subtracted in turn. Each results entry is a
+    list of (energies, stresses, force file) tuples, as returned by evaluate_frames, 
+    for consecutive chunks of frames covering the whole file.
+    
+    Usage: apply_contributions(traj_file, [atmtyps], stress_type, energy_type, [results], ofstream, [removed])
+    
+    Notes: Where a ContributionCache is given in stores, contributions for that parameter
+           file are instead looked up in the store (keyed with temperatures), and the 
+           corresponding results entry is ignored.
+    
+    """
+    
+    if stores is None:
+        stores = [None]*len(results)
+    
+    chunk  = [0]   *len(results) # Index of chunk being read
+    offset = [0]   *len(results) # Index of first frame in chunk
+    forces = [None]*len(results)
+    
+    for j, contents in enumerate(helpers.read_xyzframes(traj_file)):
+    
+        for p in range(len(results)):
+    
+            stripped, kept = strip_frame(contents, atmtyps[p])
+        
+            if stores[p] is not None:
+        
+                temperature = None
             
-            if stress_type == "all":
-                ofstream.write(sxx[j] + ' ' + syy[j] + ' ' + szz[j] + ' ' + sxy[j] + ' ' + sxz[j] + ' ' + syz[j] + ' ')
-            elif stress_type == "diag":
-                ofstream.write(sxx[j] + ' ' + syy[j] + ' ' + szz[j] + ' ')
-            if energy_type == "yes":
-                ofstream.write(ener[j])
-            ofstream.write('\n')
+                if temperatures is not None:
+                    temperature = temperatures[j]
+        
+                tmp_ener, tmp_stress, tmp_forces = stores[p].get(stores[p].key(stripped, stress_type, energy_type, temperature))
+        
+            else:
+        
+                if forces[p] is None:
+                    forces[p] = open(results[p][chunk[p]][2],'r')
+        
+                elif j - offset[p] == len(results[p][chunk[p]][0]):
+                    forces[p].close()
+                    offset[p] += len(results[p][chunk[p]][0])
+                    chunk [p] += 1
+                    forces[p]  = open(results[p][chunk[p]][2],'r')
+        
+                tmp_ener   = results[p][chunk[p]][0][j-offset[p]]
+                tmp_stress = results[p][chunk[p]][1][j-offset[p]]
+                tmp_forces = [forces[p].readline() for k in range(3*(len(stripped)-2))]
+        
+            contents, contributions = subtract_frame(contents, kept, stress_type, energy_type, tmp_ener, tmp_stress, tmp_forces)
             
+            removed[p].write(''.join(contributions))
             
-            popped_idx   = 0
-            contents_idx = 0
+        ofstream.write(''.join(contents))
+        
+    for p in range(len(results)):
+        if forces[p] is not None:
+            forces[p].close()
+
+
+class ContributionCache:
+
+    """
+    
+    Persistent, content-addressed store of per-frame force/energy/stress contributions.
+    
+    Usage: store = modify_FES.ContributionCache("/path/to/cache", param_file, "CHIMES")
+    
+    Notes: One store file is kept per parameter file (hashed by content) and method, 
+           named <cache_dir>/<method>.<parameter file hash>.fescache. Entries are keyed 
+           by a hash of a (stripped) frame's cell, atom types and coordinates, and its 
+           electron temperature (see key). Each entry is a binary record holding the
+           key (20 bytes), atom count (int32), energy, 6 stresses (GPa), and 3*natoms 
+           forces (kcal/mol/Ang), as float64. Entries are only ever appended.
+           The file may be shared by several drivers: indexing (which drops a partially
+           written trailing entry) and appends hold an exclusive flock, so a reader 
+           never sees, or truncates, another writer's entry mid-write.
+    
+    """
+
+    def __init__(self, cache_dir, param_file, method):
+    
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+    
+        self.name   = os.path.join(cache_dir, method + "." + self.hash_params(param_file) + ".fescache")
+        self.header = struct.Struct("<20si7d")
+        self.index  = {}
+        self.stream = open(self.name,'a+b')
+        
+        # Index existing entries, dropping any partially written trailing entry
+        
+        fcntl.flock(self.stream, fcntl.LOCK_EX)
+        
+        self.stream.seek(0)
+        
+        offset = 0
+        
+        while True:
+        
+            record = self.stream.read(self.header.size)
+            
+            if len(record) < self.header.size:
+                break
                 
-            for k in range(len(frame_fx)):
-            
-                if frame_fx[k] == -1: # Then this atom didn't exist in the parameter file - no modification to forces
-                    ofstream.write(popped_data[popped_idx])
-                    popped_idx += 1
-                else:
-                    line = contents[contents_idx+2].split()
-                    idx  = k-2                
-                    ofstream.write(' '.join(line[0:4]) + ' ' + frame_fx[k] + ' ' + frame_fy[k] + ' ' + frame_fz[k] + '\n')
-                    contents_idx += 1
+            key, natoms = struct.unpack("<20si", record[:24])
+            
+            if len(self.stream.read(24*natoms)) < 24*natoms:
+                break
                 
-        ofstream.close()
-        removed.close()
-        helpers.run_bash_cmnd("cp " + traj_files[i] + " " + traj_files[i] + ".original")
-        helpers.run_bash_cmnd("mv subtracted.xyzf " + traj_files[i])
+            self.index[key] = offset
+            
+            offset += self.header.size + 24*natoms
+            
+        self.stream.truncate(offset)
+        
+        fcntl.flock(self.stream, fcntl.LOCK_UN)
+        
+    def __len__(self):
+        return len(self.index)
+        
+    def __contains__(self, key):
+        return key in self.index
+        
+    def hash_params(self, param_file):
+    
+        """ Returns a hash of param_file contents, or of all files in param_file if a directory (e.g. DFTB) """
+    
+        digest = hashlib.sha1()
+        
+        if os.path.isdir(param_file):
+            files = sorted(glob.glob(param_file + "/*"))
+        else:
+            files = [param_file]
+            
+        for name in files:
+            if os.path.isfile(name):
+                digest.update(name.split("/")[-1].encode())
+                with open(name,'rb') as ifstream:
+                    digest.update(ifstream.read())
+                    
+        return digest.hexdigest()
+        
+    def key(self, stripped, stress_type, energy_type, temperature=None):
+    
+        """ Returns the key for a (stripped) frame, as returned by strip_frame """
+    
+        digest = hashlib.sha1()
+        
+        digest.update(' '.join(split_header(stripped[1], stress_type, energy_type)[0]).encode())
+        
+        for k in range(2,len(stripped)):
+            digest.update(('\n' + ' '.join(stripped[k].split()[0:4])).encode())
+            
+        digest.update(("\nT " + str(temperature)).encode())
+        
+        return digest.digest()
+        
+    def get(self, key):
+    
+        """ Returns the energy, stresses, and forces stored for key """
+        
+        self.stream.seek(self.index[key])
+        
+        record     = self.header.unpack(self.stream.read(self.header.size))
+        natoms     = record[1]
+        tmp_forces = struct.unpack("<" + str(3*natoms) + "d", self.stream.read(24*natoms))
+        
+        return record[2], list(record[3:9]), list(tmp_forces)
+        
+    def put(self, key, tmp_ener, tmp_stress, tmp_forces):
+    
+        """ Stores the energy, stresses, and forces (one component per entry) for key """
+    
+        if key in self.index:
+            return
+            
+        natoms = len(tmp_forces)//3
+        
+        fcntl.flock(self.stream, fcntl.LOCK_EX)
+            
+        self.stream.seek(0,2)
+        self.index[key] = self.stream.tell()
+        
+        self.stream.write(self.header.pack(key, natoms, float(tmp_ener), *[float(k) for k in tmp_stress]))
+        self.stream.write(struct.pack("<" + str(3*natoms) + "d", *[float(k) for k in tmp_forces]))
+        self.stream.flush()
+        
+        fcntl.flock(self.stream, fcntl.LOCK_UN)
+        
+    def close(self):
+        self.stream.close()
 
             
 def get_FES(xyz_file, param_file, md_driver, method, temperature=None):
@@ -363,11 +925,11 @@ def get_FES(xyz_file, param_file, md_driver, method, temperature=None):
     force_file = None
     
     if method == "CHIMES":
-        tmp_ener, tmp_stress, force_file = chimes_modify_FES.get_FES("tmp.xyz",param_file, md_driver) 
+        tmp_ener, tmp_stress, force_file = chimes_modify_FES.get_FES(xyz_file,param_file, md_driver) 
     elif method == "DFTB":
-        tmp_ener, tmp_stress, force_file = dftbplus_modify_FES.get_FES("tmp.xyz",param_file, md_driver,temperature) 
+        tmp_ener, tmp_stress, force_file = dftbplus_modify_FES.get_FES(xyz_file,param_file, md_driver,temperature) 
     elif method == "LMP":
-        tmp_ener, tmp_stress, force_file = lmp_modify_FES.get_FES("tmp.xyz",param_file, md_driver) 
+        tmp_ener, tmp_stress, force_file = lmp_modify_FES.get_FES(xyz_file,param_file, md_driver) 
     else:
         print("ERROR: Unrecognized method \"" + method + "\" for modify_FES.get_FES")
         print("Exiting.")
@@ -375,6 +937,35 @@ def get_FES(xyz_file, param_file, md_driver, method, temperature=None):
         
     return tmp_ener, tmp_stress, force_file
 
+
+def get_FES_batch(xyz_file, param_file, md_driver, method, temperatures=None):
+
+    """
+    
+    Multi-frame counterpart of get_FES: Evaluates every frame in xyz_file.
+    
+    Returns a list of energies, a list of stress tensors (GPa), and the name of a file 
+    holding the forces (kcal/mol/Ang) for all frames, one component per line, in frame order.
+    
+    Usage: get_FES_batch("frames.xyz", param_file, md_driver, "LMP", <temperatures>)
+    
+    Notes: temperatures, if given, holds one (electron) temperature per frame.
+           LMP evaluates all frames with a single "rerun"; CHIMES and DFTB run one 
+           frame at a time, but only set up their input files once.
+    
+    """
+    
+    if method == "CHIMES":
+        return chimes_modify_FES.get_FES_batch(xyz_file,param_file, md_driver) 
+    elif method == "DFTB":
+        return dftbplus_modify_FES.get_FES_batch(xyz_file,param_file, md_driver,temperatures) 
+    elif method == "LMP":
+        return lmp_modify_FES.get_FES_batch(xyz_file,param_file, md_driver) 
+    else:
+        print("ERROR: Unrecognized method \"" + method + "\" for modify_FES.get_FES_batch")
+        print("Exiting.")
+        exit()
+
     
 def get_format(traj_file):
 
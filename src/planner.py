@@ -0,0 +1,288 @@
+# Global (python) modules
+
+import os
+import math as m
+
+# Local modules
+
+import helpers
+
+# See gen_ff.solve_amat and main.py for how these are used
+
+PLAN_SAFETY   = 1.5    # Requested walltime is the predicted run time times PLAN_SAFETY
+PLAN_MIN_TIME = 900    # Shortest walltime (s) ever requested
+
+def to_seconds(walltime):
+
+    """
+
+    Converts a slurm walltime ("D-HH:MM:SS", "HH:MM:SS", "MM:SS", or minutes) to seconds.
+
+    Usage: to_seconds("04:00:00")
+
+    """
+
+    walltime = str(walltime)
+    days     = 0
+
+    if "-" in walltime:
+        days, walltime = walltime.split("-")
+
+    fields = [float(field) for field in walltime.split(":")]
+
+    if len(fields) == 1:   # Minutes
+        fields = [0.0, fields[0], 0.0]
+    elif len(fields) == 2: # MM:SS
+        fields = [0.0] + fields
+
+    return int(86400*int(days) + 3600*fields[0] + 60*fields[1] + fields[2])
+
+
+def to_walltime(seconds):
+
+    """
+
+    Converts seconds to a slurm "HH:MM:SS" walltime.
+
+    Usage: to_walltime(14400)
+
+    """
+
+    seconds = int(m.ceil(seconds))
+
+    return str(seconds//3600).rjust(2,'0') + ":" + str((seconds%3600)//60).rjust(2,'0') + ":" + str(seconds%60).rjust(2,'0')
+
+
+def to_gb(mem):
+
+    """
+
+    Converts a sacct memory value (e.g. "1234K", "2.5G") to GB.
+
+    Usage: to_gb("2.5G")
+
+    """
+
+    units = {"K": 2.0**-20, "M": 2.0**-10, "G": 1.0, "T": 2.0**10}
+
+    mem = str(mem).strip()
+
+    if len(mem) == 0:
+        return 0.0
+
+    if mem[-1] in units:
+        return float(mem[:-1]) * units[mem[-1]]
+
+    return float(mem) * 2.0**-30
+
+
+def job_usage(jobids, job_system="slurm"):
+
+    """
+
+    Returns [elapsed seconds, peak memory per task in GB] for a list of completed jobs, via
+    sacct. Elapsed times are summed over jobs, e.g. a job and its restarts.
+
+    Usage: elapsed, maxrss = job_usage(["2116091", "2116092"])
+
+    Notes: Returns None if usage can't be determined, e.g. for non-slurm systems, or if
+           sacct is unavailable.
+
+    """
+
+    if (len(jobids) == 0) or (job_system not in ["slurm", "TACC", "UM-ARC"]):
+        return None
+
+    jobids = [str(jobid).split()[0] for jobid in jobids]
+
+    try:
+        usage = helpers.run_bash_cmnd("sacct -n -P --format=JobID,ElapsedRaw,MaxRSS -j " + ','.join(jobids))
+    except Exception:
+        return None
+
+    elapsed = 0
+    maxrss  = 0.0
+
+    for line in usage.splitlines():
+
+        fields = line.split("|")
+
+        if len(fields) < 3:
+            continue
+
+        if "." not in fields[0]: # The allocation itself; steps hold the memory use
+            elapsed += int(fields[1] or 0)
+
+        maxrss = max(maxrss, to_gb(fields[2]))
+
+    if elapsed == 0:
+        return None
+
+    return [elapsed, maxrss]
+
+
+def record(history, my_ALC, kind, shape, nodes, ppn, jobids, job_system="slurm"):
+
+    """
+
+    Appends the resource use of a completed build_amat or solve_amat step to the run
+    history file.
+
+    Usage: record("resource_history.dat", 3, "solve", [rows, cols], 8, 36, ["2116091"])
+
+    Notes: Each line holds the ALC, kind ("build" or "solve"), A-matrix rows and cols,
+           nodes, tasks per node, elapsed seconds, peak memory per task (GB), and job ids.
+           Nothing is recorded if job_usage can't determine the resource use.
+
+    """
+
+    if len(jobids) == 0: # e.g. solved in-process
+        return
+
+    usage = job_usage(jobids, job_system)
+
+    if (usage is None) or (shape is None):
+        print("Could not determine resource use of", kind, "jobs", jobids, "- not recording")
+        return
+
+    print("Recording", kind, "resource use:", usage[0], "s and", usage[1], "GB/task for a", shape[0], "x", shape[1], "A-matrix on", nodes, "nodes")
+
+    if not os.path.isfile(history):
+        ofstream = open(history,'w')
+        ofstream.write("# ALC kind rows cols nodes ppn elapsed_s maxrss_GB jobids\n")
+        ofstream.close()
+
+    ofstream = open(history,'a')
+    ofstream.write(' '.join([str(my_ALC), kind, str(shape[0]), str(shape[1]), str(nodes), str(ppn), str(usage[0]), repr(usage[1]), ','.join([str(jobid).split()[0] for jobid in jobids])]) + '\n')
+    ofstream.close()
+
+
+def read_plan(planfile, nodes, walltime):
+
+    """
+
+    Returns the [nodes, walltime] written to planfile by gen_ff.solve_amat, or the given
+    nodes and walltime if there's no such file (e.g. planning is disabled).
+
+    Usage: nodes, walltime = read_plan("GEN_FF/plan.txt", 8, "04:00:00")
+
+    """
+
+    if not os.path.isfile(planfile):
+        return [nodes, walltime]
+
+    fields = helpers.cat_to_var(planfile)[0].split()
+
+    return [int(fields[0]), fields[1]]
+
+
+def read_history(history, kind):
+
+    """
+
+    Returns the recorded entries of a given kind as a list of dictionaries, keeping only
+    the last entry for each ALC.
+
+    Usage: entries = read_history("resource_history.dat", "solve")
+
+    """
+
+    entries = {}
+
+    if not os.path.isfile(history):
+        return []
+
+    for line in open(history,'r'):
+
+        fields = line.split()
+
+        if (len(fields) < 8) or (fields[0] == "#") or (fields[1] != kind):
+            continue
+
+        entries[int(fields[0])] = {"ALC": int(fields[0]), "rows": int(fields[2]), "cols": int(fields[3]), "procs": int(fields[4])*int(fields[5]), "elapsed": float(fields[6]), "maxrss": float(fields[7])}
+
+    return [entries[ALC] for ALC in sorted(entries)]
+
+
+def fit_cost(entries):
+
+    """
+
+    Fits the cost model elapsed*procs = c*(rows*cols)^b, and the memory model
+    maxrss*procs = k*rows*cols, to a list of history entries. Returns [c, b, k].
+
+    Usage: c, b, k = fit_cost(read_history("resource_history.dat", "solve"))
+
+    Notes: b is fit (in log space) only when the entries span more than one A-matrix
+           size; otherwise cost is taken to be linear (b = 1). k is the largest observed
+           ratio, in GB per A-matrix entry.
+
+    """
+
+    import numpy as np
+
+    work = np.array([float(entry["rows"])*float(entry["cols"]) for entry in entries])
+    cost = np.array([entry["elapsed"]*entry["procs"] for entry in entries])
+    mem  = np.array([entry["maxrss" ]*entry["procs"] for entry in entries])
+
+    b = 1.0
+
+    if len(set(work)) > 1:
+        b = np.polyfit(np.log(work), np.log(cost), 1)[0]
+        b = min(max(b, 0.5), 3.0) # Guard against wild extrapolation from noisy timings
+
+    c = np.exp(np.mean(np.log(cost) - b*np.log(work)))
+    k = (mem/work).max()
+
+    return [float(c), float(b), float(k)]
+
+
+def plan(history, kind, shape, ppn, min_nodes, max_nodes, walltime, max_walltime, node_mem=None):
+
+    """
+
+    Returns [nodes, walltime] for the next build_amat or solve_amat job, from the run history.
+
+    Usage: nodes, walltime = plan("resource_history.dat", "solve", [rows, cols], 36, 8, 32, "04:00:00", "24:00:00", 256)
+
+    Notes: Uses the fewest nodes in [min_nodes, max_nodes] for which the predicted run time
+           (see fit_cost) times PLAN_SAFETY fits within max_walltime, and the predicted
+           memory per node within node_mem (GB, if given). The requested walltime is the
+           predicted run time times PLAN_SAFETY, at least PLAN_MIN_TIME and at most
+           max_walltime. If shape is None, the last recorded A-matrix shape is assumed.
+           Returns [min_nodes, walltime] unchanged if there's no history yet.
+
+    """
+
+    entries = read_history(history, kind)
+
+    if len(entries) == 0:
+        print("No", kind, "history yet; using", min_nodes, "nodes and", walltime, "walltime")
+        return [int(min_nodes), walltime]
+
+    if shape is None:
+        shape = [entries[-1]["rows"], entries[-1]["cols"]]
+
+    c, b, k = fit_cost(entries)
+
+    work  = float(shape[0])*float(shape[1])
+    limit = to_seconds(max_walltime)
+
+    for nodes in range(int(min_nodes), max(int(min_nodes), int(max_nodes))+1):
+
+        predicted = c*work**b/(nodes*int(ppn))
+        memory    = k*work/nodes
+
+        fits = (predicted*PLAN_SAFETY <= limit) and ((node_mem is None) or (memory <= float(node_mem)))
+
+        if fits:
+            break
+
+    seconds = min(max(predicted*PLAN_SAFETY, PLAN_MIN_TIME), limit)
+
+    if not fits:
+        print("WARNING: Predicted", kind, "job (", int(predicted), "s,", round(memory,1), "GB/node ) exceeds the walltime or memory limit even on", nodes, "nodes")
+
+    print("Planned", kind, "job for a", shape[0], "x", shape[1], "A-matrix:", nodes, "nodes,", to_walltime(seconds), "walltime (predicted", int(predicted), "s,", round(memory,1), "GB/node)")
+
+    return [nodes, to_walltime(seconds)]
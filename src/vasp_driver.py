@@ -180,10 +180,7 @@ def continue_job(*argv, **kwargs):
 
                 print("            Resubmitting.")
 
-                if args["job_system"] == "slurm" or args["job_system"] == "TACC" or args["job_system"] == "UM-ARC":
-                    job_list.append(helpers.run_bash_cmnd("sbatch run_vasp.cmd").split()[-1])
-                else:    
-                    job_list.append(helpers.run_bash_cmnd("qsub run_vasp.cmd").replace('\n', ''))
+                job_list.append(helpers.submit_job("run_vasp.cmd", args["job_system"]))
 
             else:
                 print("            Not resubmitting.")
@@ -915,6 +912,8 @@ def setup_vasp(my_ALC, *argv, **kwargs):
 
         if args["job_system"] == "TACC":
             job_task.append("    ibrun " + "-n " + repr(int(args["job_nodes"])*int(args["job_ppn"])) + " " + args["job_executable"] + " > ${TAG}.out  ")
+        elif args["job_system"] == "local":
+            job_task.append("    mpirun -n " + repr(int(args["job_nodes"])*int(args["job_ppn"])) + " " + args["job_executable"] + " > ${TAG}.out  ")
         else:   
             job_task.append("    srun -N " + repr(args["job_nodes" ]) + " -n " + repr(int(args["job_nodes"])*int(args["job_ppn"])) + " " + args["job_executable"] + " > ${TAG}.out  ")
         job_task.append("    cp OUTCAR  ${TAG}.OUTCAR    ")
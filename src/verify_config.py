@@ -29,6 +29,9 @@ def print_help():
     PARAM.append("HIERARCH_PARAM_FILES");           VARTYP.append("str list");      DETAILS.append("List of parameter files to build on, which chould be in ALL_BASE_FILES/HIERARCH_PARAMS")     
     PARAM.append("HIERARCH_METHOD");                VARTYP.append("str");           DETAILS.append("MD method to use for subtracting existing parameter contributions - current options are CHIMES or LMP")     
     PARAM.append("HIERARCH_EXE");                   VARTYP.append("str");           DETAILS.append("Executable to use when subtracting existing parameter contributions")         
+    PARAM.append("SUBTRACT_BATCH");                 VARTYP.append("bool");          DETAILS.append("Should all frames of a trajectory file be evaluated with a single MD code call when subtracting hierarch./correction contributions?")
+    PARAM.append("SUBTRACT_NPROC");                 VARTYP.append("int");           DETAILS.append("Number of local processes to use when subtracting hierarch./correction contributions")
+    PARAM.append("SUBTRACT_CACHE");                 VARTYP.append("str");           DETAILS.append("Directory for a persistent cache of subtracted hierarch./correction contributions; None disables caching")
     PARAM.append("FIT_CORRECTION");                 VARTYP.append("bool");          DETAILS.append("Is this ChIMES model being fit as a correction to another method?") 
     PARAM.append("CORRECTED_TYPE");                 VARTYP.append("str");           DETAILS.append("Method type being corrected. Currently only \"DFTB\" is supported")    
     PARAM.append("CORRECTED_TYPE_FILES");           VARTYP.append("str");           DETAILS.append("Files needed to run simulations/single points with the method to be corrected")    
@@ -36,9 +39,13 @@ def print_help():
     PARAM.append("CORRECTED_TEMPS_BY_FILE");        VARTYP.append("bool");          DETAILS.append("Should electron temperatures be set to values in traj_list.dat (false) or in specified file location, for correction calculation? Only needed if correction method is QM-based. ")
     PARAM.append("HPC_PPN");                        VARTYP.append("int");           DETAILS.append("The number of processors per node on the machine code is launched on")    
     PARAM.append("HPC_ACCOUNT");                    VARTYP.append("str");           DETAILS.append("Charge bank name on machine code is launched on (e.g. \"pbronze\")")
-    PARAM.append("HPC_SYSTEM");                     VARTYP.append("str");           DETAILS.append("Job scheduler on machine code is launched on (only \"slurm\" , \"TACC\" and \"UM-ARC\" are supported currently)")
+    PARAM.append("HPC_SYSTEM");                     VARTYP.append("str");           DETAILS.append("Job scheduler on machine code is launched on (only \"slurm\" , \"TACC\", \"UM-ARC\" and \"local\" are supported currently)")
     PARAM.append("HPC_PYTHON");                     VARTYP.append("str");           DETAILS.append("Path to python executable (2.X required for now)")
     PARAM.append("HPC_EMAIL");                      VARTYP.append("bool");          DETAILS.append("Controls whether driver status updates are e-mailed to user")
+    PARAM.append("HPC_LOCAL_CORES");                VARTYP.append("int");           DETAILS.append("Number of cores shared by all jobs when HPC_SYSTEM is \"local\" (None for all cores on the machine)")
+    PARAM.append("HPC_JOB_ARRAYS");                 VARTYP.append("bool");          DETAILS.append("Submit each stage's MD/QM jobs as SLURM job array(s) rather than individual jobs")
+    PARAM.append("HPC_ARRAY_MAX");                  VARTYP.append("int");           DETAILS.append("Maximum number of simultaneously running tasks per job array (None for no limit)")
+    PARAM.append("HPC_JOB_CHAIN");                  VARTYP.append("bool");          DETAILS.append("Queue each QM job's continuation at submission, to run only if the job fails (e.g. times out)")
     PARAM.append("ALC0_FILES");                     VARTYP.append("str");           DETAILS.append("Path to base files required by the driver (e.g. ChIMES input files, VASP, input files, etc.)")
     PARAM.append("CHIMES_LSQ");                     VARTYP.append("str");           DETAILS.append("ChIMES_lsq executable absolute path (e.g. CHIMES_SRCDIR + \"chimes_lsq\")")
     PARAM.append("CHIMES_SOLVER");                  VARTYP.append("str");           DETAILS.append("lsq2.py executable absolute path (e.g. CHIMES_SRCDIR + \"lsq2.py\")")
@@ -54,6 +61,14 @@ def print_help():
     PARAM.append("REGRESS_ALG");                    VARTYP.append("str");           DETAILS.append("Regression algorithm to use for fitting; only \"lassolars\" supported for now")
     PARAM.append("REGRESS_NRM");                    VARTYP.append("bool");          DETAILS.append("Controls whether A-matrix is normalized prior to solution")
     PARAM.append("REGRESS_VAR");                    VARTYP.append("bool");          DETAILS.append("Regression regularization variable")
+    PARAM.append("REGRESS_SWEEP");                  VARTYP.append("list");          DETAILS.append("Regularization values to evaluate in one pass during local solves (see CHIMES_SOLVE_LOCAL); writes GEN_FF/sweep/")
+    PARAM.append("REGRESS_HOLDOUT");                VARTYP.append("float");         DETAILS.append("Fraction of rows held out when evaluating REGRESS_SWEEP")
+    PARAM.append("REGRESS_WARM");                   VARTYP.append("bool");          DETAILS.append("Warm-start local lasso solves (see CHIMES_SOLVE_LOCAL) from the previous ALC's GEN_FF/x.txt; queued DLARS/DLASSO solves aren't warm-started")
+    PARAM.append("AMAT_STORE");                     VARTYP.append("str");           DETAILS.append("If set (\"float64\" or \"float32\"), A/b/weights/natoms are kept in binary stores and combined without text round-trips")
+    PARAM.append("AMAT_SPLIT_NPROC");               VARTYP.append("int");           DETAILS.append("Number of local processes used to index and split the A-matrix for dlasso, to read it for local solves, and to evaluate hyper sets")
+    PARAM.append("CHIMES_SOLVE_LOCAL");             VARTYP.append("bool/str");      DETAILS.append("Solve the A-matrix in-process (svd, ridge, or lasso via coordinate descent) rather than submitting a job? True, False, or \"auto\"")
+    PARAM.append("CHIMES_LOCAL_MAX");               VARTYP.append("float");         DETAILS.append("Largest A-matrix (rows*cols) solved in-process when CHIMES_SOLVE_LOCAL is \"auto\"")
+    PARAM.append("AMAT_PRUNE");                     VARTYP.append("bool");          DETAILS.append("Remove all-zero and duplicate A-matrix columns before solving? x.txt is expanded back to full length (see GEN_FF/column_map.txt)")
     PARAM.append("CHIMES_LSQ_MODULES");             VARTYP.append("str");           DETAILS.append("System-specific modules needed to run ChIMES-LSQ jobs")
     PARAM.append("CHIMES_BUILD_NODES");             VARTYP.append("int");           DETAILS.append("Number of nodes to use when running chimes_lsq")
     PARAM.append("CHIMES_BUILD_QUEUE");             VARTYP.append("int");           DETAILS.append("Queue to submit chimes_lsq job to")
@@ -62,6 +77,10 @@ def print_help():
     PARAM.append("CHIMES_SOLVE_PPN");               VARTYP.append("int");           DETAILS.append("Number of procs per node to use when running lsq2.py/DLARS (lassolars)")
     PARAM.append("CHIMES_SOLVE_QUEUE");             VARTYP.append("str");           DETAILS.append("Queue to submit the lsq2.py/DLARS (lassolars) job to")
     PARAM.append("CHIMES_SOLVE_TIME");              VARTYP.append("str");           DETAILS.append("Walltime for lsq2.py/DLARS (lassolars) job (e.g. \"04:00:00\")")
+    PARAM.append("PLAN_RESOURCES");                 VARTYP.append("bool");          DETAILS.append("Size build/solve job nodes and walltime from the run history (resource_history.dat)?")
+    PARAM.append("PLAN_MAX_NODES");                 VARTYP.append("int");           DETAILS.append("Most nodes the resource planner may request for a build/solve job")
+    PARAM.append("PLAN_MAX_TIME");                  VARTYP.append("str");           DETAILS.append("Longest walltime the resource planner may request for a build/solve job (e.g. \"24:00:00\")")
+    PARAM.append("PLAN_NODE_MEM");                  VARTYP.append("float");         DETAILS.append("Memory per node (GB) available to build/solve jobs, used by the resource planner")
     PARAM.append("MD_STYLE");                       VARTYP.append("str");           DETAILS.append("Should MD simulations be run as ChIMES-only (\"CHIMES\") or DFTB+ChIMES (\"DFTB\")?")    
     PARAM.append("MOLANAL");                        VARTYP.append("str");           DETAILS.append("Absolute path to the molanal src directory")
     PARAM.append("MDFILES");                        VARTYP.append("str");           DETAILS.append("Absolute path to MD input files like case-0.indep-0.run_md.in (e.g. WORKING_DIR + \"ALL_BASE_FILES/CHIMESMD_FILES\")")
@@ -891,6 +910,24 @@ def verify(user_config):
             
                 user_config.HIERARCH_EXE = None                
 
+    if not hasattr(user_config,'SUBTRACT_BATCH'):
+
+        # Determines whether hierarch./correction contributions are evaluated for all frames at once
+        
+        user_config.SUBTRACT_BATCH = False
+
+    if not hasattr(user_config,'SUBTRACT_NPROC'):
+
+        # Number of local processes used to evaluate hierarch./correction contributions
+        
+        user_config.SUBTRACT_NPROC = 1
+
+    if not hasattr(user_config,'SUBTRACT_CACHE'):
+
+        # Directory for the persistent cache of hierarch./correction contributions
+        
+        user_config.SUBTRACT_CACHE = None
+
 
     ################################
     ##### General HPC options
@@ -943,6 +980,50 @@ def verify(user_config):
         print("         Will use False")
         
         user_config.HPC_EMAIL = False
+        
+    if not hasattr(user_config, 'HPC_LOCAL_CORES'):
+
+        # Number of cores shared by all jobs run by the local scheduler
+
+        if user_config.HPC_SYSTEM == "local":
+            print("WARNING: Option config.HPC_LOCAL_CORES was not set")
+            print("         Will use all cores on this machine")
+        
+        user_config.HPC_LOCAL_CORES = None
+        
+    if not hasattr(user_config, 'HPC_JOB_ARRAYS'):
+
+        # Boolean: Submit each stage's MD/QM jobs as SLURM job array(s)?
+
+        print("WARNING: Option config.HPC_JOB_ARRAYS was not set")
+        print("         Will use False")
+        
+        user_config.HPC_JOB_ARRAYS = False
+        
+    if user_config.HPC_JOB_ARRAYS and (user_config.HPC_SYSTEM not in ["slurm", "TACC", "UM-ARC"]):
+
+        print("WARNING: Option config.HPC_JOB_ARRAYS is only supported for SLURM systems (slurm, TACC, UM-ARC)")
+        print("         Will use False for HPC_SYSTEM", user_config.HPC_SYSTEM)
+        
+        user_config.HPC_JOB_ARRAYS = False
+        
+    if not hasattr(user_config, 'HPC_ARRAY_MAX'):
+
+        # Maximum number of simultaneously running tasks per job array
+
+        print("WARNING: Option config.HPC_ARRAY_MAX was not set")
+        print("         Will use None (no limit)")
+        
+        user_config.HPC_ARRAY_MAX = None
+        
+    if not hasattr(user_config, 'HPC_JOB_CHAIN'):
+
+        # Boolean: Queue each QM job's continuation (afternotok dependency) at submission?
+
+        print("WARNING: Option config.HPC_JOB_CHAIN was not set")
+        print("         Will use False")
+        
+        user_config.HPC_JOB_CHAIN = False
 
 
 
@@ -1202,6 +1283,68 @@ def verify(user_config):
         
         user_config.REGRESS_VAR = 1.0E-5                
 
+    if not hasattr(user_config,'REGRESS_SWEEP'):
+
+        # Regularization values to evaluate in one pass during local solves
+
+        user_config.REGRESS_SWEEP = None
+
+    if not hasattr(user_config,'REGRESS_HOLDOUT'):
+
+        # Fraction of rows held out when evaluating REGRESS_SWEEP
+
+        user_config.REGRESS_HOLDOUT = 0.1
+
+    if not hasattr(user_config,'REGRESS_WARM'):
+
+        # Warm-start local lasso solves from the previous ALC's solution?
+
+        user_config.REGRESS_WARM = False
+
+    if not hasattr(user_config,'AMAT_STORE'):
+
+        # Should A-matrices be kept in binary stores? (None, "float64", or "float32")
+
+        user_config.AMAT_STORE = None
+
+    if not hasattr(user_config,'AMAT_SPLIT_NPROC'):
+
+        # Number of local processes used to index and split the A-matrix
+
+        user_config.AMAT_SPLIT_NPROC = 1
+
+    if not hasattr(user_config,'CHIMES_SOLVE_LOCAL'):
+
+        # Should the A-matrix be solved in-process? True, False, or "auto" (decide by size)
+
+        user_config.CHIMES_SOLVE_LOCAL = False
+
+    if (user_config.HPC_SYSTEM == "local") and (str(user_config.CHIMES_SOLVE_LOCAL) != "True"):
+
+        # The queued ChIMES solver job launches dlars/dlasso with srun or ibrun
+
+        print("WARNING: Queued A-matrix solves aren't supported for HPC_SYSTEM \"local\"")
+        print("         Will use True for config.CHIMES_SOLVE_LOCAL")
+
+        user_config.CHIMES_SOLVE_LOCAL = True
+
+    if user_config.REGRESS_WARM and (str(user_config.CHIMES_SOLVE_LOCAL) == "False"):
+
+        print("WARNING: Option config.REGRESS_WARM only applies to local solves (see CHIMES_SOLVE_LOCAL)")
+        print("         Queued DLARS/DLASSO solves will start from scratch")
+
+    if not hasattr(user_config,'CHIMES_LOCAL_MAX'):
+
+        # Largest A-matrix (rows*cols) solved in-process when CHIMES_SOLVE_LOCAL is "auto"
+
+        user_config.CHIMES_LOCAL_MAX = 1.0E8
+
+    if not hasattr(user_config,'AMAT_PRUNE'):
+
+        # Remove all-zero and duplicate A-matrix columns before solving?
+
+        user_config.AMAT_PRUNE = False
+
     if not hasattr(user_config,'CHIMES_BUILD_NODES'):
 
         # The number of nodes to use for chimes_lsq
@@ -1275,6 +1418,30 @@ def verify(user_config):
         
         user_config.CHIMES_SOLVE_TIME = "24:00:00"
 
+    if not hasattr(user_config,'PLAN_RESOURCES'):
+
+        # Size build/solve jobs from the run history?
+
+        user_config.PLAN_RESOURCES = False
+
+    if not hasattr(user_config,'PLAN_MAX_NODES'):
+
+        # Most nodes the resource planner may request
+
+        user_config.PLAN_MAX_NODES = 2*int(user_config.CHIMES_SOLVE_NODES)
+
+    if not hasattr(user_config,'PLAN_MAX_TIME'):
+
+        # Longest walltime the resource planner may request
+
+        user_config.PLAN_MAX_TIME = user_config.CHIMES_SOLVE_TIME
+
+    if not hasattr(user_config,'PLAN_NODE_MEM'):
+
+        # Memory per node (GB) available to build/solve jobs; None for no limit
+
+        user_config.PLAN_NODE_MEM = None
+
     ################################
     ##### ChIMES MD
     ################################
@@ -0,0 +1,109 @@
+""" Tests for modify_FES.ContributionCache and its use by subtract_frame. """
+
+import os
+
+import modify_FES
+
+
+FRAME = ["3\n", "10.0 10.0 10.0 1.0 2.0 3.0 -5.0\n",
+         "C 0.0 0.0 0.0 0.1 0.2 0.3\n",
+         "N 1.0 0.0 0.0 0.4 0.5 0.6\n",
+         "O 0.0 1.0 0.0 0.7 0.8 0.9\n"]
+
+
+def open_cache(tmp_path):
+
+    params = tmp_path / "params.txt"
+
+    if not params.exists():
+        params.write_text("some parameters\n")
+
+    return modify_FES.ContributionCache(str(tmp_path / "cache"), str(params), "CHIMES")
+
+
+def stripped_key(cache, frame=FRAME, temperature=None):
+
+    return cache.key(modify_FES.strip_frame(frame, ["C", "O"])[0], "diag", "yes", temperature)
+
+
+def test_key(tmp_path):
+
+    cache = open_cache(tmp_path)
+
+    moved = FRAME[:2] + ["C 0.0 0.0 0.5 0.1 0.2 0.3\n"] + FRAME[3:]
+
+    # Forces, stresses, energies, and atoms that aren't fitted don't change the key
+
+    relabeled = [FRAME[0], "10.0 10.0 10.0 9.0 9.0 9.0 -1.0\n", "C 0.0 0.0 0.0 9 9 9\n", "N 5.0 5.0 5.0 0 0 0\n", FRAME[4]]
+
+    assert stripped_key(cache) == stripped_key(cache, relabeled)
+    assert stripped_key(cache) != stripped_key(cache, moved)
+    assert stripped_key(cache) != stripped_key(cache, FRAME, 1000)
+
+    cache.close()
+
+
+def test_put_get_and_reopen(tmp_path):
+
+    cache = open_cache(tmp_path)
+    key   = stripped_key(cache)
+
+    assert key not in cache
+
+    cache.put(key, -1.5, [1, 2, 3, 4, 5, 6], ["0.25\n", "-0.5\n", "1.0\n", "2.0\n", "3.0\n", "4.0\n"])
+    cache.put(key, 99.0, [0]*6, [0]*6) # Existing entries aren't replaced
+
+    assert cache.get(key) == (-1.5, [1.0, 2.0, 3.0, 4.0, 5.0, 6.0], [0.25, -0.5, 1.0, 2.0, 3.0, 4.0])
+
+    cache.close()
+
+    cache = open_cache(tmp_path)
+
+    assert len(cache) == 1
+    assert cache.get(key)[0] == -1.5
+
+    cache.close()
+
+
+def test_truncated_tail_recovered(tmp_path):
+
+    cache = open_cache(tmp_path)
+    first = stripped_key(cache)
+    cache.put(first, -1.0, [0]*6, [1.0]*6)
+    cache.put(stripped_key(cache, FRAME, 500), -2.0, [0]*6, [2.0]*6)
+    cache.close()
+
+    # As if a writer died partway through the second entry
+
+    size = os.path.getsize(cache.name)
+
+    with open(cache.name, 'r+b') as stream:
+        stream.truncate(size - 8)
+
+    cache = open_cache(tmp_path)
+
+    assert len(cache) == 1
+    assert cache.get(first)[0] == -1.0
+
+    second = stripped_key(cache, FRAME, 500)
+    cache.put(second, -3.0, [0]*6, [3.0]*6)
+
+    assert cache.get(second)[2] == [3.0]*6
+    assert os.path.getsize(cache.name) == size
+
+    cache.close()
+
+
+def test_subtracted_log_independent_of_cache():
+
+    # Forces as read from forceout.txt (cache miss) or from the cache (hit) give the same output
+
+    stripped, kept = modify_FES.strip_frame(FRAME, ["C", "O"])
+
+    text   = ["1.50000000e+01\n", "-2.0\n", "0.0\n", "3.25\n", "4\n", "-5.5e-01\n"]
+    floats = [float(force) for force in text]
+
+    from_text  = modify_FES.subtract_frame(FRAME, kept, "diag", "yes", -1.0, [0.1]*6, text)
+    from_cache = modify_FES.subtract_frame(FRAME, kept, "diag", "yes", -1.0, [0.1]*6, floats)
+
+    assert from_text == from_cache
@@ -0,0 +1,67 @@
+""" Tests for job array collection in helpers.submit_job / submit_job_array. """
+
+import os
+
+import helpers
+import local_sched
+
+
+def write_job(job_dir, nodes="1"):
+
+    os.makedirs(job_dir)
+
+    with open(os.path.join(job_dir, "run.cmd"), 'w') as ofstream:
+        ofstream.write("#!/bin/bash\n#SBATCH -J job\n#SBATCH -N " + nodes + "\n#SBATCH --ntasks-per-node 1\n#SBATCH -o stdoutmsg\ntrue\n")
+
+
+def test_uncollected_jobids_pass_through(tmp_path, monkeypatch):
+
+    # On non-SLURM systems jobs are submitted directly, so their ids must survive
+
+    monkeypatch.chdir(tmp_path)
+    write_job(str(tmp_path / "w0"))
+    monkeypatch.chdir(tmp_path / "w0")
+
+    helpers.begin_job_array(True)
+
+    jobids = [helpers.submit_job("run.cmd", "local")]
+
+    assert helpers.submit_job_array(jobids, job_system="local") == jobids
+
+    helpers.wait_for_jobs(jobids, job_system="local", poll_min=0.05)
+
+    assert local_sched.query_exit_states(jobids)[jobids[0]][0] == "COMPLETED"
+
+
+def test_slurm_jobs_grouped_into_arrays(tmp_path, monkeypatch):
+
+    submitted = []
+
+    def fake_sbatch(cmnd):
+        submitted.append(cmnd)
+        return "Submitted batch job " + str(100 + len(submitted))
+
+    monkeypatch.setattr(helpers, "run_bash_cmnd", fake_sbatch)
+    monkeypatch.chdir(tmp_path)
+
+    helpers.begin_job_array(True)
+
+    jobids = []
+
+    for i, nodes in enumerate(["1", "2", "1"]):
+        write_job(str(tmp_path / ("w" + str(i))), nodes)
+        monkeypatch.chdir(tmp_path / ("w" + str(i)))
+        jobids.append(helpers.submit_job("run.cmd", "slurm"))
+
+    monkeypatch.chdir(tmp_path)
+
+    assert jobids == ["array-0", "array-1", "array-2"]
+    assert submitted == []
+
+    assert helpers.submit_job_array(jobids, job_name="md", job_system="slurm") == ["101", "102"]
+    assert helpers.JOB_ARRAY is None
+
+    manifest = open(str(tmp_path / "md.0.array.dat")).read().split('\n')
+
+    assert [line.split()[0] for line in manifest if line] == [str(tmp_path / "w0"), str(tmp_path / "w2")]
+    assert "#SBATCH --array=0-1\n" in open(str(tmp_path / "md.0.array.cmd")).readlines()
@@ -0,0 +1,88 @@
+""" Tests for continuation jobs (helpers.begin_job_chain), using the local scheduler. """
+
+import os
+
+import helpers
+
+
+RERUNNABLE = ("#!/bin/bash\n#SBATCH -J qm\n#SBATCH -N 1\n#SBATCH --ntasks-per-node 1\n#SBATCH -o stdoutmsg\n"
+              "if [ -f done ] ; then echo continued ; exit 0 ; fi\n"
+              "touch done ; echo first ; exit $FAIL\n")
+
+
+def submit_chained(tmp_path, monkeypatch, fail):
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("FAIL", "1" if fail else "0")
+
+    (tmp_path / "run_qm.cmd").write_text(RERUNNABLE)
+
+    helpers.begin_job_chain(True)
+
+    jobids  = [helpers.submit_job("run_qm.cmd", "local")]
+    jobids += helpers.end_job_chain()
+
+    return jobids, helpers.wait_for_jobs(jobids, job_system="local", poll_min=0.05)
+
+
+def test_continuation_keeps_failed_log(tmp_path, monkeypatch):
+
+    jobids, states = submit_chained(tmp_path, monkeypatch, True)
+
+    assert [states[jobid][0] for jobid in jobids] == ["FAILED", "COMPLETED"]
+    assert (tmp_path / "stdoutmsg").read_text() == "first\n"
+    assert (tmp_path / "stdoutmsg.continue").read_text() == "continued\n"
+
+
+def test_continuation_cancelled_after_success(tmp_path, monkeypatch, capsys):
+
+    jobids, states = submit_chained(tmp_path, monkeypatch, False)
+
+    assert [states[jobid][0] for jobid in jobids] == ["COMPLETED", "CANCELLED"]
+    assert not os.path.exists(str(tmp_path / "stdoutmsg.continue"))
+    assert "WARNING" not in capsys.readouterr().out
+    assert jobids[1] not in helpers.CONDITIONAL_JOBS
+
+
+def test_array_continuation_outputs(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+
+    (tmp_path / "qm.0.array.cmd").write_text("#!/bin/bash\n#SBATCH -J qm\n#SBATCH -o qm.0.%a.out\n#SBATCH --array=0-1\n"
+                                             "cd ${WORK_DIR}\nbash ${JOB_FILE} > stdoutmsg 2>&1\n")
+
+    contents = open(helpers.write_continuation("qm.0.array.cmd")).read()
+
+    assert "#SBATCH -o qm.0.%a.out.continue\n" in contents
+    assert "bash ${JOB_FILE} > stdoutmsg.continue 2>&1\n" in contents
+
+
+def test_torque_job_file_and_dependency(tmp_path, monkeypatch):
+
+    submitted = []
+
+    def fake_qsub(cmnd):
+        if not cmnd.startswith("qsub"):
+            return ""
+        submitted.append(cmnd)
+        return str(300 + len(submitted)) + ".server\n"
+
+    monkeypatch.setattr(helpers, "run_bash_cmnd", fake_qsub)
+    monkeypatch.chdir(tmp_path)
+
+    helpers.begin_job_chain(True)
+
+    jobid  = helpers.create_and_launch_job(job_name="qm", job_nodes="2", job_ppn="4", job_walltime="01:00:00", job_queue="batch",
+                                           job_account="acct", job_email=False, job_executable="true", job_system="torque", job_file="run_qm.cmd")
+    chain  = helpers.end_job_chain()
+
+    lines = open("run_qm.cmd").read().split('\n')
+
+    assert "#PBS -l nodes=2:ppn=4" in lines
+    assert "#PBS -o stdoutmsg" in lines
+    assert not [line for line in lines if line.startswith("#SBATCH")]
+    assert "#PBS -o stdoutmsg.continue" in open("continue.run_qm.cmd").read().split('\n')
+
+    assert jobid == "301.server"
+    assert chain == ["302.server"]
+    assert submitted[1:] == ["qsub -W depend=afternotok:301.server continue.run_qm.cmd"]
@@ -0,0 +1,102 @@
+""" Checks that in-process solves (local_lsq) agree with solving the explicit weighted A-matrix. """
+
+import numpy as np
+
+import gen_ff
+import local_lsq
+
+
+def write_problem(tmp_path, rows=60, cols=6):
+
+    # A small A-matrix with a near-duplicate and a tiny column, so that the svd cutoff matters
+
+    rng = np.random.default_rng(7)
+
+    A = rng.normal(size=(rows, cols)) * np.array([1.0, 10.0, 1.0E-7, 1.0, 5.0, 1.0])
+    A[:,5] = A[:,0] + 1.0E-9*rng.normal(size=rows)
+    b = A @ np.array([1.0, -0.2, 3.0, 0.0, 0.5, 0.0]) + 0.01*rng.normal(size=rows)
+    w = rng.uniform(0.5, 2.0, size=rows)
+
+    np.savetxt(str(tmp_path / "A_comb.txt"),      A)
+    np.savetxt(str(tmp_path / "b_comb.txt"),      b)
+    np.savetxt(str(tmp_path / "weights_comb.dat"), w)
+
+    gram = gen_ff.text_gram(str(tmp_path / "A_comb.txt"), str(tmp_path / "b_comb.txt"), str(tmp_path / "weights_comb.dat"), 2, 16)
+
+    # As in the ChIMES solver, each row is scaled by its weight
+
+    return gram, A * w[:,None], b * w
+
+
+def test_svd_matches_explicit(tmp_path):
+
+    gram, wA, wb = write_problem(tmp_path)
+
+    # REGRESS_NRM doesn't apply to svd jobs, so mustn't change the local solution either
+
+    for nrm in [True, False]:
+        x = local_lsq.solve(gram, "svd", 1.0E-5, nrm)
+        assert np.allclose(x, np.linalg.lstsq(wA, wb, rcond=1.0E-5)[0], rtol=1.0E-6, atol=1.0E-8)
+
+
+def test_ridge_matches_explicit(tmp_path):
+
+    gram, wA, wb = write_problem(tmp_path)
+
+    alpha = 0.1
+    aug_A = np.vstack([wA, np.sqrt(alpha)*np.eye(wA.shape[1])])
+    aug_b = np.concatenate([wb, np.zeros(wA.shape[1])])
+
+    for nrm in [True, False]:
+        x = local_lsq.solve(gram, "ridge", alpha, nrm)
+        assert np.allclose(x, np.linalg.lstsq(aug_A, aug_b, rcond=None)[0], rtol=1.0E-6, atol=1.0E-8)
+
+
+def test_dlasso_is_optimal_for_normalized_problem(tmp_path):
+
+    gram, wA, wb = write_problem(tmp_path)
+
+    alpha = 1.0E-2
+    rows  = len(wb)
+    scale = np.linalg.norm(wA, axis=0)
+
+    x = local_lsq.solve(gram, "dlasso", alpha, True) * scale
+
+    # KKT conditions of min 1/(2*rows)*||(wA/scale) x - wb||^2 + alpha*||x||_1
+
+    grad = (wA/scale).T @ (wb - (wA/scale) @ x) / rows
+
+    assert np.count_nonzero(x) > 0
+    assert np.allclose(grad[x != 0], alpha*np.sign(x[x != 0]), atol=1.0E-5)
+    assert np.all(np.abs(grad[x == 0]) <= alpha + 1.0E-6)
+
+
+def lasso_sweeps(out):
+
+    return int(out.split("Lasso converged after ")[-1].split()[0])
+
+
+def test_lasso_warm_start(capsys):
+
+    # Each ALC only adds rows, so the previous solution is close to the new one
+
+    rng  = np.random.default_rng(1)
+    base = rng.normal(size=(400, 30))
+    A    = base + 0.8*base[:,[0]]
+    b    = A @ np.concatenate([rng.normal(size=8), np.zeros(22)]) + 0.05*rng.normal(size=400)
+
+    previous = gen_ff.new_gram(30)
+    current  = gen_ff.new_gram(30)
+    gen_ff.add_gram(previous, A[:300], b[:300], np.ones(300))
+    gen_ff.add_gram(current,  A,       b,       np.ones(400))
+
+    x0 = local_lsq.solve(previous, "lasso", 1.0E-2, False)
+
+    cold = local_lsq.solve(current, "lasso", 1.0E-2, False)
+    cold_sweeps = lasso_sweeps(capsys.readouterr().out)
+
+    warm = local_lsq.solve(current, "lasso", 1.0E-2, False, x0)
+    warm_sweeps = lasso_sweeps(capsys.readouterr().out)
+
+    assert np.allclose(warm, cold, atol=1.0E-5)
+    assert warm_sweeps < cold_sweeps
@@ -0,0 +1,88 @@
+""" Tests for the local scheduler (local_sched). """
+
+import time
+
+import pytest
+
+import helpers
+import local_sched
+
+
+@pytest.fixture(autouse=True)
+def fresh_scheduler(monkeypatch, tmp_path):
+
+    monkeypatch.setattr(local_sched, "QUEUED",   [])
+    monkeypatch.setattr(local_sched, "RUNNING",  {})
+    monkeypatch.setattr(local_sched, "FINISHED", {})
+    monkeypatch.chdir(tmp_path)
+
+    local_sched.set_cores(3)
+
+
+def write_job(job_file, cores, command="true"):
+
+    with open(job_file, 'w') as ofstream:
+        ofstream.write("#!/bin/bash\n#SBATCH -N 1\n#SBATCH --ntasks-per-node " + str(cores) + "\n#SBATCH -o " + job_file + ".out\n" + command + "\n")
+
+    return job_file
+
+
+def wait_all(jobids):
+
+    while local_sched.query_active_jobs(jobids):
+        time.sleep(0.02)
+
+    return local_sched.query_exit_states(jobids)
+
+
+def test_backfill_and_core_accounting():
+
+    # A 2-core job leaves 1 core free: the next 2-core job waits, but a 1-core job behind it starts
+
+    hold  = local_sched.submit(write_job("hold.cmd",  2, "sleep 0.5"))
+    wait  = local_sched.submit(write_job("wait.cmd",  2))
+    small = local_sched.submit(write_job("small.cmd", 1, "sleep 0.5"))
+
+    assert sorted(local_sched.RUNNING) == sorted([hold, small])
+    assert [job[0] for job in local_sched.QUEUED] == [wait]
+    assert sum([local_sched.RUNNING[jobid][1] for jobid in local_sched.RUNNING]) == 3
+
+    assert wait_all([hold, wait, small]) == {jobid: ["COMPLETED", "0:0"] for jobid in [hold, wait, small]}
+
+
+def test_oversized_job_capped():
+
+    jobid = local_sched.submit(write_job("big.cmd", 8))
+
+    assert local_sched.RUNNING[jobid][1] == 3
+
+    wait_all([jobid])
+
+
+def test_dependencies_cancel_or_run():
+
+    failed     = local_sched.submit(write_job("fail.cmd", 1, "exit 2"))
+    afterok    = local_sched.submit(write_job("ok.cmd",   1), "afterok:"    + failed)
+    afternotok = local_sched.submit(write_job("notok.cmd",1), "afternotok:" + failed)
+    afterany   = local_sched.submit(write_job("any.cmd",  1), "afterany:"   + failed)
+    chained    = local_sched.submit(write_job("next.cmd", 1), "afterok:"    + afterok)
+
+    states = wait_all([failed, afterok, afternotok, afterany, chained])
+
+    assert states[failed    ] == ["FAILED", "2:0"]
+    assert states[afterok   ] == ["CANCELLED", None]
+    assert states[afternotok] == ["COMPLETED", "0:0"]
+    assert states[afterany  ] == ["COMPLETED", "0:0"]
+    assert states[chained   ] == ["CANCELLED", None] # Its dependency can never succeed
+
+
+def test_create_and_launch_job_writes_sbatch_lines(tmp_path):
+
+    jobid = helpers.create_and_launch_job(job_nodes="1", job_ppn="2", job_executable="echo hello", job_system="local", job_file="run.cmd")
+
+    assert local_sched.job_cores("run.cmd") == 2
+    assert local_sched.job_output("run.cmd") == "stdoutmsg"
+
+    wait_all([jobid])
+
+    assert (tmp_path / "stdoutmsg").read_text() == "hello\n"
@@ -0,0 +1,50 @@
+""" Tests for parallel frame evaluation in modify_FES. """
+
+import os
+
+import pytest
+
+import modify_FES
+
+
+def write_frames(xyz_file, nframes):
+
+    with open(xyz_file, 'w') as ofstream:
+        for i in range(nframes):
+            ofstream.write("1\n10.0 10.0 10.0\nC 0.0 0.0 " + str(i) + ".0\n")
+
+
+def failing_FES_batch(xyz_file, param_file, md_driver, method, temperatures=None):
+
+    # As the reference code wrappers do on failure
+
+    print("ERROR: reference code failed")
+    exit()
+
+
+def test_absolute_command(tmp_path, monkeypatch):
+
+    (tmp_path / "bin").mkdir()
+    (tmp_path / "bin" / "lmp").write_text("")
+    (tmp_path / "run").mkdir()
+
+    monkeypatch.chdir(tmp_path / "run")
+
+    assert modify_FES.absolute_command("srun -n 1 ../bin/lmp") == "srun -n 1 " + str(tmp_path / "bin" / "lmp")
+    assert modify_FES.absolute_command("lmp_mpi -in") == "lmp_mpi -in"
+
+
+def test_worker_exit_is_reported(tmp_path, monkeypatch):
+
+    # A worker that exit()s must not leave Pool.map waiting forever
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(modify_FES, "get_FES_batch", failing_FES_batch)
+
+    write_frames("frames.xyz", 4)
+
+    with pytest.raises(modify_FES.ChunkError) as err:
+        modify_FES.evaluate_parallel("frames.xyz", "params.txt", "lmp", "LMP", None, 2, True, "scratch")
+
+    assert "SystemExit" in str(err.value)
+    assert os.getcwd() == str(tmp_path)
@@ -0,0 +1,89 @@
+""" Tests for helpers.monitor_jobs, using fake queue commands via its override hooks. """
+
+import os
+import stat
+
+import helpers
+
+
+def write_fake_queue(path, outputs):
+
+    # A fake squeue/qstat: prints outputs[n] on its n-th call ("FAIL" exits with an error)
+    # and the last entry once they run out
+
+    with open(path + ".dat", 'w') as ofstream:
+        ofstream.write('\0'.join(outputs))
+
+    with open(path, 'w') as ofstream:
+        ofstream.write("#!/usr/bin/env python3\n"
+                       "import sys\n"
+                       "calls = " + repr(path + ".calls") + "\n"
+                       "n = len(open(calls).read()) if __import__('os').path.exists(calls) else 0\n"
+                       "open(calls, 'a').write('x')\n"
+                       "outputs = open(" + repr(path + ".dat") + ").read().split('\\0')\n"
+                       "out = outputs[min(n, len(outputs)-1)]\n"
+                       "if out == 'FAIL': sys.exit(1)\n"
+                       "sys.stdout.write(out)\n")
+
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+    return path
+
+
+def record_sleeps(monkeypatch):
+
+    sleeps = []
+
+    monkeypatch.setattr(helpers.time, "sleep", lambda interval: sleeps.append(interval))
+
+    return sleeps
+
+
+def test_backoff_arrays_and_conditional_jobs(tmp_path, monkeypatch, capsys):
+
+    sleeps = record_sleeps(monkeypatch)
+
+    squeue = write_fake_queue(str(tmp_path / "squeue"), [
+        "100_0|RUNNING\n100_1|PENDING\n101|PENDING\n",
+        "FAIL",
+        "100_1|RUNNING\n101|PENDING\n",
+        "101|PENDING\n",
+        ""])
+
+    sacct = write_fake_queue(str(tmp_path / "sacct"), [
+        "100_0|COMPLETED|0:0\n100_1|FAILED|1:0\n101|CANCELLED by 0|0:0\n"])
+
+    monkeypatch.setattr(helpers, "CONDITIONAL_JOBS", ["101"])
+
+    states = helpers.monitor_jobs(["100", "101"], poll_min=1, poll_max=2, job_squeue=squeue, job_sacct=sacct, job_user="")
+
+    # Grows while nothing finishes (a failed squeue call changes nothing), capped at
+    # poll_max, and resets when a job finishes
+
+    assert sleeps == [1, 1.5, 2, 1]
+
+    # An array's state is that of its first task that didn't complete
+
+    assert states == {"100": ["FAILED", "1:0"], "101": ["CANCELLED", "0:0"]}
+
+    out = capsys.readouterr().out
+
+    assert "WARNING: Job 100 " in out
+    assert "WARNING: Job 101 " not in out # A cancelled continuation means its original job succeeded
+
+
+def test_torque_jobs_polled_with_qstat(tmp_path, monkeypatch):
+
+    sleeps = record_sleeps(monkeypatch)
+
+    header = "Job ID    Name  User  Time Use S Queue\n--------- ----- ----- -------- - -----\n"
+
+    qstat = write_fake_queue(str(tmp_path / "qstat"), [
+        header + "200.server  md  me  0 R batch\n201[].server  md  me  0 Q batch\n",
+        header + "200.server  md  me  0 C batch\n201[].server  md  me  0 R batch\n",
+        header + "200.server  md  me  0 C batch\n"])
+
+    states = helpers.monitor_jobs(["200.server", "201[].server"], job_system="torque", poll_min=1, poll_max=2, job_qstat=qstat)
+
+    assert sleeps == [1, 1]
+    assert states == {"200.server": ["UNKNOWN", None], "201[].server": ["UNKNOWN", None]}
@@ -0,0 +1,58 @@
+""" Smoke tests for planner.py: record -> read_history -> plan. """
+
+import helpers
+import planner
+
+
+def fake_sacct(elapsed, maxrss):
+
+    """ Returns a stand-in for helpers.run_bash_cmnd that answers sacct queries. """
+
+    return lambda cmnd: "1|" + str(elapsed) + "|\n1.0|" + str(elapsed) + "|" + maxrss + "\n"
+
+
+def test_record_read_history_plan(tmp_path, monkeypatch):
+
+    history = str(tmp_path / "resource_history.dat")
+
+    monkeypatch.setattr(helpers, "run_bash_cmnd", fake_sacct(3600, "2G"))
+    planner.record(history, 1, "solve", [1000, 100], 4, 36, ["1"])
+
+    monkeypatch.setattr(helpers, "run_bash_cmnd", fake_sacct(7200, "4G"))
+    planner.record(history, 2, "solve", [2000, 100], 4, 36, ["2"])
+
+    entries = planner.read_history(history, "solve")
+
+    assert [entry["ALC"] for entry in entries] == [1, 2]
+    assert entries[0]["procs"]   == 4*36
+    assert entries[1]["elapsed"] == 7200.0
+    assert entries[1]["maxrss"]  == 4.0
+
+    # Cost is linear in rows*cols: 4000 rows take 16 node-hours, which with PLAN_SAFETY
+    # must fit in 3 hours, i.e. 16*1.5/3 = 8 nodes
+
+    nodes, walltime = planner.plan(history, "solve", [4000, 100], 36, 1, 16, "01:00:00", "03:00:00")
+
+    assert nodes == 8
+    assert walltime == "03:00:00"
+
+
+def test_record_without_jobs(tmp_path):
+
+    history = str(tmp_path / "resource_history.dat")
+
+    planner.record(history, 1, "solve", [1000, 100], 4, 36, [])
+
+    assert planner.read_history(history, "solve") == []
+    assert planner.plan(history, "solve", [1000, 100], 36, 2, 8, "01:00:00", "04:00:00") == [2, "01:00:00"]
+
+
+def test_read_plan(tmp_path):
+
+    planfile = tmp_path / "plan.txt"
+
+    assert planner.read_plan(str(planfile), 8, "04:00:00") == [8, "04:00:00"]
+
+    planfile.write_text("12 02:30:00\n")
+
+    assert planner.read_plan(str(planfile), 8, "04:00:00") == [12, "02:30:00"]
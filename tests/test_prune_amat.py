@@ -0,0 +1,98 @@
+""" Checks that solves of pruned A-matrices (gen_ff.prune_amat) are equivalent to solves of the full A-matrix. """
+
+import numpy as np
+import pytest
+
+import gen_ff
+import local_lsq
+
+
+def write_problem(tmp_path, monkeypatch):
+
+    # Columns 3 and 4 duplicate column 1, and column 5 is all-zero
+
+    monkeypatch.chdir(tmp_path)
+
+    rng = np.random.default_rng(3)
+
+    A = rng.normal(size=(40, 6))
+    A[:,3] = A[:,1]
+    A[:,4] = A[:,1]
+    A[:,5] = 0.0
+    b = A @ np.array([1.0, 2.0, -0.5, 0.0, 0.0, 0.0]) + 0.1*rng.normal(size=40)
+
+    np.savetxt("A_comb.txt",       A)
+    np.savetxt("b_comb.txt",       b)
+    np.savetxt("weights_comb.dat", np.ones(40))
+
+    return A, b
+
+
+def solve_pruned(alg, var, split_dups):
+
+    amat = gen_ff.prune_amat("A_comb.txt", split_dups)
+
+    assert amat == "A_prune.txt"
+
+    gram = gen_ff.text_gram(amat, "b_comb.txt", "weights_comb.dat")
+
+    return gen_ff.expand_x(local_lsq.solve(gram, alg, var, False), gen_ff.read_column_map())
+
+
+def test_ridge_and_svd_split_duplicates(tmp_path, monkeypatch):
+
+    A, b = write_problem(tmp_path, monkeypatch)
+
+    alpha = 0.5
+    ridge = np.linalg.solve(A.T @ A + alpha*np.eye(6), A.T @ b)
+
+    assert np.allclose(solve_pruned("ridge", alpha, True), ridge)
+    assert np.allclose(solve_pruned("svd", 1.0E-5, True), np.linalg.lstsq(A, b, rcond=1.0E-5)[0])
+
+
+def test_lasso_merges_duplicates(tmp_path, monkeypatch):
+
+    A, b = write_problem(tmp_path, monkeypatch)
+
+    alpha = 0.05
+    full  = local_lsq.solve(gen_ff.text_gram("A_comb.txt", "b_comb.txt", "weights_comb.dat"), "lasso", alpha, False)
+    x     = solve_pruned("lasso", alpha, False)
+
+    # Lasso solutions with duplicate columns aren't unique, but their objective is
+
+    objective = lambda x: 0.5/len(b)*np.sum((A @ x - b)**2) + alpha*np.abs(x).sum()
+
+    assert np.count_nonzero(x[3:]) == 0
+    assert np.isclose(objective(x), objective(full), rtol=1.0E-6)
+
+
+def test_store_gram_submatrix_matches_pruned(tmp_path, monkeypatch):
+
+    # In-process solves of stores take the kept, scaled submatrix of the full normal equations
+
+    write_problem(tmp_path, monkeypatch)
+
+    gen_ff.write_store("A.bin", "A_comb.txt")
+
+    assert gen_ff.prune_amat("A.bin", True) == "A_prune.bin"
+
+    kept, ncols, groups, scale = gen_ff.read_column_map()
+
+    assert ncols == 6
+    assert groups == [[0], [1, 3, 4], [2]]
+
+    full   = gen_ff.text_gram("A_comb.txt", "b_comb.txt", "weights_comb.dat")
+    pruned = gen_ff.amat_product("A_prune.bin", np.eye(3))
+
+    assert np.allclose(full["AtWA"][np.ix_(kept,kept)] * np.outer(scale, scale), pruned.T @ pruned)
+    assert np.allclose(gen_ff.prune_x(gen_ff.expand_x(np.array([1.0, 2.0, 3.0]), gen_ff.read_column_map()), gen_ff.read_column_map()), [1.0, 2.0, 3.0])
+
+
+def test_all_zero_amat(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+
+    np.savetxt("A_comb.txt", np.zeros((4, 3)))
+
+    with pytest.raises(SystemExit):
+        gen_ff.prune_amat("A_comb.txt")
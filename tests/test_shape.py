@@ -0,0 +1,51 @@
+""" Tests for shape manifests of concatenated text files (gen_ff.write_shape with parts). """
+
+import pytest
+
+import gen_ff
+import helpers
+
+
+def concatenate(tmp_path, monkeypatch, parts):
+
+    monkeypatch.chdir(tmp_path)
+
+    for i, contents in enumerate(parts):
+        (tmp_path / ("part" + str(i) + ".txt")).write_text(contents)
+
+    names = ["part" + str(i) + ".txt" for i in range(len(parts))]
+
+    helpers.cat_specific("comb.txt", names)
+
+    return names
+
+
+def test_parts_match_scan(tmp_path, monkeypatch):
+
+    names = concatenate(tmp_path, monkeypatch, ["1 2 3\n4 5 6\n", "", "7 8 9\n"])
+
+    shape = gen_ff.write_shape("comb.txt", names)
+
+    assert [shape["rows"], shape["cols"]] == [3, 3]
+    assert len(shape["blocks"]) == 3 # Taken from the parts, not rescanned
+    assert gen_ff.read_shape("comb.txt")["rows"] == 3
+
+
+def test_part_without_newline_rescanned(tmp_path, monkeypatch):
+
+    # The concatenation joins "4 5 6" and "7 8 9" into one row
+
+    names = concatenate(tmp_path, monkeypatch, ["1 2 3\n4 5 6", "7 8 9\n"])
+
+    shape = gen_ff.write_shape("comb.txt", names)
+
+    assert shape["rows"] == 2
+    assert len(shape["blocks"]) == 1
+
+
+def test_column_mismatch_is_an_error(tmp_path, monkeypatch):
+
+    names = concatenate(tmp_path, monkeypatch, ["1 2 3\n", "4 5\n"])
+
+    with pytest.raises(SystemExit):
+        gen_ff.write_shape("comb.txt", names)
@@ -0,0 +1,135 @@
+""" Round-trip tests for binary stores (gen_ff.write_store and its readers). """
+
+import numpy as np
+
+import gen_ff
+
+
+def write_matrix(tmp_path, monkeypatch, rows=7):
+
+    monkeypatch.chdir(tmp_path)
+
+    rng = np.random.default_rng(5)
+    A   = rng.normal(size=(rows, 4)) * 10.0**rng.integers(-6, 6, size=(rows, 4))
+
+    np.savetxt("A.txt", A, fmt="%.17g")
+
+    return A
+
+
+def test_store_round_trip(tmp_path, monkeypatch):
+
+    A = write_matrix(tmp_path, monkeypatch)
+
+    header = gen_ff.write_store("A.bin", "A.txt", "float64", block_rows=3)
+
+    assert [header["rows"], header["cols"]] == ["7", "4"]
+    assert gen_ff.read_store_header("A.bin")["rows"] == "7"
+    assert np.array_equal(gen_ff.read_store("A.bin")[0], A)
+
+    # Text export is exact for float64, also for row ranges
+
+    gen_ff.export_store("A.bin", "A_out.txt")
+    gen_ff.export_store("A.bin", "A_part.txt", 2, 5)
+
+    assert np.array_equal(np.loadtxt("A_out.txt"), A)
+    assert np.array_equal(np.loadtxt("A_part.txt"), A[2:5])
+
+
+def test_float32_store(tmp_path, monkeypatch):
+
+    A = write_matrix(tmp_path, monkeypatch)
+
+    gen_ff.write_store("A.bin", "A.txt", "float32")
+    gen_ff.export_store("A.bin", "A_out.txt")
+
+    assert np.array_equal(np.loadtxt("A_out.txt").astype(np.float32), A.astype(np.float32)) # %.9g round-trips float32
+
+
+def write_alcs(tmp_path, monkeypatch):
+
+    # Two ALCs' stores, and ALC-1's manifests combining them
+
+    rng    = np.random.default_rng(5)
+    blocks = []
+
+    for alc, rows in enumerate([7, 5]):
+
+        alc_dir = tmp_path / ("ALC-" + str(alc))
+        alc_dir.mkdir()
+        monkeypatch.chdir(alc_dir)
+
+        A = rng.normal(size=(rows, 4)) * 10.0**rng.integers(-6, 6, size=(rows, 4))
+        b = rng.normal(size=rows)
+        w = rng.uniform(0.5, 2.0, size=rows)
+
+        np.savetxt("A.txt", A, fmt="%.17g")
+        np.savetxt("b.txt", b, fmt="%.17g")
+        np.savetxt("weights.dat", w, fmt="%.17g")
+
+        gen_ff.write_store("A.bin", "A.txt")
+        gen_ff.write_store("b.bin", "b.txt")
+        gen_ff.write_store("weights.bin", "weights.dat")
+        gen_ff.write_gram("gram.npz", "A.bin", "b.bin", "weights.bin")
+
+        blocks.append([A, b, w])
+
+    for name, block in [["A_comb.blocks", "A.bin"], ["b_comb.blocks", "b.bin"], ["weights_comb.blocks", "weights.bin"], ["gram_comb.blocks", "gram.npz"]]:
+        gen_ff.write_manifest(name, ["../ALC-0/" + block, block])
+
+    return [np.concatenate([block[i] for block in blocks]) for i in range(3)]
+
+
+def test_manifest_round_trip(tmp_path, monkeypatch):
+
+    A, b, w = write_alcs(tmp_path, monkeypatch)
+
+    header = gen_ff.read_store_header("A_comb.blocks")
+
+    assert [header["rows"], header["cols"]] == ["12", "4"]
+
+    # Row ranges may span blocks
+
+    gen_ff.export_store("A_comb.blocks", "A_comb.txt")
+    gen_ff.export_store("A_comb.blocks", "A_part.txt", 5, 9)
+
+    assert np.array_equal(np.loadtxt("A_comb.txt"), A)
+    assert np.array_equal(np.loadtxt("A_part.txt"), A[5:9])
+    assert np.array_equal(np.concatenate([contents for contents, header in gen_ff.iter_blocks("b_comb.blocks")])[:,0], b)
+
+
+def test_gram_blocks(tmp_path, monkeypatch):
+
+    A, b, w = write_alcs(tmp_path, monkeypatch)
+
+    gram = gen_ff.read_gram("gram_comb.blocks")
+
+    # As in the solver, rows are scaled by their weight
+
+    wA = A * w[:,None]
+    wb = b * w
+
+    assert np.allclose(gram["AtWA"], wA.T @ wA, rtol=1.0E-12)
+    assert np.allclose(gram["AtWb"], wA.T @ wb, rtol=1.0E-12)
+    assert np.isclose (gram["btWb"], wb @ wb,   rtol=1.0E-12)
+    assert gram["rows"] == 12
+
+
+def test_rows_and_gram_match_text(tmp_path, monkeypatch):
+
+    # Reading through iter_rows, and the text path's normal equations, agree with the stores
+
+    A, b, w = write_alcs(tmp_path, monkeypatch)
+
+    np.savetxt("A_comb.txt",       A, fmt="%.17g")
+    np.savetxt("b_comb.txt",       b, fmt="%.17g")
+    np.savetxt("weights_comb.dat", w, fmt="%.17g")
+
+    assert np.array_equal(np.concatenate(list(gen_ff.iter_rows("A_comb.blocks", 3))), A)
+    assert np.array_equal(np.concatenate(list(gen_ff.iter_rows("A_comb.txt",    3))), A)
+
+    stored = gen_ff.read_gram("gram_comb.blocks")
+    text   = gen_ff.text_gram("A_comb.txt", "b_comb.txt", "weights_comb.dat", 2, 4)
+
+    for key in ["AtWA", "AtWb", "btWb", "rows"]:
+        assert np.allclose(stored[key], text[key], rtol=1.0E-12)
@@ -0,0 +1,83 @@
+""" Checks that gen_ff.update_weights matches regenerating weights from scratch. """
+
+import numpy as np
+
+import gen_ff
+
+
+SETTINGS = {"weights_energy_gas": [["A"],      [[2.0]]],
+            "weights_energy":     [["A", "C"], [[5.0], [1.0, -0.1, 2.0]]],
+            "weights_stress":     [["A"],      [[100.0]]],
+            "weights_force_gas":  [["B"],      [[1.0, 0.5]]],
+            "weights_force":      [["A", "B"], [[1.0], [2.0, 0.25]]]}
+
+ALC = 3
+
+
+def write_block(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+
+    with open("b-labeled.txt", 'w') as ofstream:
+        ofstream.write("C 0.5\nC -1.5\nG_C 0.25\ns_xx 0.1\ns_yy 0.2\n+1 -10.0\n+1 -12.0\nG_+1 -3.0\n")
+
+    np.savetxt("natoms.txt", [4, 4, 2, 4, 4, 4, 8, 2])
+
+    gen_ff.write_weights("weights.dat", "b-labeled.txt", "natoms.txt", ALC, **SETTINGS)
+
+    gen_ff.write_store("weights.bin", "weights.dat", meta=gen_ff.weights_meta(ALC, False, **SETTINGS))
+    gen_ff.write_store("natoms.bin",  "natoms.txt")
+
+
+def check_update(settings, monkeypatch, rescaled):
+
+    expected = gen_ff.write_weights("expected.dat", "b-labeled.txt", "natoms.txt", ALC, **settings)
+
+    if rescaled: # Make sure nothing is regenerated
+
+        def no_regeneration(*args):
+            raise AssertionError("weights were regenerated")
+
+        monkeypatch.setattr(gen_ff, "gen_weights", no_regeneration)
+
+    updated = gen_ff.update_weights("weights.bin", "b-labeled.txt", "natoms.bin", "weights.new.bin", **settings)
+
+    assert updated == "weights.new.bin"
+    assert np.allclose(gen_ff.read_store(updated)[0][:,0], expected, rtol=1.0E-12)
+
+    # The updated store records its settings, so a second update does nothing
+
+    assert gen_ff.update_weights(updated, "b-labeled.txt", "natoms.bin", "weights.newer.bin", **settings) == updated
+
+
+def test_unchanged_settings_kept(tmp_path, monkeypatch):
+
+    write_block(tmp_path, monkeypatch)
+
+    assert gen_ff.update_weights("weights.bin", "b-labeled.txt", "natoms.bin", "weights.new.bin", **SETTINGS) == "weights.bin"
+
+
+def test_rescaled_in_closed_form(tmp_path, monkeypatch):
+
+    # Only A/B parameters change: forces and gas forces are rescaled
+
+    write_block(tmp_path, monkeypatch)
+
+    settings = dict(SETTINGS)
+    settings["weights_force"    ] = [["A", "B"], [[3.0], [2.0, 0.5]]]
+    settings["weights_force_gas"] = [["B"],      [[0.5, 1.0]]]
+
+    check_update(settings, monkeypatch, True)
+
+
+def test_regenerated(tmp_path, monkeypatch):
+
+    # A row-dependent (C) parameter, and a method list, change: energies and stresses are regenerated
+
+    write_block(tmp_path, monkeypatch)
+
+    settings = dict(SETTINGS)
+    settings["weights_energy"] = [["A", "C"], [[5.0], [1.0, -0.2, 2.0]]]
+    settings["weights_stress"] = [["A", "E"], [[100.0], [0.5]]]
+
+    check_update(settings, monkeypatch, False)
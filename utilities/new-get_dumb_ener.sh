@@ -10,6 +10,10 @@
 #	2.
 #		msub -l nodes=<#nodes>:ppn=<#procs> <this .cmd file> <parameter file> REPO
 # 		Expects only xyzlist.dat in the working directory
+#
+#	Energies are computed by one persistent worker (new-get_dumb_ener_subjob.sh) per proc, 
+#	each pulling configurations from a shared, flock-guarded work queue (DUMB_ENER_QUEUE)
+#	until it's empty. Requires flock, and a working directory on a file system supporting it.
 	  		  	  
 #MSUB -V		  
 #MSUB -o stdoutmsg	  
@@ -69,7 +73,7 @@ do
 		readarray -t REPO_FILES < ${TARG}xyzlist.dat
 		
 		
-		# Prepare to break the job into $NPROC separate jobs
+		# Set up the shared work queue, pulled from by $NWORK persistent workers
 		
 		NJOBS=${#REPO_FILES[@]} # Number of configurations to compute energies for
 		
@@ -79,79 +83,44 @@ do
 			continue
 		fi
 		
+		NWORK=$NPROC
 		
 		if [ $NJOBS -lt $NPROC ] ; then
 		
-			NPROC=$NJOBS
+			NWORK=$NJOBS
 			
-			echo "NJOBS < NPROCS ... will only use $NPROC procs."			
+			echo "NJOBS < NPROCS ... will only use $NWORK procs."			
 		fi
-			
-		
-		JPERN=`echo " $NJOBS / $NPROC    " | bc`
-		NJOB1=`echo " $JPERN * $NPROC + 1" | bc`
 		
 		echo "	...Processing $NJOBS configurations"
-		echo "	...(approx. $JPERN configurations per proc)" 
+		echo "	...(dynamically distributed over $NWORK procs)" 
 		
-		SUBJOB=0
-		LFTOVR=0
+		QUEUE=`pwd`/DUMB_ENER_QUEUE
 		
-		rm -rf  DUMB_ENER_SUBJOB-*
-
-		for (( i=0; i<$NJOBS; i++))
-		do
-			# Which subjob are we on? Set up the subjob .sh driver scripts and the .cmd script
+		rm -rf  DUMB_ENER_SUBJOB-* ${QUEUE}
+		mkdir ${QUEUE}
 		
-			NEWSUBJOB=`echo " ($i ) % $JPERN " | bc` # Returns modulo
-			
-			CURRJOB=$[ $i + 1 ]
-			
-			if   [ $CURRJOB -eq $NJOB1 ] ; then
-			
-				LFTOVR=$SUBJOB
-			
-				SUBJOB=1
-				
-			elif [ $CURRJOB -gt $NJOB1 ] ; then
-			
-				SUBJOB=$[ $SUBJOB + 1 ]
-			
-			elif [[ $NEWSUBJOB -eq 0 ]] ; then 
-
-				SUBJOB=$[ $SUBJOB + 1 ]
-				
-				mkdir DUMB_ENER_SUBJOB-${SUBJOB}
-				cp ${DRIVER}/utilities/new-get_dumb_ener_subjob.sh DUMB_ENER_SUBJOB-${SUBJOB}
-				cp $PARAMS DUMB_ENER_SUBJOB-${SUBJOB}				  
-			fi
-			
-			echo "		...Assigning configuration $i to proc $SUBJOB / $NPROC:"
-
-			echo ${REPO_FILES[$i]} >> DUMB_ENER_SUBJOB-${SUBJOB}/xyzlist.dat
-			
-		done
+		# Hand out the largest clusters (most atoms) first, so that no long 
+		# calculation is left to start once the rest of the queue has drained
 		
-		if [ $LFTOVR -gt 0 ] ; then
-			SUBJOB=$LFTOVR
-		fi
+		cp ${TARG}xyzlist.dat ${QUEUE}/xyzlist.dat
 		
-		echo "	...Counted $SUBJOB subjobs"
-
-		# Run this "TARG's" NPROCS dumb energy calculations 
+		awk '{print NR-1, $1}' ${TARG}xyzlist.dat | sort -k2,2nr -k1,1n | awk '{print $1}' > ${QUEUE}/order
 		
-		CURRNODE=-1
-
-		for (( i=1; i<=$SUBJOB; i++))
+		echo 0 > ${QUEUE}/next
+		touch    ${QUEUE}/lock
+		
+		# Launch this "TARG's" NWORK workers; each claims configurations from 
+		# the queue until it's empty
+		
+		for (( i=1; i<=$NWORK; i++))
 		do
-			ITERATOR=`echo "( $i - 1 ) % $PROCS" | bc` 
-
-			if [ $ITERATOR -eq 0 ] ; then let CURRNODE=CURRNODE+1; fi
+			mkdir DUMB_ENER_SUBJOB-${i}
+			cp $PARAMS DUMB_ENER_SUBJOB-${i}
 			
 			cd DUMB_ENER_SUBJOB-${i}
 			
-			TASK=`pwd`
-			TASK="${TASK}/new-get_dumb_ener_subjob.sh 1 ${EXEC} ${BASE} ${i} "
+			TASK="`pwd`/../new-get_dumb_ener_subjob.sh 1 ${EXEC} ${BASE} ${i} ${QUEUE}"
 			
 			srun -N 1 -n 1 ${TASK} &
 
@@ -159,18 +128,22 @@ do
 		done
 
 		
-		# Process output of TARG's runs
+		# Process output of TARG's runs: workers write "<line number> <energy>", 
+		# so restore xyzlist.dat order
 			
 		wait	  
 		
-		rm -f ${TARG}xyzlist.energies ${TARG}xyzlist.energies_normed
+		cat DUMB_ENER_SUBJOB-*/xyzlist.energies | sort -k1,1n | awk '{print $2}' > ${TARG}xyzlist.energies
+		
+		paste ${TARG}xyzlist.dat ${TARG}xyzlist.energies | awk '{print $NF/$1}' > ${TARG}xyzlist.energies_normed
+		
+		NDONE=`cat ${TARG}xyzlist.energies | wc -l`
+		
+		if [ $NDONE -ne $NJOBS ] ; then
+			echo "WARNING: Computed $NDONE of $NJOBS energies for ${TARG}xyzlist.dat"
+		fi
 		
-		for (( i=1; i<=$SUBJOB; i++))	   
-		do				   
-			cat DUMB_ENER_SUBJOB-${i}/xyzlist.energies		>> ${TARG}xyzlist.energies		  
-			cat DUMB_ENER_SUBJOB-${i}/xyzlist.energies_normed 	>> ${TARG}xyzlist.energies_normed	  
-			rm -rf DUMB_ENER_SUBJOB-${i}	  
-		done				  
+		rm -rf DUMB_ENER_SUBJOB-* ${QUEUE}
 
 done
 
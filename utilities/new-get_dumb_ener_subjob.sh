@@ -4,42 +4,77 @@
 # Notes: WHEN RUN WITH: srun -N 1 -n 1 ${TASK}, $EXEC should NOT be compiled with MPI support
 #        i.e. use g++ instead of mpicxx
 
-# Expects a xyzlist.dat file to be generated in the working directory
+# Runs as one of the persistent workers launched by new-get_dumb_ener.sh: repeatedly claims
+# the next configuration from the shared work queue in $QUEUE, until the queue is empty.
+#
+# $QUEUE contains:
+#	xyzlist.dat	The configurations.. format is: <natoms> <n_c> <n_o> </path/to/xyz/file>
+#	order		Order in which to hand out configurations (line numbers in xyzlist.dat, from 0)
+#	next		Number of configurations handed out so far
+#	lock		Lock file guarding "next" (flock)
+#
+# Writes "<line number> <energy>" for each configuration it computed to xyzlist.energies,
+# in the working directory
 
 NPROC=$1 	# This job is always run serially for now
 EXEC=$2	 	# EXEC=/p/lscratchrza/rlindsey/RC4B_RAG/11-12-18/SVN_SRC-11-12-18/chimes_md
 BASE=$3  	# ../../../../DUMB_FF/run_md.base
 SUBJOB=$4
+QUEUE=$5	# /path/to/DUMB_ENER_QUEUE
 
-# Read the list of configurations.. format is: <natoms> <n_c> <n_o> </path/to/xyz/file>
+readarray -t REPO_FILES < ${QUEUE}/xyzlist.dat
+readarray -t ORDER      < ${QUEUE}/order
 
-readarray -t REPO_FILES < xyzlist.dat
+# Claim the next entry of ORDER; prints nothing once the queue is empty
+
+claim_task()
+{
+	(
+		flock 9
+
+		NEXT=`cat ${QUEUE}/next`
+
+		if [ $NEXT -lt ${#ORDER[@]} ] ; then
+			echo $[ $NEXT + 1 ] > ${QUEUE}/next
+			echo $NEXT
+		fi
+	) 9>> ${QUEUE}/lock
+}
 
 rm -f xyzlist.energies
 
-echo "Subjob $SUBJOB is running, with ${#REPO_FILES[@]} loop tasks"
+echo "Subjob $SUBJOB is running, pulling from a queue of ${#REPO_FILES[@]} loop tasks"
 
 rm -f md_statistics.out
 
-for (( i=0; i<${#REPO_FILES[@]}; i++))
+NDONE=0
+
+while true
 do
+	TASK=`claim_task`
+
+	if [ -z "$TASK" ] ; then break ; fi
+
+	i=${ORDER[$TASK]}
+
 	NO_A=`echo ${REPO_FILES[$i]} | awk '{print $1}'`
 	XYZF=`echo ${REPO_FILES[$i]} | awk '{print $NF}'`
-	
+
 	awk -v infile="../${XYZF}" '/CRDFILE/{print;getline;$0=infile}{print}' $BASE > run_md.in
-	
+
 	echo "	...job $i, subjob $SUBJOB	(../${XYZF})"
 
 	${EXEC} run_md.in | tail -n 20 # > /dev/null
 
-	awk -v natoms="${NO_A}" '{if(NR==3){print ($5*natoms); exit}}' md_statistics.out >> xyzlist.energies
+	echo "$i `awk -v natoms="${NO_A}" '{if(NR==3){print ($5*natoms); exit}}' md_statistics.out`" >> xyzlist.energies
 	rm -f md_statistics.out
-	
+
+	NDONE=$[ $NDONE + 1 ]
+
 	echo ""
-	
+
 done
 
-paste xyzlist.dat xyzlist.energies | awk '{print $NF/$1}' > xyzlist.energies_normed
+echo "Subjob $SUBJOB is done, after $NDONE loop tasks"
 
 exit 0
-